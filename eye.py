@@ -7,17 +7,47 @@
   WTW、角膜厚度、瞳孔直径、眼压、双眼视觉/集合/AC/A、调节幅度、翻转拍(cpm)等
 - 干预/治疗记录：阿托品/防控眼镜/捕光仪/七叶洋地参/翻转拍/其它；含频次与依从性
 - 趋势图：视力（左/右/均值）+ SE（左右/均值）+ 远视储备 + 眼轴
-- 汇总：阶段×干预（次数、频次均值、依从性均值、使用时平均视力/SE）
+- 生长预测：按当前阶段趋势外推 6/12 个月眼轴与 SE（含 95% 预测区间）
+- 汇总：阶段×干预（次数、频次均值、依从性均值、使用时平均视力/SE；视力按 logMAR 平均）
 - 最近一次 A4 打印报告（建议浏览器打印：Ctrl+P，选择A4纵向）
+- 导出：英文字段 JSONL / FHIR Observation NDJSON / Parquet，可去标识化、按录入时间增量导出
+  （命令行：python eye.py export --format fhir --deid --incremental）
+- 归档分层：早于设定天数的记录移入 archive/ 按年分区的压缩 Parquet，默认只读近期数据，
+  查看全部历史或历史阶段时才按需读取（命令行：python eye.py archive --days 730，可配合定时任务）
+- 分片存储：python eye.py shard [--by-site] 把数据按孩子（可再按站点）拆成分片，打开某个孩子只读他的分片；
+  批处理按分片并行（python eye.py batch summary|quality|reports）
+- 复查提醒：按阶段医生建议里的复查间隔算每个孩子的下次复查日期，并提示依从性低 / 频次下降的干预；
+  python eye.py schedule --once 写出当天摘要 digests/digest-YYYY-MM-DD.json（可配合定时任务每天运行）
+- 加密存储：python eye.py encrypt 把数据文件（含分片）转为分块 AES-GCM 加密，页面只解密用到的块，
+  新记录只加密新块追加；python eye.py bench-storage 对比明文与加密的读写吞吐（需要 cryptography）
+- 压力测试：python eye.py loadtest --sessions 8 --steps 20（多会话模拟，报告重跑耗时 p50/p95、写冲突、内存）
 
 数据文件：
 - vision_data.csv：检查+干预+关键数据
 - stages.csv：阶段表
+- audit_log.jsonl + audit/：修改记录（哈希链审计日志）与定期快照
+- archive/：归档的旧记录（exams-<年份>.parquet）与清单 manifest.json
+- shards/：按孩子分片存储时代替 vision_data.csv（每个孩子一个 CSV + 分片索引 index.json）
+- encryption.json：加密存储标记（算法与密钥指纹）；此时数据文件为 *.enc（分块密文）+ *.enc.idx（加密的块索引）
 """
 
+import io
 import os
+import gzip
+import re
 import sys
+import json
+import base64
+import struct
+import hashlib
+import hmac
+import argparse
+import time
+import shutil
+import tempfile
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
 
 # ================== 🪄 魔法启动（subprocess 启动 streamlit） ==================
@@ -53,22 +83,73 @@ def magic_launch():
 
 
 if __name__ == "__main__":
-    if not running_in_streamlit():
+    # 不带参数（双击运行）时魔法启动页面；带子命令时走命令行工具（见文件末尾 cli_main）
+    if not running_in_streamlit() and len(sys.argv) == 1:
         magic_launch()
 
 # ================== Streamlit APP ==================
+import numpy as np
 import streamlit as st
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
+from streamlit.errors import StreamlitAPIException
+
+try:  # 可选依赖：有 pyarrow 时启用预处理数据的 Arrow 缓存
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = feather = pq = None
+
+try:  # 可选依赖：加密存储（AES-GCM）
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+    InvalidTag = ValueError
+
+try:  # 数据写锁用的文件锁：POSIX 用 fcntl，Windows 用 msvcrt
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 CSV_FILE = "vision_data.csv"
 STAGE_FILE = "stages.csv"
+CACHE_DIR = ".eye_cache"
+PUBLISHED_FILE = os.path.join(CACHE_DIR, "published.json")
+
+# 按孩子分片存储（学校筛查等多孩子场景）：存在分片索引时，数据改为每个孩子（可再按站点分目录）一个 CSV
+SHARD_DIR = "shards"
+SHARD_INDEX = os.path.join(SHARD_DIR, "index.json")
+
+# 加密存储：存在 encryption.json 时，数据文件改为分块 AES-GCM 加密；密钥取自环境变量，或数据目录之外的密钥文件
+# （encrypt --key-file 指定，路径记在 encryption.json 里，可用 EYE_KEY_FILE 覆盖）
+ENCRYPTION_FILE = "encryption.json"
+ENCRYPTION_KEY_ENV = "EYE_DATA_KEY"
+ENCRYPTION_KEY_FILE_ENV = "EYE_KEY_FILE"
+
+# 预处理逻辑（阶段匹配/干预标签等）变化时递增，旧缓存自动失效
+PREPARED_CACHE_VERSION = 6
+
+# 超大历史档案：超过该大小的数据文件改为分块流式读取（常量内存），不再整表载入
+LARGE_ARCHIVE_BYTES = int(os.environ.get("EYE_LARGE_ARCHIVE_MB", "200")) * 1024 * 1024
+STREAM_CHUNK_ROWS = 50_000
+STREAM_TAIL_ROWS = 2_000
+
+# 归档分层：早于该天数的检查记录可移入 archive/ 下按年分区的压缩 Parquet（冷数据），默认视图只读热数据文件
+ARCHIVE_DIR = "archive"
+ARCHIVE_MANIFEST = os.path.join(ARCHIVE_DIR, "manifest.json")
+ARCHIVE_HORIZON_DAYS = int(os.environ.get("EYE_ARCHIVE_DAYS", "730"))
 
-st.set_page_config(page_title="宝贝视力成长档案", page_icon="🧸", layout="wide")
 
 # ================== UI 美化 ==================
-st.markdown(
-    """
+def page_setup() -> None:
+    """页面配置与样式（只在页面运行时调用，命令行工具不触发）。"""
+    st.set_page_config(page_title="宝贝视力成长档案", page_icon="🧸", layout="wide")
+    st.markdown(
+        """
 <style>
 .block-container { padding-top: 1.0rem; padding-bottom: 2rem; max-width: 1250px; }
 .small-hint { font-size: 12px; color: #6c757d; margin-top: -6px; }
@@ -120,22 +201,28 @@ hr { margin: .6rem 0; }
 .print-only { display:none; }
 </style>
 """,
-    unsafe_allow_html=True,
-)
+        unsafe_allow_html=True,
+    )
+
 
 # ================== 列定义 ==================
 BASE_COLUMNS = [
     "日期",
+    "儿童",
+    "站点",
     "阶段ID",
     "阶段名称",
     "阶段主方案",
     "左眼视力",
     "右眼视力",
+    "左眼_logMAR",
+    "右眼_logMAR",
     "左眼远视储备",
     "右眼远视储备",
     "眼轴长度(L)",
     "眼轴长度(R)",
     "备注",
+    "录入时间",
 ]
 
 TREAT_COLUMNS = [
@@ -188,7 +275,13 @@ EXAM_EXTRA_COLUMNS = [
     "Flipper_备注",
 ]
 
-ALL_COLUMNS = BASE_COLUMNS + TREAT_COLUMNS + EXAM_EXTRA_COLUMNS
+# 派生指标：由检查项按公式算出（读入/保存时整列重算，不在表单中录入）
+DERIVED_COLUMNS = [
+    f"{eye}_{c}" for eye in ("右眼", "左眼")
+    for c in ("CR(mm)", "AL/CR", "M", "J0", "J45", "角膜J0", "角膜J45")
+]
+
+ALL_COLUMNS = BASE_COLUMNS + TREAT_COLUMNS + EXAM_EXTRA_COLUMNS + DERIVED_COLUMNS
 
 # ================== 阶段表 ==================
 STAGE_COLUMNS = [
@@ -196,42 +289,695 @@ STAGE_COLUMNS = [
     "主方案", "阶段目标", "医生建议", "备注", "是否启用"
 ]
 
+# 所有日期列（读入时统一转换为 datetime）
+DATE_COLUMNS = [
+    "日期",
+    "阿托品_开始日期", "阿托品_结束日期",
+    "防控眼镜_开始日期", "防控眼镜_结束日期",
+    "捕光仪_开始日期", "捕光仪_结束日期",
+    "七叶洋地参_开始日期", "七叶洋地参_结束日期",
+    "翻转拍_开始日期", "翻转拍_结束日期",
+    "其它干预_开始日期", "其它干预_结束日期",
+]
+
+# 阶段归属写回历史数据时用到的列
+STAGE_LINK_COLUMNS = ["日期", "阶段ID", "阶段名称", "阶段主方案"]
+
+# 未填写“儿童”的记录（单个孩子使用时）统一归到这个名字下
+DEFAULT_CHILD = "默认"
+
 # ================== 工具函数 ==================
-def ensure_columns(df: pd.DataFrame) -> pd.DataFrame:
-    for c in ALL_COLUMNS:
-        if c not in df.columns:
-            df[c] = None
-    return df[ALL_COLUMNS]
-
-
-def load_data() -> pd.DataFrame:
-    if not os.path.exists(CSV_FILE):
-        return pd.DataFrame(columns=ALL_COLUMNS)
-    df = pd.read_csv(CSV_FILE)
-
-    date_cols = ["日期",
-        "阿托品_开始日期", "阿托品_结束日期",
-        "防控眼镜_开始日期", "防控眼镜_结束日期",
-        "捕光仪_开始日期", "捕光仪_结束日期",
-        "七叶洋地参_开始日期", "七叶洋地参_结束日期",
-        "翻转拍_开始日期", "翻转拍_结束日期",
-        "其它干预_开始日期", "其它干预_结束日期",
-    ]
-    for col in date_cols:
+def project_columns(columns=None) -> list:
+    """把视图声明的列集合规范为 ALL_COLUMNS 中的顺序；None 表示全部列。"""
+    if columns is None:
+        return list(ALL_COLUMNS)
+    wanted = set(columns)
+    return [c for c in ALL_COLUMNS if c in wanted]
+
+
+def ensure_columns(df: pd.DataFrame, columns=None) -> pd.DataFrame:
+    return df.reindex(columns=project_columns(columns))
+
+
+def _coerce_dates(df: pd.DataFrame) -> pd.DataFrame:
+    for col in DATE_COLUMNS:
         if col in df.columns:
             df[col] = pd.to_datetime(df[col], errors="coerce")
+    return df
+
 
-    return ensure_columns(df)
+def load_data(columns=None, chunksize=None, stages_df=None, child=None):
+    """读取检查记录。
+
+    - columns：列投影，只解析视图需要的列（None=全部列）
+    - chunksize：给定时返回按块产出的迭代器（流式读取超大历史档案，内存恒定）
+    - stages_df：给定时顺带按日期重新匹配阶段归属
+    - child：只要这个孩子的记录（分片存储时只打开他的分片）
+    """
+    cols = project_columns(columns)
+    if stages_df is not None:
+        stages_df = as_timeline(stages_df)
+    if chunksize:
+        return _iter_data_chunks(cols, chunksize, stages_df, child)
+    df = _load_files(data_files(child), cols, child)
+    if stages_df is not None:
+        df = assign_stages(df, stages_df)
+    return df
+
+
+def _load_files(files, cols, child=None) -> pd.DataFrame:
+    read_cols = cols if child is None else project_columns(cols + ["儿童"])
+    wanted = set(with_sources(read_cols))
+    frames = [f for path in files for f in _read_data_file(path, lambda c: c in wanted, child)]
+    if not frames:
+        return pd.DataFrame(columns=cols)
+    df = _finish_frame(frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True), read_cols)
+    return df if child is None else ensure_columns(df[child_keys(df) == child], cols)
+
+
+def _iter_data_chunks(cols, chunksize, stages_df=None, child=None, files=None):
+    read_cols = cols if child is None else project_columns(cols + ["儿童"])
+    wanted = set(with_sources(read_cols))
+    for path in data_files(child) if files is None else files:
+        for chunk in _read_data_file(path, lambda c: c in wanted, child, chunksize):
+            chunk = _finish_frame(chunk, read_cols)
+            if child is not None:
+                chunk = ensure_columns(chunk[child_keys(chunk) == child], cols)
+            if stages_df is not None:
+                chunk = assign_stages(chunk, stages_df)
+            yield chunk
+
+
+def _finish_frame(df: pd.DataFrame, cols) -> pd.DataFrame:
+    """读入后的统一整理：日期转换、补 logMAR、重算派生指标，最后只保留请求的列。"""
+    df = fill_derived(ensure_columns(_coerce_dates(df), with_sources(cols)))
+    return df if list(df.columns) == cols else ensure_columns(df, cols)
 
 
 def save_data(df: pd.DataFrame) -> None:
-    df.to_csv(CSV_FILE, index=False)
+    """整表保存；分片存储时按孩子拆开写各分片，并删掉已没有记录的分片。"""
+    if sharded():
+        write_shards(df, replace_all=True)
+    else:
+        _write_data_file(CSV_FILE, [fill_derived(df)])
+    data_versions().bump("data")
+
+
+def append_records(rows: pd.DataFrame) -> None:
+    """追加新记录并保存（调用方持有 data_lock）；分片存储时只读写这些孩子所在的分片。
+
+    单文件存储直接把新行接在 CSV 末尾（日期已转换、阶段已按日期匹配），不读已有数据；
+    加密存储时同样不重写已有数据：新记录加密成新块追加到所在文件（分片）末尾。
+    """
+    rows = assign_stages(ensure_columns(_coerce_dates(rows)), as_timeline(load_stages()))
+    if encrypted():
+        rows = fill_derived(rows)
+        if not sharded():
+            EncryptedFile(CSV_FILE).append(rows)
+        else:
+            index = read_shard_index()
+            for path_rel, part in rows.groupby(shard_relpaths(rows, index["by_site"]), sort=False):
+                path = os.path.join(SHARD_DIR, path_rel)
+                EncryptedFile(path).append(part)
+                rows_before = index["shards"].get(path_rel, {}).get("rows", 0)
+                index["shards"][path_rel] = _shard_entry(part, path, index["by_site"], rows_before + len(part))
+            _write_shard_index(index)
+        data_versions().bump("data")
+        return
+    if sharded():
+        paths = [os.path.join(SHARD_DIR, rel) for rel in sorted(set(shard_relpaths(rows)))]
+        old = _load_files(paths, ALL_COLUMNS)
+        write_shards(pd.concat([old, rows], ignore_index=True) if not old.empty else rows)
+        data_versions().bump("data")
+        return
+    if _csv_header(CSV_FILE) != list(ALL_COLUMNS):
+        # 文件还不存在，或是旧版的列布局：整表重写一次，之后都能直接追加
+        df = load_data()
+        df = pd.concat([df, rows], ignore_index=True) if not df.empty else rows
+        save_data(ensure_columns(df.sort_values("日期", kind="stable")))
+        return
+    with open(CSV_FILE, "a", encoding="utf-8", newline="") as f:
+        ensure_columns(fill_derived(rows)).to_csv(f, index=False, header=False)
+        f.flush()
+        os.fsync(f.fileno())
+    data_versions().bump("data")
+
+
+def _csv_header(path: str):
+    """CSV 文件的列名；文件不存在或为空时为 None。"""
+    try:
+        return list(pd.read_csv(path, nrows=0).columns)
+    except (OSError, pd.errors.EmptyDataError):
+        return None
+
+
+# ================== 按孩子分片存储 ==================
+def sharded() -> bool:
+    return os.path.exists(SHARD_INDEX)
+
+
+def read_shard_index(path: str = SHARD_INDEX) -> dict:
+    """分片索引 {"by_site": 是否按站点分目录, "shards": {相对路径: {child, site, rows, fp}}}；加密存储时整体加密。"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {"by_site": False, "shards": {}}
+    return unseal_json(index["sealed"], b"shard-index") if "sealed" in index else index
+
+
+def _write_shard_index(index: dict, root: str = SHARD_DIR) -> None:
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, "index.json")
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"sealed": seal_json(index, b"shard-index")} if encrypted() else index, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _slug(text: str) -> str:
+    """文件名用的安全写法：保留文字和数字，其余换成 _，再带一段哈希，避免不同名字落到同一个文件。
+
+    加密存储时只用哈希，文件名里不出现孩子名字。
+    """
+    if encrypted():
+        return hashlib.sha256(b"eye-shard" + text.encode("utf-8")).hexdigest()[:16]
+    clean = "".join(ch if ch.isalnum() else "_" for ch in text)[:40]
+    return f"{clean}-{hashlib.sha1(text.encode('utf-8')).hexdigest()[:8]}"
+
+
+def site_keys(df: pd.DataFrame) -> pd.Series:
+    """每条记录所属的站点；未填写的为 "_"。"""
+    if "站点" not in df.columns:
+        return pd.Series("_", index=df.index)
+    return df["站点"].astype(object).where(df["站点"].notna() & (df["站点"].astype(str).str.strip() != ""),
+                                           "_").astype(str)
+
+
+def shard_relpaths(df: pd.DataFrame, by_site: bool = None) -> pd.Series:
+    """每条记录所在分片（相对 SHARD_DIR）：孩子.csv，按站点分目录时为 站点/孩子.csv。"""
+    if by_site is None:
+        by_site = read_shard_index().get("by_site", False)
+    child = child_keys(df)
+    rel = child.map({c: f"{_slug(c)}.csv" for c in child.unique()})
+    if by_site:
+        site = site_keys(df)
+        rel = site.map({x: _slug(x) for x in site.unique()}) + "/" + rel
+    return rel
+
+
+def data_files(child=None) -> list:
+    """当前的数据文件：单文件存储为 [CSV_FILE]；分片存储为各分片，给定 child 时只取他的。"""
+    if not sharded():
+        return [CSV_FILE]
+    shards = read_shard_index()["shards"]
+    return [os.path.join(SHARD_DIR, rel) for rel, m in sorted(shards.items()) if child is None or m["child"] == child]
+
+
+def shard_children() -> list:
+    return sorted({m["child"] for m in read_shard_index()["shards"].values()})
+
+
+def data_file_fingerprint(child=None) -> str:
+    """数据文件指纹（缓存键）。分片存储时取分片索引（每次写分片都会更新），给定 child 时只取他的分片。"""
+    if not sharded():
+        return file_fingerprint(data_physical_path(CSV_FILE))
+    if child is None:
+        return file_fingerprint(SHARD_INDEX)
+    return "|".join(m["fp"] for _, m in sorted(read_shard_index()["shards"].items()) if m["child"] == child)
+
+
+def write_shards(df: pd.DataFrame, replace_all: bool = False, root: str = SHARD_DIR) -> None:
+    """按分片拆开写出（调用方持有 data_lock）：各分片先写临时文件再替换，最后更新分片索引。
+
+    replace_all：df 是全部数据，写完删掉其中已经没有记录的分片。root：分片目录（重新分片时先写到临时目录）。
+    """
+    index = read_shard_index(os.path.join(root, "index.json"))
+    df = fill_derived(ensure_columns(df))
+    rel = shard_relpaths(df, index["by_site"])
+    written = {}
+    for path_rel, part in df.groupby(rel, sort=False):
+        path = os.path.join(root, path_rel)
+        _write_data_file(path, [part.sort_values("日期", kind="stable")])
+        written[path_rel] = _shard_entry(part, path, index["by_site"])
+    if replace_all:
+        for path_rel in set(index["shards"]) - set(written):
+            _remove_data_file(os.path.join(root, path_rel))
+        index["shards"] = written
+    else:
+        index["shards"].update(written)
+    _write_shard_index(index, root)
+
+
+def _shard_entry(part: pd.DataFrame, path: str, by_site: bool, rows: int = None) -> dict:
+    first = part.index[0]
+    return {"child": child_keys(part)[first], "site": site_keys(part)[first] if by_site else None,
+            "rows": len(part) if rows is None else rows, "fp": file_fingerprint(data_physical_path(path))}
+
+
+def touch_shards(paths) -> None:
+    """分片被原地改写后（如重新匹配阶段）刷新索引里的指纹。"""
+    index = read_shard_index()
+    for path in paths:
+        index["shards"][os.path.relpath(path, SHARD_DIR)]["fp"] = file_fingerprint(data_physical_path(path))
+    _write_shard_index(index)
+
+
+def shard_storage(by_site: bool = False) -> int:
+    """把数据（单文件或已有分片）重新按孩子分片，返回分片数；原来的单文件改名为 .bak 保留。
+
+    新分片先全部写进临时目录，再改名换上、最后删旧分片目录：中途中断时旧数据还在。
+    """
+    with data_lock():
+        df = load_data()
+        tmp_dir, old_dir = f"{SHARD_DIR}.{os.getpid()}.tmp", f"{SHARD_DIR}.{os.getpid()}.old"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        _write_shard_index({"by_site": by_site, "shards": {}}, tmp_dir)
+        write_shards(df, replace_all=True, root=tmp_dir)
+        if os.path.isdir(SHARD_DIR):
+            os.replace(SHARD_DIR, old_dir)
+        os.replace(tmp_dir, SHARD_DIR)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        _remove_data_file(CSV_FILE, backup=f"{CSV_FILE}.bak")
+    data_versions().bump("data")
+    return len(read_shard_index()["shards"])
+
+
+def unshard_storage() -> int:
+    """分片合并回单个数据文件，返回记录数。"""
+    with data_lock():
+        df = load_data()
+        _write_data_file(CSV_FILE, [fill_derived(df.sort_values("日期", kind="stable"))])
+        if sharded():
+            shutil.rmtree(SHARD_DIR)
+    data_versions().bump("data")
+    return len(df)
+
+
+# ================== 加密存储（AES-GCM 分块加密） ==================
+# 每个数据文件（单文件或分片）存成 <文件>.enc：文件头 + 若干块，每块是一段带表头的 CSV，单独用 AES-GCM 加密。
+# 附加数据（AAD）= 文件 ID + 块序号，块被调换、挪到别的文件都解不开；块索引（行数 / 日期范围 / 孩子）
+# 加密后另存在 <文件>.enc.idx，读取时先按索引挑块，只解密用得到的块；追加新记录只加密新块。
+ENC_MAGIC = b"EYEENC01"
+ENC_CHUNK_ROWS = 5_000
+ENC_TAIL_MERGE = 16  # 逐条追加产生的小块攒到这么多，就把文件尾部这些小块合并成一块
+
+
+def encrypted() -> bool:
+    return os.path.exists(ENCRYPTION_FILE)
+
+
+def key_file_path():
+    """密钥文件位置：环境变量 EYE_KEY_FILE，否则 encryption.json 里记下的路径；都没有时为 None。"""
+    path = os.environ.get(ENCRYPTION_KEY_FILE_ENV)
+    if path is None:
+        try:
+            with open(ENCRYPTION_FILE, encoding="utf-8") as f:
+                path = json.load(f).get("key_file")
+        except (OSError, ValueError):
+            return None
+    return path
+
+
+def check_key_file(path: str) -> str:
+    """密钥文件的绝对路径；放在数据目录（当前目录）里时报错——密钥会跟着数据一起被备份、复制。"""
+    real, data_dir = os.path.realpath(path), os.path.realpath(os.getcwd())
+    if os.path.commonpath([real, data_dir]) == data_dir:
+        raise RuntimeError(f"密钥文件不能放在数据目录里：{path}")
+    return real
+
+
+def data_key(key_file: str = None) -> bytes:
+    """数据密钥（32 字节）：给定 key_file 时读它，否则优先取环境变量（base64），再读密钥文件。"""
+    raw = None if key_file else os.environ.get(ENCRYPTION_KEY_ENV)
+    if raw is None:
+        key_file = key_file or key_file_path()
+        if key_file is None:
+            raise RuntimeError(f"加密存储需要密钥：设置环境变量 {ENCRYPTION_KEY_ENV}，或用 encrypt --key-file 指定数据目录之外的密钥文件")
+        try:
+            with open(check_key_file(key_file), encoding="ascii") as f:
+                raw = f.read().strip()
+        except OSError:
+            raise RuntimeError(f"读不到密钥文件 {key_file}") from None
+    key = base64.urlsafe_b64decode(raw)
+    if len(key) != 32:
+        raise RuntimeError("数据密钥应为 32 字节（base64 编码）")
+    return key
+
+
+def _key_id(key: bytes) -> str:
+    return hashlib.sha256(b"eye-key-id" + key).hexdigest()[:16]
+
+
+def _aead():
+    """当前存储的 AES-GCM 对象；密钥与 encryption.json 记下的密钥指纹不符时报错（不会用错密钥写出解不开的块）。"""
+    if AESGCM is None:
+        raise RuntimeError("加密存储需要安装 cryptography")
+    key = data_key()
+    with open(ENCRYPTION_FILE, encoding="utf-8") as f:
+        if json.load(f).get("key_id") != _key_id(key):
+            raise RuntimeError("数据密钥与加密存储不匹配")
+    return AESGCM(key)
+
+
+def seal(plain: bytes, aad: bytes, aead=None) -> bytes:
+    nonce = os.urandom(12)
+    return nonce + (aead or _aead()).encrypt(nonce, plain, aad)
+
+
+def unseal(blob: bytes, aad: bytes, aead=None) -> bytes:
+    return (aead or _aead()).decrypt(blob[:12], blob[12:], aad)
+
+
+class EncryptedFile:
+    """一个分块加密的数据文件：path 是逻辑文件名，实际数据在 path.enc，块索引在 path.enc.idx。"""
+
+    def __init__(self, path: str, aead=None):
+        self.path = f"{path}.enc"
+        self.idx_path = f"{path}.enc.idx"
+        self.aead = aead or _aead()
+        self._index = None
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    @property
+    def index(self) -> dict:
+        if self._index is None:
+            self._index = self._load_index()
+        return self._index
+
+    def _file_id(self) -> bytes:
+        with open(self.path, "rb") as f:
+            head = f.read(len(ENC_MAGIC) + 16)
+        if head[:len(ENC_MAGIC)] != ENC_MAGIC:
+            raise RuntimeError(f"{self.path} 不是加密数据文件")
+        return head[len(ENC_MAGIC):]
+
+    def _load_index(self) -> dict:
+        """读块索引；索引缺失或落后于数据文件（追加后、写索引前中断）时扫描数据文件重建。"""
+        fid = self._file_id()
+        idx = None
+        try:
+            with open(self.idx_path, "rb") as f:
+                idx = json.loads(unseal(f.read(), fid + b"index", self.aead))
+        except (OSError, ValueError, InvalidTag):
+            pass
+        if idx is not None and idx["size"] == os.path.getsize(self.path):
+            return idx
+        rebuilt = self._scan(fid)
+        if idx is not None and sum(m["rows"] for m in rebuilt["chunks"]) < sum(m["rows"] for m in idx["chunks"]):
+            raise RuntimeError(f"{self.path} 比块索引记录的少，可能被截断")
+        return rebuilt
+
+    def _scan(self, fid: bytes) -> dict:
+        chunks, pos = [], len(ENC_MAGIC) + 16
+        with open(self.path, "rb") as f:
+            f.seek(pos)
+            while True:
+                head = f.read(4)
+                if len(head) < 4:
+                    break
+                n = struct.unpack(">I", head)[0]
+                blob = f.read(n)
+                if len(blob) < n:  # 写了一半的块：忽略，下次追加时从这里覆盖
+                    break
+                frame = pd.read_csv(io.BytesIO(self._open(blob, fid, len(chunks))))
+                chunks.append(dict(self._meta(frame), offset=pos, length=4 + n))
+                pos += 4 + n
+        return {"file_id": fid.hex(), "size": pos, "chunks": chunks}
+
+    def _open(self, blob: bytes, fid: bytes, seq: int) -> bytes:
+        try:
+            return unseal(blob, fid + struct.pack(">Q", seq), self.aead)
+        except InvalidTag:
+            raise RuntimeError(f"{self.path} 第 {seq + 1} 块校验失败（损坏或被改动）") from None
+
+    def _encode(self, frame: pd.DataFrame, fid: bytes, seq: int) -> bytes:
+        blob = seal(frame.to_csv(index=False).encode("utf-8"), fid + struct.pack(">Q", seq), self.aead)
+        return struct.pack(">I", len(blob)) + blob
+
+    @staticmethod
+    def _meta(frame: pd.DataFrame) -> dict:
+        dates = pd.to_datetime(frame["日期"], errors="coerce") if "日期" in frame.columns else pd.Series(dtype="datetime64[ns]")
+        return {
+            "rows": len(frame),
+            "first": None if dates.isna().all() else str(dates.min().date()),
+            "last": None if dates.isna().all() else str(dates.max().date()),
+            "children": sorted(child_keys(frame).unique()) if len(frame) else [],
+        }
+
+    def _write_chunks(self, f, frames, fid: bytes, chunks: list, pos: int) -> int:
+        for frame in frames:
+            for start in range(0, len(frame), ENC_CHUNK_ROWS):
+                part = frame.iloc[start:start + ENC_CHUNK_ROWS]
+                rec = self._encode(part, fid, len(chunks))
+                f.write(rec)
+                chunks.append(dict(self._meta(part), offset=pos, length=len(rec)))
+                pos += len(rec)
+        return pos
+
+    def _write_index(self, idx: dict) -> None:
+        tmp = f"{self.idx_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(seal(json.dumps(idx, ensure_ascii=False).encode("utf-8"),
+                         bytes.fromhex(idx["file_id"]) + b"index", self.aead))
+        os.replace(tmp, self.idx_path)
+        self._index = idx
+
+    def frames(self, usecols=None, child=None):
+        """逐块解密解析；给定 child 时跳过索引表明不含他的块（这些块不解密）。"""
+        if not self.exists():
+            return
+        idx = self.index
+        fid = bytes.fromhex(idx["file_id"])
+        with open(self.path, "rb") as f:
+            for seq, m in enumerate(idx["chunks"]):
+                if child is not None and child not in m["children"]:
+                    continue
+                f.seek(m["offset"] + 4)
+                yield pd.read_csv(io.BytesIO(self._open(f.read(m["length"] - 4), fid, seq)), usecols=usecols)
+
+    def rewrite(self, frames) -> None:
+        """整文件重写（换新的文件 ID）：先写临时文件再替换。"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fid, chunks = os.urandom(16), []
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(ENC_MAGIC + fid)
+            pos = self._write_chunks(f, frames, fid, chunks, len(ENC_MAGIC) + 16)
+        os.replace(tmp, self.path)
+        self._write_index({"file_id": fid.hex(), "size": pos, "chunks": chunks})
+
+    def append(self, frame: pd.DataFrame) -> None:
+        """追加：只把新记录加密成新块写到文件末尾，已有的块原样不动。
+
+        末尾的小块攒够 ENC_TAIL_MERGE 个时，把它们和新记录合并成整块：前面的块按密文原样拷贝到临时文件，
+        只重新加密尾部，再整体替换（中途中断不会留下半截文件）。
+        """
+        if not self.exists():
+            return self.rewrite([frame])
+        idx = self.index
+        fid, chunks = bytes.fromhex(idx["file_id"]), list(idx["chunks"])
+        k = len(chunks)
+        while k > 0 and chunks[k - 1]["rows"] < ENC_CHUNK_ROWS:
+            k -= 1
+        if len(chunks) - k < ENC_TAIL_MERGE:
+            with open(self.path, "r+b") as f:
+                f.seek(idx["size"])
+                pos = self._write_chunks(f, [frame], fid, chunks, idx["size"])
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            tail = []
+            with open(self.path, "rb") as f:
+                for seq in range(k, len(chunks)):
+                    f.seek(chunks[seq]["offset"] + 4)
+                    tail.append(pd.read_csv(io.BytesIO(self._open(f.read(chunks[seq]["length"] - 4), fid, seq))))
+            merged = pd.concat(tail + [frame], ignore_index=True)
+            start = chunks[k]["offset"]
+            chunks = chunks[:k]
+            tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(self.path, "rb") as src, open(tmp, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+                dst.seek(start)
+                pos = self._write_chunks(dst, [merged], fid, chunks, start)
+                dst.truncate()
+            os.replace(tmp, self.path)
+        self._write_index({"file_id": idx["file_id"], "size": pos, "chunks": chunks})
+
+
+def data_physical_path(path: str) -> str:
+    """数据文件实际落盘的位置（加密存储时是 .enc），用于指纹与大小判断。"""
+    return f"{path}.enc" if encrypted() else path
+
+
+def _read_data_file(path: str, usecols=None, child=None, chunksize=None):
+    """按块产出一个数据文件的内容；加密存储时只解密用得到的块（块本身已有上限，不再二次分块）。"""
+    if encrypted():
+        yield from EncryptedFile(path).frames(usecols, child)
+    elif not os.path.exists(path):
+        return
+    elif chunksize:
+        with pd.read_csv(path, usecols=usecols, chunksize=chunksize) as reader:
+            yield from reader
+    else:
+        yield pd.read_csv(path, usecols=usecols)
+
+
+def _write_data_file(path: str, frames) -> None:
+    """整文件重写一个数据文件（先写临时文件再替换）；frames 为按块产出的 DataFrame。"""
+    if encrypted():
+        EncryptedFile(path).rewrite(frames)
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    first = True
+    for frame in frames:
+        frame.to_csv(tmp, index=False, mode="w" if first else "a", header=first)
+        first = False
+    if first:
+        pd.DataFrame(columns=ALL_COLUMNS).to_csv(tmp, index=False)
+    os.replace(tmp, path)
+
+
+def _remove_data_file(path: str, backup: str = None) -> None:
+    """删掉（或改名为 backup 保留）一个数据文件，明文和加密形式都处理。"""
+    for suffix in ("", ".enc", ".enc.idx"):
+        if os.path.exists(path + suffix):
+            if backup:
+                os.replace(path + suffix, backup + suffix)
+            else:
+                os.remove(path + suffix)
+
+
+def seal_json(obj, aad: bytes) -> str:
+    """把小块 JSON（分片索引、审计日志里的记录内容）加密成 base64 文本。"""
+    return base64.b64encode(seal(json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8"), aad)).decode("ascii")
 
 
-def load_stages() -> pd.DataFrame:
-    if not os.path.exists(STAGE_FILE):
+def unseal_json(text: str, aad: bytes):
+    return json.loads(unseal(base64.b64decode(text), aad))
+
+
+def _switch_encryption(enable: bool, key_file: str = None) -> int:
+    """在明文与加密存储之间转换（调用方持有 data_lock），返回记录数。
+
+    先在旧模式下读出全部数据，切换模式后按原布局（单文件 / 分片）重写，最后删掉旧形式的文件和空下来的站点目录。
+    分片存储加密后，分片文件名只用哈希（不带孩子名字），分片索引也加密。
+    """
+    df = load_data()
+    shard_meta = read_shard_index() if sharded() else None
+    old_files = [data_physical_path(p) for p in data_files()]
+    if enable:
+        meta = {"scheme": "AES-256-GCM", "chunk_rows": ENC_CHUNK_ROWS}
+        if key_file:
+            meta["key_file"] = check_key_file(key_file)
+            if not os.path.exists(key_file):
+                fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, "w", encoding="ascii") as f:
+                    f.write(base64.urlsafe_b64encode(AESGCM.generate_key(bit_length=256)).decode("ascii"))
+        meta["key_id"] = _key_id(data_key(key_file))
+        tmp = f"{ENCRYPTION_FILE}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, ENCRYPTION_FILE)
+    else:
+        os.remove(ENCRYPTION_FILE)
+    if shard_meta is not None:
+        os.remove(SHARD_INDEX)
+        _write_shard_index({"by_site": shard_meta["by_site"], "shards": {}})
+        write_shards(df, replace_all=True)
+    else:
+        _write_data_file(CSV_FILE, [fill_derived(df)])
+    for path in old_files:
+        for p in (path, f"{path}.idx") if path.endswith(".enc") else (path,):
+            if os.path.exists(p):
+                os.remove(p)
+    if shard_meta is not None:
+        for root, dirs, files in os.walk(SHARD_DIR, topdown=False):
+            if root != SHARD_DIR and not dirs and not files:
+                os.rmdir(root)  # 明文分片按站点名建的目录
+    data_versions().bump("data")
+    return len(df)
+
+
+def enable_encryption(key_file: str = None) -> int:
+    """转为加密存储。key_file：数据目录之外的密钥文件，不存在时生成（权限 600，请另行妥善备份）；
+    不给时需要环境变量 EYE_DATA_KEY（或 EYE_KEY_FILE）。
+    """
+    if AESGCM is None:
+        raise RuntimeError("加密存储需要安装 cryptography")
+    if key_file is None and ENCRYPTION_KEY_ENV not in os.environ:
+        key_file = os.environ.get(ENCRYPTION_KEY_FILE_ENV)
+        if key_file is None:
+            raise RuntimeError(f"加密存储需要密钥：设置环境变量 {ENCRYPTION_KEY_ENV}，或用 encrypt --key-file 指定数据目录之外的密钥文件")
+    if key_file:
+        check_key_file(key_file)
+    with data_lock():
+        return len(load_data(["日期"])) if encrypted() else _switch_encryption(True, key_file)
+
+
+def disable_encryption() -> int:
+    with data_lock():
+        return _switch_encryption(False) if encrypted() else len(load_data(["日期"]))
+
+
+def run_storage_benchmark(rows: int = 20000, children: int = 50, appends: int = 20) -> pd.DataFrame:
+    """在临时目录里分别用明文和加密存储跑同一组读写，比较吞吐（不动真实数据）。"""
+    if AESGCM is None:
+        raise RuntimeError("加密存储需要安装 cryptography")
+    names = [f"孩子{i + 1}" for i in range(children)]
+    data = synthetic_records(rows, names)
+    extra = [synthetic_records(1, [names[i % children]], seed=i + 1) for i in range(appends)]
+    base = tempfile.mkdtemp(prefix="eye-bench-")
+    cwd, env_key = os.getcwd(), os.environ.get(ENCRYPTION_KEY_ENV)
+    results = []
+    try:
+        for mode in ("明文", "加密"):
+            work = os.path.join(base, mode)
+            os.makedirs(work)
+            os.chdir(work)
+            if mode == "加密":
+                key = AESGCM.generate_key(bit_length=256)
+                os.environ[ENCRYPTION_KEY_ENV] = base64.urlsafe_b64encode(key).decode("ascii")
+                with open(ENCRYPTION_FILE, "w", encoding="utf-8") as f:
+                    json.dump({"scheme": "AES-256-GCM", "chunk_rows": ENC_CHUNK_ROWS, "key_id": _key_id(key)}, f)
+
+            def timed(op, n, fn, mb=None):
+                t0 = time.perf_counter()
+                fn()
+                results.append({"存储": mode, "操作": op, "行数": n, "秒": time.perf_counter() - t0, "MB": mb})
+
+            timed("整表写入", rows, lambda: save_data(data))
+            mb = results[-1]["MB"] = os.path.getsize(data_physical_path(CSV_FILE)) / 1e6
+            timed("整表读取", rows, lambda: load_data(), mb)
+            timed("列投影读取（趋势列）", rows, lambda: load_data(TREND_COLS), mb)
+            timed("单个孩子", rows // children, lambda: load_data(child=names[0]))
+            timed(f"逐条追加 ×{appends}", appends, lambda: [append_records(r) for r in extra])
+    finally:
+        os.chdir(cwd)
+        if env_key is None:
+            os.environ.pop(ENCRYPTION_KEY_ENV, None)
+        else:
+            os.environ[ENCRYPTION_KEY_ENV] = env_key
+        shutil.rmtree(base, ignore_errors=True)
+    out = pd.DataFrame(results)
+    out["行/秒"] = (out["行数"] / out["秒"]).round(0)
+    out["MB/秒"] = (out["MB"].astype(float) / out["秒"]).round(1)
+    plain = out[out["存储"] == "明文"].set_index("操作")["秒"]
+    out["相对明文"] = (out["秒"] / out["操作"].map(plain)).round(2)
+    return out[["存储", "操作", "行数", "秒", "行/秒", "MB/秒", "相对明文"]].round({"秒": 3})
+
+
+def load_stages(path: str = STAGE_FILE) -> pd.DataFrame:
+    if not os.path.exists(path):
         return pd.DataFrame(columns=STAGE_COLUMNS)
-    s = pd.read_csv(STAGE_FILE)
+    return normalize_stages(pd.read_csv(path))
+
+
+def normalize_stages(s: pd.DataFrame) -> pd.DataFrame:
     s["开始日期"] = pd.to_datetime(s.get("开始日期"), errors="coerce")
     s["结束日期"] = pd.to_datetime(s.get("结束日期"), errors="coerce")
     if "是否启用" in s.columns:
@@ -246,6 +992,16 @@ def load_stages() -> pd.DataFrame:
 
 def save_stages(s: pd.DataFrame) -> None:
     s.to_csv(STAGE_FILE, index=False)
+    data_versions().bump("stages")
+    audit_append_or_warn("stages", {"rows": audit_records(s)})
+
+
+def child_keys(df: pd.DataFrame) -> pd.Series:
+    """每条记录所属的儿童；未填写的归为 DEFAULT_CHILD。"""
+    if "儿童" not in df.columns:
+        return pd.Series(DEFAULT_CHILD, index=df.index)
+    return df["儿童"].astype(object).where(df["儿童"].notna() & (df["儿童"].astype(str).str.strip() != ""),
+                                           DEFAULT_CHILD).astype(str)
 
 
 def is_yes(v) -> bool:
@@ -299,19 +1055,282 @@ def parse_optional_int(s: str, min_v=None, max_v=None):
     return v, None
 
 
-def match_stage_for_date(stages_df: pd.DataFrame, d: pd.Timestamp):
-    if stages_df is None or stages_df.empty or pd.isna(d):
-        return (None, None, None)
-    s = stages_df[stages_df["是否启用"] == True].copy()
-    s = s.dropna(subset=["开始日期"])
-    if s.empty:
-        return (None, None, None)
-    end = s["结束日期"].fillna(pd.Timestamp.max)
-    hit = s[(s["开始日期"] <= d) & (d <= end)]
-    if hit.empty:
-        return (None, None, None)
-    hit = hit.sort_values("开始日期", ascending=False).iloc[0]
-    return (hit.get("阶段ID"), hit.get("阶段名称"), hit.get("主方案"))
+# ================== 视力记录法换算（小数 / 5分 / logMAR） ==================
+ACUITY_SCALES = ["自动识别", "小数", "5分", "logMAR"]
+# 标准对数视力表的行：logMAR、5分记录（= 5 - logMAR）与习惯写法的小数视力一一对应
+ACUITY_CHART_LOGMAR = np.round(np.arange(1.0, -0.35, -0.1), 1)
+ACUITY_CHART_DECIMAL = np.array([0.1, 0.12, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0, 1.2, 1.5, 2.0])
+ACUITY_PAIRS = [("左眼视力", "左眼_logMAR"), ("右眼视力", "右眼_logMAR")]
+
+
+def detect_acuity_scale(values):
+    """整列（整个文件）一起判断视力记录法；判断不了时返回 None，由用户明确选择。
+
+    - 都 ≥3：5 分记录；有的 ≥3、有的 <3：混用，判断不了
+    - 有负数，或有 0（小数视力没有 0）：logMAR
+    - 有大于 1.0 的值，或有只在小数视力表上的值（0.12 / 0.15 / 0.25）：小数
+    - 其余（都在 0～1.0 之间）两种记法都说得通：判断不了
+    """
+    v = to_numeric(pd.Series(values)).dropna().to_numpy(dtype=float)
+    if not len(v):
+        return "小数"  # 没有视力值，记法无所谓
+    if (v >= 3).any():
+        return "5分" if (v >= 3).all() else None
+    if (v < 0).any() or np.isclose(v, 0).any():
+        return "logMAR"
+    if (v > 1.0).any() or np.isclose(v[:, None], [0.12, 0.15, 0.25]).any():
+        return "小数"
+    return None
+
+
+def to_logmar(values, scale: str = "小数") -> np.ndarray:
+    """把一列视力值整体换算为 logMAR。
+
+    小数视力先按视力表行对齐（0.12 → 0.9 而不是 0.92），不在表上的按 -log10 计算（≤0 的小数视力无效，为空）；
+    “自动识别”先用 detect_acuity_scale 整列判断记法，判断不了时报 ValueError。
+    """
+    v = to_numeric(pd.Series(values)).to_numpy(dtype=float)
+    if scale == "自动识别":
+        scale = detect_acuity_scale(v)
+        if scale is None:
+            raise ValueError("无法自动判断视力记录法（数值都在 0～1.0 之间，小数视力和 logMAR 都有可能），请明确选择")
+    i = np.clip(np.searchsorted(ACUITY_CHART_DECIMAL, v), 0, len(ACUITY_CHART_DECIMAL) - 1)
+    on_chart = np.isclose(ACUITY_CHART_DECIMAL[i], v)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        from_decimal = np.where(on_chart, ACUITY_CHART_LOGMAR[i], -np.log10(np.where(v > 0, v, np.nan)))
+    if scale == "小数":
+        out = from_decimal
+    elif scale == "5分":
+        out = 5.0 - v
+    else:
+        out = v
+    return np.round(out, 2)
+
+
+def logmar_to_decimal(lm) -> np.ndarray:
+    """logMAR 换回小数视力；落在视力表行上的取表上的习惯写法，其余保留两位小数。"""
+    lm = to_numeric(pd.Series(lm)).to_numpy(dtype=float)
+    i = np.nan_to_num(np.clip(np.round((1.0 - lm) * 10), 0, len(ACUITY_CHART_DECIMAL) - 1)).astype(int)
+    on_chart = np.isclose(ACUITY_CHART_LOGMAR[i], lm, atol=0.005)
+    return np.where(on_chart, ACUITY_CHART_DECIMAL[i], np.round(10.0 ** -lm, 2))
+
+
+def fill_logmar(df: pd.DataFrame) -> pd.DataFrame:
+    """补齐 logMAR 列：只换算缺失且有小数视力的行（旧档案读入时一次性向量化补算）。"""
+    for dec_col, lm_col in ACUITY_PAIRS:
+        if dec_col in df.columns and lm_col in df.columns:
+            missing = df[lm_col].isna() & df[dec_col].notna()
+            if missing.any():
+                df.loc[missing, lm_col] = to_logmar(df.loc[missing, dec_col], "小数")
+    return df
+
+
+def normalize_acuity(df: pd.DataFrame, scale: str) -> pd.DataFrame:
+    """导入时统一记法：视力列按 scale 换算为 logMAR；5 分 / logMAR 记录再回写为小数视力。
+
+    “自动识别”对整个文件（左右眼两列一起）只判断一次记法，判断不了时报 ValueError，不逐值猜。
+    本来就是小数视力的值原样保留（0.7、0.9 这类不在视力表行上的值，往返换算会变成 0.71、0.89），
+    ≤0 的小数视力无效，置空。
+    """
+    cols = [(d, lm) for d, lm in ACUITY_PAIRS if d in df.columns]
+    if scale == "自动识别":
+        scale = detect_acuity_scale(pd.concat([df[d] for d, _ in cols]) if cols else [])
+        if scale is None:
+            raise ValueError("无法自动判断视力记录法（数值都在 0～1.0 之间，小数视力和 logMAR 都有可能），请明确选择")
+    for dec_col, lm_col in cols:
+        v = to_numeric(df[dec_col]).to_numpy(dtype=float)
+        lm = to_logmar(v, scale)
+        df[lm_col] = lm
+        df[dec_col] = np.where(v > 0, v, np.nan) if scale == "小数" else logmar_to_decimal(lm)
+    return df
+
+
+# ================== 生物测量派生指标（AL/CR、屈光力矢量） ==================
+# 屈光与角膜散光都分解为 Thibos 矢量：M = S + C/2，J0 = -C/2·cos2A，J45 = -C/2·sin2A。
+# 该分解与正/负柱镜记法无关；角膜散光取 C = K1 - K2、A = K1 轴位，即矫正等效（顺规散光 J0 为正），
+# 可与验光 J0 直接比较。没有 K 轴位时退回到记录的角膜 CYL / 轴位。
+KERATOMETRY_INDEX = 337.5  # 角膜屈光力(D) = 337.5 / 曲率半径(mm)
+DERIVED_SOURCES = {}
+for _eye, _al in (("右眼", "眼轴长度(R)"), ("左眼", "眼轴长度(L)")):
+    _k = [f"{_eye}_{k}" for k in ("K1(mm)", "K2(mm)", "K1(D)", "K2(D)")]
+    DERIVED_SOURCES[f"{_eye}_CR(mm)"] = _k
+    DERIVED_SOURCES[f"{_eye}_AL/CR"] = _k + [_al]
+    for _c in ("M", "J0", "J45"):
+        DERIVED_SOURCES[f"{_eye}_{_c}"] = [f"{_eye}_{x}" for x in ("S", "C", "A", "SE")]
+    for _c in ("角膜J0", "角膜J45"):
+        DERIVED_SOURCES[f"{_eye}_{_c}"] = _k + [f"{_eye}_K1轴位", f"{_eye}角膜CYL(D)", f"{_eye}角膜CYL轴位"]
+assert set(DERIVED_SOURCES) == set(DERIVED_COLUMNS)
+
+
+def with_sources(columns) -> list:
+    """列投影补上派生列的来源列（读入时才能重算）。"""
+    cols = list(columns)
+    return project_columns(cols + [s for c in cols for s in DERIVED_SOURCES.get(c, [])])
+
+
+def power_vector(cyl, axis) -> tuple:
+    """柱镜 + 轴位 -> (J0, J45)；柱镜为 0 时两者为 0（不要求轴位）。"""
+    c, a = to_numeric(cyl).to_numpy(dtype=float), np.deg2rad(to_numeric(axis).to_numpy(dtype=float))
+    j0 = np.where(c == 0, 0.0, -c / 2 * np.cos(2 * a))
+    j45 = np.where(c == 0, 0.0, -c / 2 * np.sin(2 * a))
+    return np.round(j0, 2) + 0.0, np.round(j45, 2) + 0.0  # + 0.0 去掉 -0.0
+
+
+def fill_biometry(df: pd.DataFrame) -> pd.DataFrame:
+    """整列重算派生指标（float64）；只处理来源列都在投影里的那些派生列，其余保持读入的值。"""
+    if df.empty:
+        return df
+    present = set(df.columns)
+    num = lambda c: to_numeric(df[c]).astype(float)
+    for eye, al in (("右眼", "眼轴长度(R)"), ("左眼", "眼轴长度(L)")):
+        ready = lambda c: c in present and set(DERIVED_SOURCES[c]) <= present
+        if ready(f"{eye}_CR(mm)") or ready(f"{eye}_AL/CR"):
+            r = pd.concat([num(f"{eye}_K1(mm)"), num(f"{eye}_K2(mm)")], axis=1).mean(axis=1)
+            k = pd.concat([num(f"{eye}_K1(D)"), num(f"{eye}_K2(D)")], axis=1).mean(axis=1)
+            cr = r.fillna(KERATOMETRY_INDEX / k.where(k > 0))
+            if f"{eye}_CR(mm)" in present:
+                df[f"{eye}_CR(mm)"] = cr.round(3)
+            if ready(f"{eye}_AL/CR"):
+                df[f"{eye}_AL/CR"] = (num(al) / cr.where(cr > 0)).round(3)
+        if ready(f"{eye}_M"):
+            s_, c_ = num(f"{eye}_S"), num(f"{eye}_C")
+            df[f"{eye}_M"] = (s_ + c_.fillna(0) / 2).fillna(num(f"{eye}_SE")).round(2)
+        if ready(f"{eye}_J0") or ready(f"{eye}_J45"):
+            df[f"{eye}_J0"], df[f"{eye}_J45"] = power_vector(num(f"{eye}_C"), num(f"{eye}_A"))
+        if ready(f"{eye}_角膜J0") or ready(f"{eye}_角膜J45"):
+            k1 = num(f"{eye}_K1(D)").fillna(KERATOMETRY_INDEX / num(f"{eye}_K1(mm)").where(lambda v: v > 0))
+            k2 = num(f"{eye}_K2(D)").fillna(KERATOMETRY_INDEX / num(f"{eye}_K2(mm)").where(lambda v: v > 0))
+            axis = num(f"{eye}_K1轴位")
+            has_k = (k1 - k2).notna() & axis.notna()
+            cyl = (k1 - k2).where(has_k, num(f"{eye}角膜CYL(D)"))
+            j0, j45 = power_vector(cyl, axis.where(has_k, num(f"{eye}角膜CYL轴位")))
+            df[f"{eye}_角膜J0"], df[f"{eye}_角膜J45"] = j0, j45
+    return df
+
+
+def fill_derived(df: pd.DataFrame) -> pd.DataFrame:
+    return fill_biometry(fill_logmar(df))
+
+
+# ================== 阶段时间轴 ==================
+_NS_OPEN = np.iinfo(np.int64).max  # 无结束日期 = 至今
+
+
+def _to_ns(values) -> np.ndarray:
+    """日期 -> int64 纳秒；NaT 为 int64 最小值。"""
+    return pd.to_datetime(pd.Series(values), errors="coerce").to_numpy("datetime64[ns]").astype(np.int64)
+
+
+def _ns_to_ts(v):
+    return None if v == _NS_OPEN else pd.Timestamp(int(v))
+
+
+def compile_segments(starts: np.ndarray, stops: np.ndarray, priority: np.ndarray, open_end=_NS_OPEN):
+    """把可能重叠的区间 [start, stop) 编译成互不重叠、按时间排序的段；重叠处 priority 大者胜（相同取行号大者）。
+
+    返回 (段开始, 段结束, 段对应的区间行号)，相邻且同一行号的段会合并。
+    """
+    seg_start, seg_stop, seg_idx = [], [], []
+    points = np.unique(np.concatenate([starts, stops[stops != open_end]]))
+    for k, p in enumerate(points):
+        active = np.flatnonzero((starts <= p) & (stops > p))
+        if active.size == 0:
+            continue
+        win = active[np.lexsort((active, priority[active]))[-1]]
+        nxt = points[k + 1] if k + 1 < len(points) else open_end
+        if seg_idx and seg_idx[-1] == win and seg_stop[-1] == p:
+            seg_stop[-1] = nxt
+        else:
+            seg_start.append(p)
+            seg_stop.append(nxt)
+            seg_idx.append(win)
+    return (np.array(seg_start, dtype=np.int64), np.array(seg_stop, dtype=np.int64),
+            np.array(seg_idx, dtype=np.int64))
+
+
+class StageTimeline:
+    """启用阶段编译成互不重叠的时间段（重叠处开始日期较晚者优先，同日开始取后建的），按日期二分查找。
+
+    建表时顺带记录阶段之间的重叠（overlaps）与空档（gaps），供阶段表单提示。
+    """
+
+    def __init__(self, stages_df: pd.DataFrame):
+        s = pd.DataFrame(columns=STAGE_COLUMNS) if stages_df is None else stages_df
+        s = s[s["是否启用"] == True].dropna(subset=["开始日期"]).reset_index(drop=True)
+        self.stages = s
+        starts = _to_ns(s["开始日期"])
+        ends = _to_ns(s["结束日期"])
+        # 结束日期当天也算在内：区间统一为 [开始, 结束 + 1ns)
+        stops = np.where(ends == np.iinfo(np.int64).min, _NS_OPEN, ends + 1)
+
+        self.seg_start, self.seg_stop, self.seg_idx = compile_segments(starts, stops, starts)
+
+        self.overlaps = []
+        for i in range(len(s)):
+            for j in range(i + 1, len(s)):
+                lo, hi = max(starts[i], starts[j]), min(stops[i], stops[j])
+                if lo < hi:
+                    self.overlaps.append({
+                        "阶段A": s.at[i, "阶段ID"], "阶段B": s.at[j, "阶段ID"],
+                        "重叠开始": pd.Timestamp(int(lo)), "重叠结束": _ns_to_ts(hi - 1 if hi != _NS_OPEN else hi),
+                    })
+        # 阶段按天记录：上一段结束日的次日即接上下一段，不算空档
+        day = pd.Timedelta(days=1).value
+        self.gaps = [
+            {"空档开始": pd.Timestamp(int(self.seg_stop[k] - 1 + day)), "空档结束": pd.Timestamp(int(self.seg_start[k + 1] - day))}
+            for k in range(len(self.seg_idx) - 1)
+            if self.seg_start[k + 1] - (self.seg_stop[k] - 1) > day
+        ]
+
+    def positions(self, dates) -> np.ndarray:
+        """批量查找：返回每个日期命中的阶段行号（未命中为 -1）。"""
+        d = _to_ns(dates)
+        if len(self.seg_idx) == 0:
+            return np.full(len(d), -1, dtype=np.int64)
+        i = np.searchsorted(self.seg_start, d, side="right") - 1
+        ok = (i >= 0) & (d != np.iinfo(np.int64).min)
+        ok[ok] &= d[ok] < self.seg_stop[i[ok]]
+        return np.where(ok, self.seg_idx[np.clip(i, 0, None)], -1)
+
+    def lookup(self, d):
+        if pd.isna(d):
+            return (None, None, None)
+        pos = self.positions([d])[0]
+        if pos < 0:
+            return (None, None, None)
+        hit = self.stages.iloc[pos]
+        return (hit.get("阶段ID"), hit.get("阶段名称"), hit.get("主方案"))
+
+    def links(self, dates: pd.Series) -> pd.DataFrame:
+        pos = self.positions(dates)
+        cols = ["阶段ID", "阶段名称", "主方案"]
+        hit = self.stages[cols].reindex(pos).reset_index(drop=True) if len(self.stages) else pd.DataFrame(
+            index=range(len(pos)), columns=cols)
+        hit.index = dates.index
+        return hit.rename(columns={"主方案": "阶段主方案"})
+
+
+def as_timeline(stages) -> StageTimeline:
+    return stages if isinstance(stages, StageTimeline) else StageTimeline(stages)
+
+
+def match_stage_for_date(stages_df, d: pd.Timestamp):
+    return as_timeline(stages_df).lookup(d)
+
+
+def timeline_notes(timeline: StageTimeline, stage_id=None) -> list:
+    """阶段重叠/空档的提示文字；给定 stage_id 时只报告与该阶段有关的重叠。"""
+    def day(ts):
+        return "至今" if ts is None else ts.strftime("%Y-%m-%d")
+
+    notes = []
+    for o in timeline.overlaps:
+        if stage_id is None or stage_id in (o["阶段A"], o["阶段B"]):
+            notes.append(f"阶段 {o['阶段A']} 与 {o['阶段B']} 重叠（{day(o['重叠开始'])} ~ {day(o['重叠结束'])}），"
+                         f"重叠期间的记录归属开始日期较晚的阶段")
+    for g in timeline.gaps:
+        notes.append(f"{day(g['空档开始'])} ~ {day(g['空档结束'])} 没有启用的阶段，期间记录为“未匹配阶段”")
+    return notes
 
 
 def short_tag(row: pd.Series) -> str:
@@ -334,42 +1353,1602 @@ INTERVENTIONS = [
     ("其它", "其它干预_是否有", ["其它干预_每周次数", "其它干预_每次分钟"], ["其它干预_依从性(%)"]),
 ]
 
+# ================== 视图列需求（列投影） ==================
+# 每个视图声明自己用到的列，load_data 只解析这些列；新增视图时在这里登记即可。
+TAG_COLUMNS = [flag for _, flag, _, _ in INTERVENTIONS]
 
-def build_stage_intervention_summary(df_show: pd.DataFrame) -> pd.DataFrame:
+HEADER_COLS = ["日期", "儿童", "阶段名称", "左眼视力", "右眼视力", "左眼远视储备", "右眼远视储备"] + TAG_COLUMNS
+
+TREND_COLS = [
+    "日期", "阶段ID", "阶段名称", "阶段主方案",
+    "左眼视力", "右眼视力", "左眼_logMAR", "右眼_logMAR", "左眼远视储备", "右眼远视储备",
+    "眼轴长度(L)", "眼轴长度(R)", "左眼_SE", "右眼_SE",
+    "左眼_AL/CR", "右眼_AL/CR", "左眼_J0", "右眼_J0", "左眼_J45", "右眼_J45",
+    "左眼_角膜J0", "右眼_角膜J0", "左眼_角膜J45", "右眼_角膜J45",
+]
+
+SUMMARY_COLS = ["日期", "阶段名称", "左眼视力", "右眼视力", "左眼_logMAR", "右眼_logMAR", "左眼_SE", "右眼_SE", "眼轴长度(L)", "眼轴长度(R)"] + [
+    c for _, flag, freq_cols, adh_cols in INTERVENTIONS for c in [flag] + freq_cols + adh_cols
+]
+
+VIEW_COLUMNS = {
+    "header": HEADER_COLS,
+    "trend": TREND_COLS,
+    "summary": SUMMARY_COLS,
+    "report": ALL_COLUMNS,
+    "table": ALL_COLUMNS,
+}
+
+
+def view_columns(*views) -> list:
+    """合并多个视图的列需求。"""
+    cols = []
+    for v in views:
+        cols += VIEW_COLUMNS[v]
+    return project_columns(cols)
+
+
+def stage_links(stages_df: pd.DataFrame, dates: pd.Series) -> pd.DataFrame:
+    """按日期匹配阶段，返回与 dates 同索引的 阶段ID/阶段名称/阶段主方案。"""
+    links = as_timeline(stages_df).links(dates)
+    links["阶段名称"] = links["阶段名称"].fillna("未匹配阶段")
+    return links
+
+
+def assign_stages(df: pd.DataFrame, stages_df: pd.DataFrame) -> pd.DataFrame:
+    if df.empty or "日期" not in df.columns:
+        return df
+    links = stage_links(stages_df, df["日期"])
+    for c in links.columns:
+        if c in df.columns:
+            df[c] = links[c]
+    return df
+
+
+def sync_stage_assignment(stages_df: pd.DataFrame) -> None:
+    """把阶段匹配写回历史数据；先分块只读阶段相关列比对，确有变化才分块重写整表。"""
+    def norm(frame):
+        return frame.astype(object).where(frame.notna(), "").astype(str)
+
+    stages_df = as_timeline(stages_df)
+    link_cols = ["阶段ID", "阶段名称", "阶段主方案"]
+    changed = []
+    for path in data_files():
+        for link in _iter_data_chunks(project_columns(STAGE_LINK_COLUMNS), STREAM_CHUNK_ROWS, files=[path]):
+            if not norm(stage_links(stages_df, link["日期"])).equals(norm(link[link_cols])):
+                changed.append(path)
+                break
+    if not changed:
+        return
+
+    # 只重写归属有变化的文件（分片存储时就是受影响孩子的分片）
+    for path in changed:
+        _write_data_file(path, _iter_data_chunks(list(ALL_COLUMNS), STREAM_CHUNK_ROWS, stages_df, files=[path]))
+    if sharded():
+        touch_shards(changed)
+    data_versions().bump("data")
+    audit_append("reassign", {})
+
+
+def prepare_view_frame(df_show: pd.DataFrame) -> pd.DataFrame:
+    """整理展示用数据：按日期排序、生成干预标签与干预暴露量、补全阶段名称。
+
+    新增的列先攒齐再一次 concat 接上（读入的表本来就分成很多块，逐列插入会越来越碎）。
+    """
     if df_show.empty:
-        return pd.DataFrame()
-    rows = []
-    stages = sorted([x for x in df_show["阶段名称"].dropna().unique().tolist()]) or ["未匹配阶段"]
-    for stage in stages:
-        d0 = df_show[df_show["阶段名称"].fillna("未匹配阶段") == stage]
+        return df_show
+    df_show = df_show.sort_values("日期")
+    extra = {}
+    if all(c in df_show.columns for c in TAG_COLUMNS):
+        extra["干预标签"] = df_show.apply(short_tag, axis=1)
+    if "阶段名称" in df_show.columns:
+        extra["阶段名称"] = df_show["阶段名称"].fillna("未匹配阶段")
+    if all(c in df_show.columns for c in EXPOSURE_SOURCES):
+        extra.update(exposure_features(df_show))
+    if not extra:
+        return df_show
+    kept = [c for c in df_show.columns if c not in extra]
+    out = pd.concat([df_show[kept], pd.DataFrame(extra, index=df_show.index)], axis=1)
+    return out[[c for c in df_show.columns if c in out.columns] + [c for c in extra if c not in df_show.columns]]
+
+
+def load_view_data(columns) -> pd.DataFrame:
+    """按列投影读取并整理展示用数据（df_show）。"""
+    return prepare_view_frame(load_data(columns))
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def cached_child_view(fp: str, columns: tuple, child: str) -> pd.DataFrame:
+    """分片存储：单个孩子的 df_show（只读他的分片，阶段归属按当前阶段表匹配）；fp 只作缓存键。"""
+    return prepare_view_frame(load_data(list(columns), stages_df=load_stages(), child=child))
+
+
+# ================== 预处理数据缓存（Arrow / Feather，内存映射） ==================
+def file_fingerprint(path: str) -> str:
+    try:
+        st_ = os.stat(path)
+    except FileNotFoundError:
+        return "none"
+    return f"{st_.st_size}-{st_.st_mtime_ns}"
+
+
+def data_fingerprint(child=None) -> str:
+    """数据文件 + 阶段表 + 预处理版本的指纹；任一变化即对应新的缓存文件（分片存储时可只看某个孩子）。"""
+    raw = f"{data_file_fingerprint(child)}|{file_fingerprint(STAGE_FILE)}|v{PREPARED_CACHE_VERSION}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def prepared_cache_path(fp: str) -> str:
+    return os.path.join(CACHE_DIR, f"df_show-{fp}.arrow")
+
+
+def write_prepared_cache(df: pd.DataFrame, path: str) -> bool:
+    """写出未压缩的 Feather 文件（未压缩才能零拷贝内存映射）；先写临时文件再原子替换。"""
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return False
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    feather.write_feather(table, tmp, compression="uncompressed")
+    os.replace(tmp, path)
+    return True
+
+
+def prune_prepared_cache(keep) -> None:
+    """删掉已发布快照以外的缓存文件；必须在新的 published.json 就位之后调用，否则读取方会暂时找不到快照。"""
+    keep = {os.path.basename(p) for p in keep}
+    for name in os.listdir(CACHE_DIR):
+        if name.startswith(("df_show-", "summary-")) and name.endswith(".arrow") and name not in keep:
+            try:
+                os.remove(os.path.join(CACHE_DIR, name))
+            except OSError:
+                pass
+
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def open_prepared_table(path: str):
+    """只读内存映射打开缓存；同一进程内所有会话共用这一份 Table。"""
+    return feather.read_table(path, memory_map=True)
+
+
+def read_published():
+    """当前已发布的快照（df_show + 汇总）；没有或文件已丢失时返回 None。"""
+    try:
+        with open(PUBLISHED_FILE, encoding="utf-8") as f:
+            snap = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not all(os.path.exists(snap.get(k) or "") for k in ("df_show", "summary")):
+        return None
+    return snap
+
+
+def rebuild_snapshot(stages_df):
+    """重算阶段归属、df_show 与汇总，写好缓存后原子发布；返回 (快照, df_show)，无法缓存时快照为 None。"""
+    with data_lock():
+        sync_stage_assignment(stages_df)
+        df_show = load_view_data(None)
+        fp = data_fingerprint()
+    if df_show.empty:
+        return None, df_show
+
+    snap = {
+        "fingerprint": fp,
+        "df_show": prepared_cache_path(fp),
+        "summary": os.path.join(CACHE_DIR, f"summary-{fp}.arrow"),
+        "built_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    if not (write_prepared_cache(df_show, snap["df_show"])
+            and write_prepared_cache(build_stage_intervention_summary(df_show), snap["summary"])):
+        return None, df_show
+    tmp = f"{PUBLISHED_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snap, f, ensure_ascii=False)
+    os.replace(tmp, PUBLISHED_FILE)
+    prune_prepared_cache([snap["df_show"], snap["summary"]])
+    data_versions().bump("published")
+    return snap, df_show
+
+
+# ================== 后台重算 ==================
+DATA_LOCK_FILE = f"{CSV_FILE}.lock"
+
+
+class DataLock:
+    """数据文件写锁：进程内的线程锁 + 数据目录里锁文件上的排他锁。
+
+    页面录入、后台重算与命令行的 archive / shard / encrypt / export 等写入互斥，不论是否在同一个进程里。
+    锁文件按进入时的当前目录定位（压测、存储基准会切换到临时数据目录）。
+    """
+
+    def __init__(self, path: str = DATA_LOCK_FILE):
+        self.path = path
+        self.thread_lock = threading.Lock()
+        self.fd = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                else:
+                    while True:  # LK_LOCK 重试约 10 秒后报错，继续等
+                        try:
+                            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:
+                            pass
+            except BaseException:
+                os.close(fd)
+                raise
+        except BaseException:
+            self.thread_lock.release()
+            raise
+        self.fd = fd
+        return self
+
+    def __exit__(self, *exc) -> None:
+        fd, self.fd = self.fd, None
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+            self.thread_lock.release()
+
+
+@st.cache_resource
+def data_lock() -> DataLock:
+    """进程内共享的数据写锁（见 DataLock，跨进程同样互斥）。"""
+    return DataLock()
+
+
+class DataVersions:
+    """进程内共享的数据版本号：数据文件 / 阶段表 / 已发布快照，每次写入各自递增。
+
+    表单提交只重跑所在片段；页面上的 data_watch 按版本号判断视图输入是否变了，变了才刷新，
+    其他会话和后台重算的写入也能感知到。
+    """
+
+    KEYS = ("data", "stages", "published")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versions = dict.fromkeys(self.KEYS, 0)
+
+    def bump(self, *keys) -> None:
+        with self.lock:
+            for k in keys:
+                self.versions[k] += 1
+
+    def get(self, *keys) -> dict:
+        with self.lock:
+            return {k: self.versions[k] for k in (keys or self.KEYS)}
+
+
+@st.cache_resource
+def data_versions() -> DataVersions:
+    return DataVersions()
+
+
+class RecomputeWorker:
+    """后台重算线程：阶段调整后重新匹配阶段、重建 df_show 与汇总并原子发布（超大档案只写回阶段归属）。
+
+    任务串行执行；运行期间重复提交只会让它在当前轮结束后再跑一轮。
+    """
+
+    def __init__(self):
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="eye-recompute")
+        self.lock = threading.Lock()
+        self.running = False
+        self.dirty = False
+        self.error = None
+        self.synced_stages = None  # 不走快照的存储（分片 / 加密 / 超大档案 / 无 pyarrow）：已写回阶段归属的阶段表指纹
+
+    def submit(self) -> None:
+        with self.lock:
+            self.dirty = True
+            if not self.running:
+                self.running = True
+                self.pool.submit(self._run)
+
+    def _run(self) -> None:
+        while True:
+            with self.lock:
+                if not self.dirty:
+                    self.running = False
+                    return
+                self.dirty = False
+            try:
+                if sharded() or encrypted() or feather is None or is_large_archive():
+                    fp = file_fingerprint(STAGE_FILE)
+                    with data_lock():
+                        sync_stage_assignment(load_stages())
+                    self.synced_stages = fp
+                else:
+                    rebuild_snapshot(load_stages())
+                self.error = None
+            except Exception as exc:  # 出错时保留旧快照继续服务，并在页面上提示
+                self.error = str(exc)
+
+    def busy(self) -> bool:
+        with self.lock:
+            return self.running
+
+
+@st.cache_resource
+def recompute_worker() -> RecomputeWorker:
+    return RecomputeWorker()
+
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def cached_view_data(fp: str) -> pd.DataFrame:
+    """整份 df_show 的内存缓存（不写文件）；fp 只作缓存键。"""
+    return load_view_data(None)
+
+
+def load_prepared(stages_df, columns=None):
+    """读取 df_show：命中缓存时直接从内存映射文件按列取数。返回 (df_show, 它对应的数据指纹)。
+
+    缓存未命中（数据或阶段有变化）时：已有发布的快照就交给后台重算、先用旧快照服务（指纹是快照的）；
+    首次运行没有快照才同步构建。
+    """
+    cols = project_columns(columns)
+    if all(c in cols for c in TAG_COLUMNS):
+        cols = cols + ["干预标签"]
+    if all(c in cols for c in EXPOSURE_SOURCES):
+        cols = cols + EXPOSURE_COLUMNS
+
+    if feather is None or encrypted():
+        # 没有 pyarrow，或加密存储（不落明文的预处理缓存）：df_show 只缓存在内存里，按数据指纹复用；
+        # 阶段表变了才写回阶段归属（写回之后再取指纹）
+        stage_fp = file_fingerprint(STAGE_FILE)
+        if recompute_worker().synced_stages != stage_fp:
+            with data_lock():
+                sync_stage_assignment(stages_df)
+            recompute_worker().synced_stages = stage_fp
+        fp = data_fingerprint()
+        df_show = cached_view_data(fp)
+        return df_show[[c for c in cols if c in df_show.columns]], fp
+
+    fp = data_fingerprint()
+    path = prepared_cache_path(fp)
+    if not os.path.exists(path):
+        snap = read_published()
+        if snap is not None:
+            recompute_worker().submit()
+        else:
+            snap, df_show = rebuild_snapshot(stages_df)
+            if snap is None:
+                return (df_show[cols] if not df_show.empty else df_show[project_columns(columns)]), fp
+        path, fp = snap["df_show"], snap["fingerprint"]
+
+    table = open_prepared_table(path)
+    return table.select([c for c in cols if c in table.column_names]).to_pandas(), fp
+
+
+def load_prepared_summary():
+    """已发布快照里的阶段×干预汇总；没有时返回 None（由调用方现场计算）。"""
+    snap = read_published() if feather is not None and not encrypted() else None
+    if snap is None:
+        return None
+    return open_prepared_table(snap["summary"]).to_pandas()
+
+
+# ================== 分块聚合（汇总 / 趋势降采样） ==================
+YES_VALUES = ["1", "true", "yes", "是"]
+
+TREND_METRICS = ["左眼_logMAR", "右眼_logMAR", "左眼_SE", "右眼_SE", "左眼远视储备", "右眼远视储备", "眼轴长度(L)", "眼轴长度(R)",
+                 "左眼_AL/CR", "右眼_AL/CR", "左眼_J0", "右眼_J0", "左眼_J45", "右眼_J45"]
+
+
+def yes_mask(series: pd.Series) -> pd.Series:
+    """is_yes 的向量化版本。"""
+    return series.astype(str).str.lower().isin(YES_VALUES)
+
+
+class StageInterventionAccumulator:
+    """阶段×干预汇总的分块累加器：只保存各分组的和与计数，可逐块 update、可 merge。"""
+
+    FIELDS = ["adh", "f1", "f2", "v", "se"]
+
+    def __init__(self):
+        self.parts = []
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        if chunk.empty:
+            return
+        stage = chunk["阶段名称"].fillna("未匹配阶段")
+        # 视力在 logMAR 上取平均（小数视力是比值尺度，算术平均会偏高）
+        v_avg = (to_numeric(chunk["左眼_logMAR"]) + to_numeric(chunk["右眼_logMAR"])) / 2
+        se_avg = (to_numeric(chunk["左眼_SE"]) + to_numeric(chunk["右眼_SE"])) / 2
         for name, flag, freq_cols, adh_cols in INTERVENTIONS:
-            used = d0[d0[flag].apply(is_yes)]
-            if used.empty:
+            used = yes_mask(chunk[flag])
+            if not used.any():
                 continue
+            vals = pd.DataFrame({
+                "adh": to_numeric(chunk[adh_cols[0]]) if adh_cols else None,
+                "f1": to_numeric(chunk[freq_cols[0]]) if len(freq_cols) >= 1 else None,
+                "f2": to_numeric(chunk[freq_cols[1]]) if len(freq_cols) >= 2 else None,
+                "v": v_avg,
+                "se": se_avg,
+            })[used]
+            g = vals.groupby(stage[used])
+            part = g.sum(min_count=1).fillna(0).add_suffix("_sum").join(g.count().add_suffix("_cnt"))
+            part["n"] = g.size()
+            part["干预"] = name
+            self.parts.append(part.reset_index(names="阶段").set_index(["阶段", "干预"]))
+
+    def merge(self, other: "StageInterventionAccumulator") -> "StageInterventionAccumulator":
+        self.parts += other.parts
+        return self
+
+    def result(self) -> pd.DataFrame:
+        if not self.parts:
+            return pd.DataFrame()
+        tot = pd.concat(self.parts).groupby(level=[0, 1], sort=False).sum()
+        order = {name: i for i, (name, _, _, _) in enumerate(INTERVENTIONS)}
+        keys = pd.DataFrame({"阶段": tot.index.get_level_values(0), "o": tot.index.get_level_values(1).map(order)})
+        tot = tot.iloc[keys.sort_values(["阶段", "o"]).index]
+
+        def mean(field, digits):
+            m = tot[f"{field}_sum"] / tot[f"{field}_cnt"].where(tot[f"{field}_cnt"] > 0)
+            return m.round(digits)
+
+        out = pd.DataFrame({
+            "记录次数": tot["n"].astype(int),
+            "平均依从性(%)": mean("adh", 1),
+            "频次/时长均值1": mean("f1", 2),
+            "频次/时长均值2": mean("f2", 2),
+            "使用时平均视力(左右均值)": logmar_to_decimal(mean("v", 2)),
+            "使用时平均logMAR": mean("v", 2),
+            "使用时平均SE(左右均值)": mean("se", 2),
+        }, index=tot.index)
+        return out.reset_index()
+
+
+class TrendAccumulator:
+    """趋势的分块累加器：按月降采样（各指标月均值），并保留最近 tail_n 条原始记录。"""
+
+    def __init__(self, freq: str = "M", tail_n: int = STREAM_TAIL_ROWS):
+        self.freq = freq
+        self.tail_n = tail_n
+        self.sums = None
+        self.counts = None
+        self.tail = None
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        if chunk.empty:
+            return
+        period = chunk["日期"].dt.to_period(self.freq).dt.to_timestamp().rename("日期")
+        vals = chunk[TREND_METRICS].apply(to_numeric)
+        g = vals.groupby(period)
+        s, c = g.sum(), g.count()
+        self.sums = s if self.sums is None else self.sums.add(s, fill_value=0)
+        self.counts = c if self.counts is None else self.counts.add(c, fill_value=0)
+        tail = chunk if self.tail is None else pd.concat([self.tail, chunk])
+        self.tail = tail.sort_values("日期").tail(self.tail_n)
+
+    def merge(self, other: "TrendAccumulator") -> "TrendAccumulator":
+        if other.sums is not None:
+            self.sums = other.sums if self.sums is None else self.sums.add(other.sums, fill_value=0)
+            self.counts = other.counts if self.counts is None else self.counts.add(other.counts, fill_value=0)
+            tail = other.tail if self.tail is None else pd.concat([self.tail, other.tail])
+            self.tail = tail.sort_values("日期").tail(self.tail_n)
+        return self
+
+    def result(self) -> pd.DataFrame:
+        if self.sums is None:
+            return pd.DataFrame(columns=["日期"] + TREND_METRICS)
+        m = (self.sums / self.counts.where(self.counts > 0)).sort_index()
+        m["平均logMAR"] = (m["左眼_logMAR"] + m["右眼_logMAR"]) / 2
+        for col, lm_col in ACUITY_PAIRS + [("平均视力", "平均logMAR")]:
+            m[col] = logmar_to_decimal(m[lm_col])
+        m["平均SE"] = (m["左眼_SE"] + m["右眼_SE"]) / 2
+        m["平均AL/CR"] = (m["左眼_AL/CR"] + m["右眼_AL/CR"]) / 2
+        return m.reset_index()
 
-            v_avg = (to_numeric(used["左眼视力"]) + to_numeric(used["右眼视力"])) / 2
-            se_avg = (to_numeric(used["左眼_SE"]) + to_numeric(used["右眼_SE"])) / 2
 
-            adh = None
-            for c in adh_cols:
-                if c in used.columns:
-                    adh = to_numeric(used[c]).mean()
-                    break
+def build_stage_intervention_summary(df_show: pd.DataFrame) -> pd.DataFrame:
+    acc = StageInterventionAccumulator()
+    acc.update(df_show)
+    return acc.result()
+
+
+def is_large_archive() -> bool:
+    if sharded():  # 分片存储时页面只读所选孩子的分片
+        return False
+    try:
+        return os.path.getsize(data_physical_path(CSV_FILE)) > LARGE_ARCHIVE_BYTES
+    except OSError:
+        return False
+
+
+@st.cache_data(max_entries=4, show_spinner="正在分块读取历史档案…")
+def stream_view_data(fp: str, columns: tuple) -> dict:
+    """超大档案：一遍分块扫描同时喂给汇总、趋势累加器，只在内存中保留最近若干条记录。
+
+    fp 只用作缓存键（数据或阶段表变化即重新扫描）。
+    """
+    stages_df = load_stages()
+    summary_acc, trend_acc = StageInterventionAccumulator(), TrendAccumulator()
+    cols = project_columns(list(columns) + SUMMARY_COLS + TREND_COLS)
+    for chunk in load_data(cols, chunksize=STREAM_CHUNK_ROWS, stages_df=stages_df):
+        summary_acc.update(chunk)
+        trend_acc.update(chunk)
+    tail = trend_acc.tail if trend_acc.tail is not None else pd.DataFrame(columns=cols)
+    return {
+        "tail": prepare_view_frame(tail.copy()),
+        "summary": summary_acc.result(),
+        "monthly": trend_acc.result(),
+    }
+
+
+# ================== 审计日志（哈希链 + 定期快照） ==================
+# 只追加的修改日志：每条记录 seq / 时间 / 动作 / 内容，并带上一条的哈希串成链，改动任意一条都能校验出来。
+# 动作：snapshot（全量快照）、insert（新增记录）、dedupe（删除完全重复）、stages（阶段表变更）、reassign（按阶段表重新匹配）、
+# archive（旧记录移入归档；只是换了存放位置，快照与重建都按“热数据 + 归档”的完整数据计）、
+# repair（上次追加写到一半中断，截掉的残行另存在 audit/torn-*.bin）
+AUDIT_FILE = "audit_log.jsonl"
+AUDIT_DIR = "audit"
+AUDIT_CHECKPOINT_FILE = os.path.join(AUDIT_DIR, "verified.json")
+AUDIT_SNAPSHOT_INDEX = os.path.join(AUDIT_DIR, "snapshots.jsonl")
+AUDIT_SNAPSHOT_EVERY = 50  # 每追加这么多条日志记一次全量快照，时点重建最多重放这么多条
+AUDIT_GENESIS = "0" * 64
+
+
+class AuditLogError(RuntimeError):
+    """审计日志末尾损坏（不是写了一半的残行），不能在其后继续追加。"""
+
+
+@st.cache_resource
+def audit_lock() -> threading.Lock:
+    return threading.Lock()
+
+
+def audit_records(df: pd.DataFrame) -> list:
+    """DataFrame → 可写入日志的记录列表（日期转 ISO 字符串，空值不写）。"""
+    rows = json.loads(df.to_json(orient="records", date_format="iso", force_ascii=False))
+    return [{k: v for k, v in r.items() if v is not None} for r in rows]
+
+
+def _entry_hash(entry: dict) -> str:
+    body = {k: entry[k] for k in ("seq", "ts", "action", "payload", "prev")}
+    raw = json.dumps(body, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _last_line(path: str) -> bytes:
+    """从文件末尾往前读出最后一行，不扫描整个日志。"""
+    with open(path, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        buf = b""
+        while pos > 0:
+            step = min(1 << 16, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+            cut = buf.rstrip(b"\n").rfind(b"\n")
+            if cut >= 0:
+                return buf[cut + 1:].rstrip(b"\n")
+        return buf.rstrip(b"\n")
+
+
+def audit_append(action: str, payload: dict) -> dict:
+    """追加一条日志（落盘后才返回）；每 AUDIT_SNAPSHOT_EVERY 条顺带记一次快照。
+
+    加密存储时，带记录内容（rows）的日志把内容加密后再入链，哈希链校验的是密文。
+    """
+    if encrypted() and "rows" in payload:
+        payload = {"sealed": seal_json(payload, b"audit")}
+    with audit_lock():
+        torn = _cut_torn_tail()
+        if torn is not None:
+            _write_entry("repair", torn)
+        entry = _write_entry(action, payload)
+    if action != "snapshot" and entry["seq"] % AUDIT_SNAPSHOT_EVERY == 0:
+        audit_snapshot()
+    return entry
+
+
+def _write_entry(action: str, payload: dict) -> dict:
+    """接在最后一条后面写一条日志（调用方持有 audit_lock）。"""
+    offset = os.path.getsize(AUDIT_FILE) if os.path.exists(AUDIT_FILE) else 0
+    try:
+        last = json.loads(_last_line(AUDIT_FILE)) if offset else None
+        seq, prev = (last["seq"] + 1, last["hash"]) if last else (1, AUDIT_GENESIS)
+    except (ValueError, TypeError, KeyError):
+        raise AuditLogError(f"{AUDIT_FILE} 最后一条无法解析（可能被改动），无法接续哈希链") from None
+    entry = {
+        "seq": seq,
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "action": action,
+        "payload": payload,
+        "prev": prev,
+    }
+    entry["hash"] = _entry_hash(entry)
+    with open(AUDIT_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    if action == "snapshot":
+        os.makedirs(AUDIT_DIR, exist_ok=True)
+        with open(AUDIT_SNAPSHOT_INDEX, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"seq": entry["seq"], "ts": entry["ts"], "offset": offset}) + "\n")
+    return entry
+
+
+def _cut_torn_tail():
+    """上次追加写到一半就中断（日志末尾没有换行）时，截掉残行并另存到 audit/ 备查，返回 repair 日志的内容。
+
+    每条日志都连同换行一次写入，末尾缺换行只会是写了一半；调用方持有 audit_lock。
+    """
+    if not os.path.exists(AUDIT_FILE) or os.path.getsize(AUDIT_FILE) == 0:
+        return None
+    with open(AUDIT_FILE, "rb+") as f:
+        pos = f.seek(-1, os.SEEK_END)
+        if f.read(1) == b"\n":
+            return None
+        keep = 0
+        while pos > 0:
+            step = min(1 << 16, pos)
+            pos -= step
+            f.seek(pos)
+            cut = f.read(step).rfind(b"\n")
+            if cut >= 0:
+                keep = pos + cut + 1
+                break
+        f.seek(keep)
+        torn = f.read()
+        os.makedirs(AUDIT_DIR, exist_ok=True)
+        saved = os.path.join(AUDIT_DIR, f"torn-{datetime.now():%Y%m%d-%H%M%S-%f}.bin")
+        with open(saved, "wb") as out:
+            out.write(torn)
+        f.truncate(keep)
+        f.flush()
+        os.fsync(f.fileno())
+    return {"offset": keep, "bytes": len(torn), "sha256": hashlib.sha256(torn).hexdigest(), "saved": saved}
+
+
+def audit_append_or_warn(action: str, payload: dict) -> None:
+    """页面保存路径用：数据已经写入，日志损坏时在页面上提示，而不是让保存流程异常中断。"""
+    try:
+        audit_append(action, payload)
+    except AuditLogError as exc:
+        st.warning(f"⚠️ 已保存，但审计日志未能记录：{exc}")
+
+
+def audit_snapshot() -> dict:
+    """把当前数据和阶段表压缩存档，并在日志里记下文件摘要（快照文件被改也能校验出来）。
+
+    完整数据按块（归档分区、热数据分块）写出，不整表读进内存。
+    """
+    os.makedirs(AUDIT_DIR, exist_ok=True)
+    name = f"snapshot-{datetime.now():%Y%m%d-%H%M%S-%f}"
+    stages_path = os.path.join(AUDIT_DIR, f"{name}-stages.csv.gz")
+    if encrypted():  # 快照同样按块加密
+        data_path = os.path.join(AUDIT_DIR, f"{name}-data.csv")
+        EncryptedFile(data_path).rewrite(ensure_columns(chunk) for chunk in history_chunks())
+        data_path += ".enc"
+    else:
+        data_path = os.path.join(AUDIT_DIR, f"{name}-data.csv.gz")
+        with gzip.open(data_path, "wt", encoding="utf-8", newline="") as f:
+            for i, chunk in enumerate(history_chunks()):
+                ensure_columns(chunk).to_csv(f, index=False, header=i == 0)
+    load_stages().to_csv(stages_path, index=False, compression="gzip")
+    return audit_append("snapshot", {
+        "data": data_path, "data_sha256": _file_sha256(data_path),
+        "stages": stages_path, "stages_sha256": _file_sha256(stages_path),
+    })
+
+
+def ensure_audit_baseline() -> None:
+    """还没有日志时，先给现有数据记一份起点快照。"""
+    if not os.path.exists(AUDIT_FILE):
+        audit_snapshot()
+
+
+def verify_audit(full: bool = False) -> dict:
+    """校验哈希链。
+
+    默认增量：从上次校验点继续，只校验新追加的日志，并复核校验点那一条仍然原样；full=True 从头校验。
+    """
+    cp = {}
+    if not full:
+        try:
+            with open(AUDIT_CHECKPOINT_FILE, encoding="utf-8") as f:
+                cp = json.load(f)
+        except (OSError, ValueError):
+            cp = {}
+    if not os.path.exists(AUDIT_FILE):
+        return {"ok": True, "checked": 0, "seq": 0}
+    offset, seq, prev = cp.get("offset", 0), cp.get("seq", 0), cp.get("hash", AUDIT_GENESIS)
+    if os.path.getsize(AUDIT_FILE) < offset:
+        return {"ok": False, "checked": 0, "seq": seq, "error": "日志比上次校验时短，可能被截断"}
+
+    checked = 0
+    with open(AUDIT_FILE, "rb") as f:
+        if offset:
+            f.seek(cp["line_start"])
+            try:
+                e = json.loads(f.readline())
+            except ValueError:
+                e = {}
+            if e.get("hash") != prev or _entry_hash(e) != prev:
+                return {"ok": False, "checked": 0, "seq": seq, "error": f"第 {seq} 条（上次校验点）已被改动"}
+        f.seek(offset)
+        pos, line_start = offset, cp.get("line_start", 0)
+        for raw in f:
+            try:
+                e = json.loads(raw)
+                intact = e["seq"] == seq + 1 and e["prev"] == prev and _entry_hash(e) == e["hash"]
+            except (ValueError, KeyError, TypeError):
+                intact = False
+            if not intact:
+                return {"ok": False, "checked": checked, "seq": seq + 1, "error": f"第 {seq + 1} 条与哈希链不符"}
+            if e["action"] == "snapshot":
+                p = e["payload"]
+                for key in ("data", "stages"):
+                    if not os.path.exists(p[key]) or _file_sha256(p[key]) != p[f"{key}_sha256"]:
+                        return {"ok": False, "checked": checked, "seq": e["seq"], "error": f"快照文件 {p[key]} 缺失或被改动"}
+            seq, prev, line_start = e["seq"], e["hash"], pos
+            pos += len(raw)
+            checked += 1
+
+    os.makedirs(AUDIT_DIR, exist_ok=True)
+    tmp = f"{AUDIT_CHECKPOINT_FILE}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"offset": pos, "line_start": line_start, "seq": seq, "hash": prev}, f)
+    os.replace(tmp, AUDIT_CHECKPOINT_FILE)
+    return {"ok": True, "checked": checked, "seq": seq}
+
+
+def _audit_snapshots() -> list:
+    """快照索引（seq / 时间 / 日志中的字节位置）；索引丢了就扫一遍日志重建。"""
+    if os.path.exists(AUDIT_SNAPSHOT_INDEX):
+        with open(AUDIT_SNAPSHOT_INDEX, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    snaps, pos = [], 0
+    if os.path.exists(AUDIT_FILE):
+        with open(AUDIT_FILE, "rb") as f:
+            for raw in f:
+                e = json.loads(raw)
+                if e["action"] == "snapshot":
+                    snaps.append({"seq": e["seq"], "ts": e["ts"], "offset": pos})
+                pos += len(raw)
+    return snaps
+
+
+def _replay(entry: dict, data: pd.DataFrame, stages: pd.DataFrame) -> tuple:
+    p = entry["payload"]
+    if "sealed" in p:
+        p = unseal_json(p["sealed"], b"audit")
+    if entry["action"] == "snapshot":
+        if p["data"].endswith(".enc"):
+            frames = list(EncryptedFile(p["data"][:-len(".enc")]).frames())
+            raw = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        else:
+            raw = pd.read_csv(p["data"])
+        data = fill_derived(ensure_columns(_coerce_dates(raw)))
+        stages = load_stages(p["stages"])
+    elif entry["action"] == "insert":
+        rows = fill_derived(ensure_columns(_coerce_dates(pd.DataFrame(p["rows"]))))
+        data = pd.concat([data, rows], ignore_index=True).sort_values("日期", kind="stable")
+    elif entry["action"] == "dedupe":
+        data = data[~pd.Series(record_hashes(data)).duplicated().to_numpy()]
+    elif entry["action"] == "stages":
+        stages = normalize_stages(pd.DataFrame(p["rows"]))
+    elif entry["action"] == "reassign":
+        data = assign_stages(data, as_timeline(stages))
+    return data, stages
+
+
+def audit_state_at(when) -> tuple:
+    """重建某一时刻的 (数据, 阶段表)：从该时刻之前最近的快照开始，只重放其后的日志。"""
+    when = pd.Timestamp(when)
+    base = [s for s in _audit_snapshots() if pd.Timestamp(s["ts"]) <= when]
+    data, stages = ensure_columns(pd.DataFrame()), pd.DataFrame(columns=STAGE_COLUMNS)
+    if not base:
+        return data, stages
+    with open(AUDIT_FILE, "rb") as f:
+        f.seek(base[-1]["offset"])
+        for raw in f:
+            entry = json.loads(raw)
+            if pd.Timestamp(entry["ts"]) > when:
+                break
+            data, stages = _replay(entry, data, stages)
+    return data.reset_index(drop=True), stages
+
+
+# ================== 归档分层（冷数据按年分区） ==================
+def archive_partition_path(year) -> str:
+    return os.path.join(ARCHIVE_DIR, f"exams-{int(year)}.parquet")
+
+
+def archive_manifest() -> dict:
+    """归档清单 {年份: {rows, first, last, recorded（分区内最晚的录入时间）}}；没有归档时为空。"""
+    try:
+        with open(ARCHIVE_MANIFEST, encoding="utf-8") as f:
+            return {int(y): v for y, v in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+
+
+def archive_years(start=None, end=None) -> list:
+    """日期范围与 [start, end] 有交集的归档年份（空值表示不限）。"""
+    years = []
+    for year, m in sorted(archive_manifest().items()):
+        if pd.notna(start) and pd.Timestamp(m["last"]) < pd.Timestamp(start):
+            continue
+        if pd.notna(end) and pd.Timestamp(m["first"]) > pd.Timestamp(end):
+            continue
+        years.append(year)
+    return years
+
+
+def _write_partition(df: pd.DataFrame, path: str) -> None:
+    """zstd 压缩写出一个年份分区；文本列统一成字符串（CSV 读入的 object 列可能混有数字），先写临时文件再替换。"""
+    df = df.copy()
+    for c in df.columns:
+        if df[c].dtype == object:
+            df[c] = df[c].astype("string")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp, compression="zstd")
+    os.replace(tmp, path)
+
+
+def archive_old_records(horizon_days: int = ARCHIVE_HORIZON_DAYS) -> dict:
+    """把早于 horizon_days 天的记录移入按年分区的归档，热数据文件只留近期记录（日期缺失的记录留在热数据）。
+
+    先写分区和清单、最后才改写热数据文件；中途中断后重跑，已在分区里的记录按哈希跳过，不会重复归档。
+    """
+    if pq is None:
+        raise RuntimeError("归档需要安装 pyarrow")
+    if encrypted():
+        raise RuntimeError("加密存储暂不支持归档（归档分区是明文 Parquet）")
+    cutoff = pd.Timestamp.today().normalize() - pd.Timedelta(days=horizon_days)
+    moved = {}
+    with data_lock():
+        df = load_data()
+        old = (df["日期"] < cutoff).to_numpy()
+        if old.any():
+            os.makedirs(ARCHIVE_DIR, exist_ok=True)
+            manifest = archive_manifest()
+            for year, rows in df[old].groupby(df.loc[old, "日期"].dt.year):
+                path = archive_partition_path(year)
+                if os.path.exists(path):
+                    part = load_archive(years=[year])
+                    rows = rows[~np.isin(record_hashes(rows), record_hashes(part))]
+                    part = pd.concat([part, rows], ignore_index=True).sort_values("日期", kind="stable")
+                else:
+                    part = rows
+                _write_partition(part, path)
+                recorded = pd.to_datetime(part["录入时间"], errors="coerce", format="mixed").max()
+                manifest[int(year)] = {"rows": len(part), "first": str(part["日期"].min().date()),
+                                       "last": str(part["日期"].max().date()),
+                                       "recorded": None if pd.isna(recorded) else recorded.isoformat()}
+                moved[str(int(year))] = len(rows)
+            tmp = f"{ARCHIVE_MANIFEST}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({str(y): v for y, v in sorted(manifest.items())}, f, ensure_ascii=False)
+            os.replace(tmp, ARCHIVE_MANIFEST)
+            save_data(df[~old])
+    if moved:
+        audit_append("archive", {"cutoff": str(cutoff.date()), "years": moved})
+    return {"rows": int(old.sum()), "cutoff": str(cutoff.date()), "years": moved}
+
+
+def load_archive(columns=None, years=None, stages_df=None) -> pd.DataFrame:
+    """读取归档分区（列投影；years=None 为全部年份）。给定 stages_df 时按当前阶段表重新匹配阶段归属。"""
+    cols = project_columns(columns)
+    if years is None:
+        years = sorted(archive_manifest())
+    paths = [archive_partition_path(y) for y in years if os.path.exists(archive_partition_path(y))]
+    if pq is None or not paths:
+        return pd.DataFrame(columns=cols)
+    wanted = set(with_sources(cols))
+    frames = []
+    for path in paths:
+        names = [c for c in pq.read_schema(path).names if c in wanted]
+        frames.append(pq.read_table(path, columns=names).to_pandas())
+    df = _finish_frame(pd.concat(frames, ignore_index=True), cols)
+    if stages_df is not None:
+        df = assign_stages(df, as_timeline(stages_df))
+    return df
+
+
+def load_history(columns=None, stages_df=None) -> pd.DataFrame:
+    """完整数据 = 归档 + 热数据（导出、审计快照、判重索引用）。"""
+    hot = load_data(columns, stages_df=stages_df)
+    old = load_archive(columns, stages_df=stages_df)
+    return hot if old.empty else pd.concat([old, hot], ignore_index=True)
+
+
+def history_chunks(chunksize: int = STREAM_CHUNK_ROWS, recorded_since=None):
+    """按块产出完整数据：先逐个归档分区，再分块读热数据。
+
+    recorded_since：跳过清单表明没有在这之后（含这一刻）录入记录的归档分区
+    （归档按检查日期挑选，补录的旧检查也可能刚录入就被归档）。
+    """
+    for year, m in sorted(archive_manifest().items()):
+        if recorded_since is not None and "recorded" in m and (
+                m["recorded"] is None or pd.Timestamp(m["recorded"]) < recorded_since):
+            continue
+        yield load_archive(years=[year])
+    yield from load_data(chunksize=chunksize)
+
+
+def historic_stages() -> dict:
+    """阶段表中日期范围落到归档年份上的阶段：{阶段名称: 归档年份}。"""
+    if not archive_manifest():
+        return {}
+    out = {}
+    for _, r in load_stages().iterrows():
+        years = archive_years(r["开始日期"], r["结束日期"])
+        if years:
+            out[r["阶段名称"]] = sorted(set(out.get(r["阶段名称"], [])) | set(years))
+    return out
+
+
+@st.cache_data(max_entries=4, show_spinner="正在读取归档历史…")
+def cached_archive_view(fp: str, columns: tuple, years: tuple = None, child: str = None) -> pd.DataFrame:
+    """归档部分的展示数据（按需读取，可只取某个孩子）；fp 只作缓存键（归档清单 + 阶段表的指纹）。"""
+    read_cols = list(columns) if child is None else project_columns(list(columns) + ["儿童"])
+    old = load_archive(read_cols, None if years is None else list(years), load_stages())
+    if child is not None:
+        old = ensure_columns(old[child_keys(old) == child], list(columns))
+    return prepare_view_frame(old)
+
+
+def with_archive(df_show: pd.DataFrame, columns, years=None, child=None) -> pd.DataFrame:
+    """在热数据前面接上归档记录（归档的日期都早于热数据）。"""
+    fp = f"{file_fingerprint(ARCHIVE_MANIFEST)}|{file_fingerprint(STAGE_FILE)}"
+    old = cached_archive_view(fp, tuple(project_columns(columns)), None if years is None else tuple(years), child)
+    if old.empty:
+        return df_show
+    return pd.concat([old, df_show], ignore_index=True) if not df_show.empty else old
+
+
+# ================== 重复记录检查（哈希索引 / 排序近邻去重） ==================
+RECORD_INDEX_FILE = os.path.join(CACHE_DIR, "record_index.npz")
+DEDUP_KEY_COLUMNS = ["日期", "儿童", "左眼视力", "右眼视力", "眼轴长度(L)", "眼轴长度(R)", "左眼_SE", "右眼_SE"]
+# 近似重复的容差：日期相差天数 + 各测量值（双方都填了的才比较）
+NEAR_DUP_DAYS = 3
+NEAR_DUP_TOLERANCE = {
+    "左眼_logMAR": 0.1, "右眼_logMAR": 0.1,
+    "眼轴长度(L)": 0.05, "眼轴长度(R)": 0.05,
+    "左眼_SE": 0.25, "右眼_SE": 0.25,
+}
+
+
+def record_hashes(df: pd.DataFrame) -> np.ndarray:
+    """每条记录按 (儿童, 检查日, 关键测量值) 算 64 位哈希；测量值先统一成两位小数。"""
+    key = pd.DataFrame({"儿童": child_keys(df), "日期": pd.to_datetime(df["日期"]).dt.normalize()})
+    for c in DEDUP_KEY_COLUMNS[2:]:
+        key[c] = to_numeric(df[c]).astype(float).round(2) if c in df.columns else np.nan
+    return pd.util.hash_pandas_object(key, index=False).to_numpy(np.uint64)
+
+
+class RecordIndex:
+    """记录哈希索引，和数据文件放在一起维护：保存 / 导入前 O(1) 判重。
+
+    索引文件记着生成时数据文件（及归档清单）的指纹；被别处改写过（指纹不符）就按关键列重建。
+    """
+
+    def __init__(self, hashes: np.ndarray):
+        self.hashes = set(hashes.tolist())
+
+    @classmethod
+    def load(cls) -> "RecordIndex":
+        try:
+            with np.load(RECORD_INDEX_FILE) as z:
+                if str(z["fp"]) == cls.fingerprint():
+                    return cls(z["hashes"])
+        except (OSError, ValueError, KeyError):
+            pass
+        index = cls(record_hashes(load_history(DEDUP_KEY_COLUMNS)))
+        index.save()
+        return index
+
+    @staticmethod
+    def fingerprint() -> str:
+        """热数据文件 + 归档清单的指纹（已归档的记录再导入也能判重）。"""
+        return f"{data_file_fingerprint()}|{file_fingerprint(ARCHIVE_MANIFEST)}"
+
+    def contains(self, h) -> bool:
+        return int(h) in self.hashes
+
+    def mask(self, hashes: np.ndarray) -> np.ndarray:
+        return np.fromiter((h in self.hashes for h in hashes.tolist()), dtype=bool, count=len(hashes))
+
+    def add(self, hashes: np.ndarray) -> None:
+        """数据文件保存后调用：并入新记录的哈希，并按新指纹落盘。"""
+        self.hashes.update(hashes.tolist())
+        self.save()
+
+    def save(self) -> None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = f"{RECORD_INDEX_FILE}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, hashes=np.fromiter(self.hashes, dtype=np.uint64, count=len(self.hashes)),
+                 fp=np.array(self.fingerprint()))
+        os.replace(tmp, RECORD_INDEX_FILE)
+
+
+def near_duplicates(df: pd.DataFrame, window: int = 5, days: int = NEAR_DUP_DAYS) -> pd.DataFrame:
+    """排序近邻法找疑似重复：按 (儿童, 日期) 排序后，每条只和其后 window-1 条比较，O(n·window)。
+
+    同一孩子、日期相差不超过 days 天、且双方都填写的测量值全部在容差内（至少有一项可比）即视为一对。
+    返回的 a / b 为原数据的行索引。
+    """
+    d = df[df["日期"].notna()]
+    out_cols = ["a", "b", "儿童", "日期a", "日期b", "相隔天数", "完全重复"]
+    if len(d) < 2:
+        return pd.DataFrame(columns=out_cols)
+    child = child_keys(d)
+    codes = pd.factorize(child)[0]
+    t = _days(d["日期"])
+    order = np.lexsort((t, codes))
+    codes, t = codes[order], t[order]
+    vals = np.column_stack([to_numeric(d[c]).to_numpy(dtype=float) if c in d.columns else np.full(len(d), np.nan)
+                            for c in NEAR_DUP_TOLERANCE])[order]
+    tol = np.array(list(NEAR_DUP_TOLERANCE.values()))
+    hashes = record_hashes(d)[order]
+
+    pairs = []
+    for k in range(1, min(window, len(d))):
+        a = np.arange(len(d) - k)
+        b = a + k
+        gap = t[b] - t[a]
+        both = ~np.isnan(vals[a]) & ~np.isnan(vals[b])
+        close = (~both | (np.abs(vals[a] - vals[b]) <= tol)).all(axis=1) & both.any(axis=1)
+        m = (codes[a] == codes[b]) & (gap <= days) & close
+        if m.any():
+            pairs.append(pd.DataFrame({"a": order[a[m]], "b": order[b[m]], "相隔天数": gap[m],
+                                       "完全重复": hashes[a[m]] == hashes[b[m]]}))
+    if not pairs:
+        return pd.DataFrame(columns=out_cols)
+    res = pd.concat(pairs, ignore_index=True)
+    res["儿童"] = child.to_numpy()[res["a"]]
+    res["日期a"] = d["日期"].to_numpy()[res["a"]]
+    res["日期b"] = d["日期"].to_numpy()[res["b"]]
+    res["a"] = d.index[res["a"]]
+    res["b"] = d.index[res["b"]]
+    return res[out_cols].sort_values(["儿童", "日期a"], ignore_index=True)
+
+
+@st.cache_data(max_entries=2, show_spinner="正在扫描疑似重复记录…")
+def cached_near_duplicates(fp: str) -> pd.DataFrame:
+    """整库离线去重扫描（只读需要的列），按数据指纹缓存。"""
+    return near_duplicates(load_data(DEDUP_KEY_COLUMNS + list(NEAR_DUP_TOLERANCE)))
+
+
+def drop_exact_duplicates() -> int:
+    """删除完全重复的记录（保留文件中靠前的一条），返回删除条数。调用方需持有 data_lock。"""
+    df = load_data()
+    dup = pd.Series(record_hashes(df), index=df.index).duplicated()
+    if dup.any():
+        save_data(df[~dup.to_numpy()])
+        RecordIndex.load()
+        audit_append("dedupe", {"removed": int(dup.sum())})
+    return int(dup.sum())
+
+
+# ================== 生长预测（眼轴 / SE） ==================
+FORECAST_METRICS = {"眼轴长度(L)": "mm", "眼轴长度(R)": "mm", "左眼_SE": "D", "右眼_SE": "D"}
+FORECAST_HORIZONS_MONTHS = (6, 12)
+FORECAST_MIN_POINTS = 3  # 当前阶段内少于该点数时改用全部历史拟合
+FORECAST_STATS_FILE = os.path.join(CACHE_DIR, "forecast_stats.csv")
+FORECAST_META_FILE = os.path.join(CACHE_DIR, "forecast_meta.json")
+_FIT_SUMS = ["n", "st", "sy", "stt", "sty", "syy"]
+_T0 = pd.Timestamp("2000-01-01")
+
+
+def _years(dates) -> pd.Series:
+    return (pd.to_datetime(dates) - _T0).dt.days / 365.25
+
+
+def _fit_sums(df: pd.DataFrame) -> pd.DataFrame:
+    """按 (儿童, 阶段ID, 指标) 一次性算出线性回归的充分统计量（可相加，便于增量更新）。"""
+    cols = ["日期", "阶段ID"] + list(FORECAST_METRICS)
+    d = df[cols].copy()
+    d["儿童"] = child_keys(df)
+    d["阶段ID"] = d["阶段ID"].astype(object).where(d["阶段ID"].notna(), "").astype(str)
+    long = d.melt(id_vars=["儿童", "阶段ID", "日期"], var_name="指标", value_name="y")
+    long["y"] = to_numeric(long["y"])
+    long = long.dropna(subset=["日期", "y"])
+    if long.empty:
+        return pd.DataFrame(columns=["儿童", "阶段ID", "指标"] + _FIT_SUMS)
+    t = _years(long["日期"])
+    y = long["y"]
+    parts = pd.DataFrame({"n": 1.0, "st": t, "sy": y, "stt": t * t, "sty": t * y, "syy": y * y})
+    keys = [long["儿童"], long["阶段ID"], long["指标"]]
+    return parts.groupby(keys).sum().rename_axis(["儿童", "阶段ID", "指标"]).reset_index()
+
+
+def update_forecast_fits(df: pd.DataFrame) -> pd.DataFrame:
+    """读取缓存的拟合统计量，只对有新检查的孩子增量更新；阶段表变化或旧记录被改动时对应重算。
+
+    加密存储时不落盘（缓存里有孩子名字），每次现场算。
+    """
+    if encrypted():
+        return _fit_sums(df)
+    stages_fp = file_fingerprint(STAGE_FILE)
+    children = child_keys(df)
+    now_meta = df["日期"].groupby(children).agg(["max", "count"])
+
+    stats, meta = None, {}
+    try:
+        with open(FORECAST_META_FILE, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("stages") == stages_fp and os.path.exists(FORECAST_STATS_FILE):
+            stats = pd.read_csv(FORECAST_STATS_FILE, dtype={"儿童": str, "阶段ID": str}, keep_default_na=False)
+    except (OSError, ValueError):
+        pass
+    known = meta.get("children", {}) if stats is not None else {}
+
+    # 逐孩子比对：水位线（上次拟合时的最后检查日期）之前的记录数不变 -> 只追加新检查；否则整段重算
+    last_known = children.map({c: pd.Timestamp(v["last"]) for c, v in known.items()})
+    last_known = pd.to_datetime(last_known)
+    n_before = (df["日期"] <= last_known).groupby(children).sum()
+    n_known = pd.Series({c: v["n"] for c, v in known.items()}, dtype=float).reindex(now_meta.index)
+    refit = now_meta.index[n_known.isna() | (n_before.reindex(now_meta.index) != n_known)]
+    newer = (df["日期"] > last_known) & ~children.isin(refit)
+
+    if stats is not None and refit.empty and not newer.any() and set(known) == set(now_meta.index):
+        return stats
+
+    fresh = _fit_sums(df[children.isin(refit) | newer])
+    keep = stats[stats["儿童"].isin(set(now_meta.index) - set(refit))] if stats is not None else None
+    stats = fresh if keep is None or keep.empty else (
+        pd.concat([keep, fresh]).groupby(["儿童", "阶段ID", "指标"], as_index=False)[_FIT_SUMS].sum()
+    )
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f"{FORECAST_STATS_FILE}.{os.getpid()}.tmp"
+    stats.to_csv(tmp, index=False)
+    os.replace(tmp, FORECAST_STATS_FILE)
+    meta = {
+        "stages": stages_fp,
+        "children": {c: {"last": r["max"].isoformat(), "n": int(r["count"])}
+                     for c, r in now_meta.iterrows() if pd.notna(r["max"])},
+    }
+    tmp = f"{FORECAST_META_FILE}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp, FORECAST_META_FILE)
+    return stats
+
+
+def _solve_fits(sums: pd.DataFrame) -> pd.DataFrame:
+    """由充分统计量向量化求斜率/截距/残差方差。"""
+    n = sums["n"]
+    sxx = sums["stt"] - sums["st"] ** 2 / n
+    sxy = sums["sty"] - sums["st"] * sums["sy"] / n
+    out = sums.copy()
+    out["slope"] = (sxy / sxx.where(sxx > 1e-9)).fillna(0.0)
+    out["intercept"] = (sums["sy"] - out["slope"] * sums["st"]) / n
+    sse = (sums["syy"] - sums["sy"] ** 2 / n) - out["slope"] * sxy
+    out["s2"] = (sse.clip(lower=0) / (n - 2)).where(n > 2)
+    out["sxx"] = sxx
+    return out
+
+
+def forecast_growth(df: pd.DataFrame, stats: pd.DataFrame) -> pd.DataFrame:
+    """每个孩子每个指标的 6/12 个月预测及 95% 预测区间（按当前阶段趋势，点数不足时用全部历史）。"""
+    if stats is None or stats.empty:
+        return pd.DataFrame()
+    d = pd.DataFrame({"儿童": child_keys(df), "日期": df["日期"], "阶段ID": df["阶段ID"]}).dropna(subset=["日期"])
+    latest = d.sort_values("日期").groupby("儿童").tail(1).set_index("儿童")
+    latest["阶段ID"] = latest["阶段ID"].astype(object).where(latest["阶段ID"].notna(), "").astype(str)
+
+    whole = stats.groupby(["儿童", "指标"], as_index=False)[_FIT_SUMS].sum()
+    whole["依据"] = "全部历史"
+    cur = stats.merge(latest["阶段ID"].reset_index(), on=["儿童", "阶段ID"])
+    cur = cur[(cur["n"] >= FORECAST_MIN_POINTS) & (cur["阶段ID"] != "")].drop(columns="阶段ID")
+    cur["依据"] = "当前阶段"
+    fits = pd.concat([cur, whole]).drop_duplicates(["儿童", "指标"], keep="first")
+    fits = _solve_fits(fits[fits["n"] >= 2])
+    if fits.empty:
+        return pd.DataFrame()
+
+    last = latest["日期"].reindex(fits["儿童"]).to_numpy()
+    out = fits[["儿童", "指标", "依据"]].copy()
+    out["点数"] = fits["n"].astype(int)
+    out["最近检查"] = last
+    out["年变化率"] = fits["slope"].round(3)
+    tbar = fits["st"] / fits["n"]
+    for m in FORECAST_HORIZONS_MONTHS:
+        when = pd.to_datetime(last) + pd.DateOffset(months=m)
+        t = _years(pd.Series(when, index=fits.index))
+        yhat = fits["intercept"] + fits["slope"] * t
+        se = (fits["s2"] * (1 + 1 / fits["n"] + (t - tbar) ** 2 / fits["sxx"].where(fits["sxx"] > 1e-9))) ** 0.5
+        out[f"{m}个月日期"] = when
+        out[f"{m}个月预测"] = yhat.round(2)
+        out[f"{m}个月下限"] = (yhat - 1.96 * se).round(2)
+        out[f"{m}个月上限"] = (yhat + 1.96 * se).round(2)
+    return out.reset_index(drop=True)
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def cached_forecasts(fp: str, _df: pd.DataFrame) -> pd.DataFrame:
+    """fp 为 _df 对应的数据指纹（缓存键：先用旧快照服务时是快照的指纹，包含归档时带上归档年份）；
+    _df 需含 日期/儿童/阶段ID 及各预测指标。
+    """
+    return forecast_growth(_df, update_forecast_fits(_df))
+
+
+def add_forecast_traces(fig, fc: pd.DataFrame, last_values: dict) -> None:
+    """在趋势图上叠加预测虚线与 95% 区间带。"""
+    for _, r in fc.iterrows():
+        start = last_values.get(r["指标"])
+        if start is None:
+            continue
+        xs = [r["最近检查"]] + [r[f"{m}个月日期"] for m in FORECAST_HORIZONS_MONTHS]
+        ys = [start] + [r[f"{m}个月预测"] for m in FORECAST_HORIZONS_MONTHS]
+        lo = [start] + [r[f"{m}个月下限"] for m in FORECAST_HORIZONS_MONTHS]
+        hi = [start] + [r[f"{m}个月上限"] for m in FORECAST_HORIZONS_MONTHS]
+        if not any(pd.isna(v) for v in lo + hi):
+            fig.add_trace(go.Scatter(
+                x=xs + xs[::-1], y=hi + lo[::-1], fill="toself", mode="lines", line=dict(width=0),
+                opacity=0.2, name=f"{r['指标']} 95%区间", hoverinfo="skip",
+            ))
+        fig.add_trace(go.Scatter(x=xs, y=ys, mode="lines+markers", line=dict(dash="dash"),
+                                 name=f"{r['指标']} 预测（{r['依据']}）"))
+
+
+# ================== 干预效果对比（进展速度 + 自助法置信区间） ==================
+EFFECT_METRICS = {
+    "眼轴": (["眼轴长度(L)", "眼轴长度(R)"], "mm/年"),
+    "SE": (["左眼_SE", "右眼_SE"], "D/年"),
+}
+BOOTSTRAP_N = 2000
+BOOTSTRAP_MAX_CELLS = 4_000_000  # 单次重抽样矩阵 (批次 × 点数) 的上限，控制内存
+
+
+def _centered_points(df: pd.DataFrame, mask: pd.Series, cols: list):
+    """取 mask 内的检查点，按 (儿童, 眼别) 分组中心化 —— 合并多个孩子时只比较各自内部的变化速度。"""
+    t_all = _years(df["日期"])
+    child = child_keys(df)
+    ts, ys = [], []
+    for eye, c in enumerate(cols):
+        y = to_numeric(df[c])
+        m = mask & y.notna() & df["日期"].notna()
+        if not m.any():
+            continue
+        g = child[m] + f"|{eye}"
+        t, yy = t_all[m], y[m]
+        ts.append((t - t.groupby(g).transform("mean")).to_numpy())
+        ys.append((yy - yy.groupby(g).transform("mean")).to_numpy())
+    if not ts:
+        return np.empty(0), np.empty(0)
+    return np.concatenate(ts), np.concatenate(ys)
+
+
+def bootstrap_slope(t: np.ndarray, y: np.ndarray, rng, n_boot: int = BOOTSTRAP_N):
+    """年化速度（合并组内斜率）及其自助法分布：整批下标矩阵一次性重抽样，不逐次循环。"""
+    n = len(t)
+    if n < 3 or float((t * t).sum()) <= 1e-9:
+        return np.nan, np.full(n_boot, np.nan)
+    est = float((t * y).sum() / (t * t).sum())
+    boot = np.empty(n_boot)
+    step = max(1, BOOTSTRAP_MAX_CELLS // n)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for a in range(0, n_boot, step):
+            idx = rng.integers(0, n, size=(min(step, n_boot - a), n))
+            tt = t[idx]
+            boot[a:a + len(idx)] = (tt * y[idx]).sum(axis=1) / (tt * tt).sum(axis=1)
+    boot[~np.isfinite(boot)] = np.nan
+    return est, boot
+
+
+def _ci(boot: np.ndarray):
+    if np.isnan(boot).all():
+        return np.nan, np.nan
+    lo, hi = np.nanpercentile(boot, [2.5, 97.5])
+    return round(float(lo), 3), round(float(hi), 3)
+
+
+def intervention_effects(df: pd.DataFrame, n_boot: int = BOOTSTRAP_N, seed: int = 0):
+    """阶段进展速度（含较上一阶段的变化）与各干预“使用前 vs 使用中”的速度差，均附 95% 自助法区间。
+
+    每个队列（阶段/干预 × 指标）独立重抽样，用线程池并行计算。返回 (阶段表, 干预表)。
+    """
+    if df.empty:
+        return pd.DataFrame(), pd.DataFrame()
+    df = df.reset_index(drop=True)
+    stage = df["阶段名称"].fillna("未匹配阶段")
+    stage_order = df.groupby(stage)["日期"].min().sort_values().index.tolist()
+    child = child_keys(df)
+
+    cohorts = []  # (类别, 名称, 指标, mask)
+    for name in stage_order:
+        for metric in EFFECT_METRICS:
+            cohorts.append(("stage", name, metric, stage == name))
+    for name, flag, _, _ in INTERVENTIONS:
+        used = yes_mask(df[flag])
+        if not used.any():
+            continue
+        first_use = df["日期"].where(used).groupby(child).transform("min")
+        before = ~used & first_use.notna() & (df["日期"] < first_use)
+        for metric in EFFECT_METRICS:
+            cohorts.append(("before", name, metric, before))
+            cohorts.append(("on", name, metric, used))
+
+    def run(i):
+        kind, name, metric, mask = cohorts[i]
+        t, y = _centered_points(df, mask, EFFECT_METRICS[metric][0])
+        est, boot = bootstrap_slope(t, y, np.random.default_rng([seed, i]), n_boot)
+        return (kind, name, metric), (len(t), est, boot)
+
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as pool:
+        res = dict(pool.map(run, range(len(cohorts))))
+
+    stage_rows, prev = [], {}
+    for name in stage_order:
+        for metric, (_, unit) in EFFECT_METRICS.items():
+            n, est, boot = res[("stage", name, metric)]
+            row = {"阶段": name, "指标": metric, "单位": unit, "点数": n,
+                   "年化速度": None if np.isnan(est) else round(est, 3)}
+            row["95%CI下限"], row["95%CI上限"] = _ci(boot)
+            p = prev.get(metric)
+            if p is not None and not np.isnan(est) and not np.isnan(p[0]):
+                row["较上一阶段变化"] = round(est - p[0], 3)
+                row["变化CI下限"], row["变化CI上限"] = _ci(boot - p[1])
+            stage_rows.append(row)
+            prev[metric] = (est, boot)
+
+    inter_rows = []
+    for name, _, _, _ in INTERVENTIONS:
+        for metric, (_, unit) in EFFECT_METRICS.items():
+            if ("on", name, metric) not in res:
+                continue
+            n0, e0, b0 = res[("before", name, metric)]
+            n1, e1, b1 = res[("on", name, metric)]
+            row = {"干预": name, "指标": metric, "单位": unit,
+                   "使用前点数": n0, "使用前速度": None if np.isnan(e0) else round(e0, 3),
+                   "使用中点数": n1, "使用中速度": None if np.isnan(e1) else round(e1, 3)}
+            if not (np.isnan(e0) or np.isnan(e1)):
+                row["差值(中-前)"] = round(e1 - e0, 3)
+                row["差值CI下限"], row["差值CI上限"] = _ci(b1 - b0)
+            inter_rows.append(row)
+    return pd.DataFrame(stage_rows), pd.DataFrame(inter_rows)
+
+
+@st.cache_data(max_entries=8, show_spinner="正在计算进展速度与置信区间…")
+def cached_effects(fp: str, child, _df: pd.DataFrame):
+    """fp（_df 对应的数据指纹，包含归档时带上归档年份）+ child 为缓存键。"""
+    return intervention_effects(_df)
+
+
+# ================== 数据质量检查（跨字段一致性，向量化一次扫描） ==================
+EYES = (("右眼", "OD"), ("左眼", "OS"))
+AXIAL_COLUMNS = {"OD": "眼轴长度(R)", "OS": "眼轴长度(L)"}
+QUALITY_RULES = {
+    "SE≠S+C/2": "等效球镜与球镜 + 柱镜/2 相差超过 0.25D",
+    "K值mm/D不符": "角膜曲率半径与屈光力不符（D ≈ 337.5 / r，相差超过 0.25D）",
+    "眼轴跳变": "与同一孩子上一次检查相比眼轴变化超过 0.5mm",
+    "疑似左右眼填反": "左右互换后与上一次检查明显更接近（眼轴或 SE）",
+    "数值超范围": "眼轴 18–32mm、SE -25~+15D、K 值 35–55D 之外",
+}
+QUALITY_COLUMNS = ["日期", "儿童"] + list(AXIAL_COLUMNS.values()) + [
+    f"{eye}_{c}" for eye, _ in EYES for c in ("S", "C", "SE", "K1(mm)", "K1(D)", "K2(mm)", "K2(D)")
+]
+SE_TOLERANCE = 0.25
+K_TOLERANCE = 0.25
+AXIAL_JUMP_MM = 0.5
+SWAP_MARGIN = {"眼轴": 0.3, "SE": 0.75}  # 互换后总偏差至少减少这么多才提示
+QUALITY_RANGES = {"眼轴": (18.0, 32.0), "SE": (-25.0, 15.0), "K": (35.0, 55.0)}
+
+
+def quality_flags(df: pd.DataFrame) -> pd.DataFrame:
+    """对整表一次性跑完全部一致性规则（每条规则都是列运算），返回被标记的 (行, 规则, 眼别, 详情, 偏差)。"""
+    out_cols = ["行", "日期", "儿童", "规则", "眼别", "详情", "偏差"]
+    if df.empty:
+        return pd.DataFrame(columns=out_cols)
+    num = {c: to_numeric(df[c]).astype(float) if c in df.columns else pd.Series(np.nan, index=df.index)
+           for c in QUALITY_COLUMNS[2:]}
+    child = child_keys(df)
+    # 上一次 / 下一次检查：同一孩子按日期排序后的相邻行
+    order = df["日期"].sort_values(kind="stable").index
+    groups = {c: v.loc[order].groupby(child.loc[order]) for c, v in num.items()}
+    prev = {c: g.shift(1).reindex(df.index) for c, g in groups.items()}
+    nxt = {c: g.shift(-1).reindex(df.index) for c, g in groups.items()}
+
+    parts = []
+
+    def flag(rule, eye, mask, detail, dev):
+        mask = mask.fillna(False)
+        if mask.any():
+            parts.append(pd.DataFrame({"行": df.index[mask], "规则": rule, "眼别": eye,
+                                       "详情": detail[mask], "偏差": dev[mask].round(2)}))
+
+    signed = lambda v: v.map("{:+.2f}".format)
+    for eye, tag in EYES:
+        s_, c_, se = num[f"{eye}_S"], num[f"{eye}_C"], num[f"{eye}_SE"]
+        dev = se - (s_ + c_.fillna(0) / 2)
+        flag("SE≠S+C/2", tag, dev.abs() > SE_TOLERANCE + 1e-9,
+             "SE " + signed(se) + "，S+C/2 " + signed(s_ + c_.fillna(0) / 2), dev)
+        for k in ("K1", "K2"):
+            r, d = num[f"{eye}_{k}(mm)"], num[f"{eye}_{k}(D)"]
+            dev = d - KERATOMETRY_INDEX / r.where(r > 0)
+            flag("K值mm/D不符", tag, dev.abs() > K_TOLERANCE + 1e-9,
+                 f"{k} " + r.map("{:.2f}mm".format) + " → " + (KERATOMETRY_INDEX / r).map("{:.2f}D".format) + "，记录 " + d.map("{:.2f}D".format), dev)
+            lo, hi = QUALITY_RANGES["K"]
+            flag("数值超范围", tag, (d < lo) | (d > hi), f"{k} " + d.map("{:.2f}D".format), d)
+        al = num[AXIAL_COLUMNS[tag]]
+        dev = al - prev[AXIAL_COLUMNS[tag]]
+        flag("眼轴跳变", tag, dev.abs() > AXIAL_JUMP_MM,
+             "上次 " + prev[AXIAL_COLUMNS[tag]].map("{:.2f}".format) + " → 本次 " + al.map("{:.2f}".format), dev)
+        for name, v in (("眼轴", al), ("SE", se)):
+            lo, hi = QUALITY_RANGES[name]
+            flag("数值超范围", tag, (v < lo) | (v > hi), f"{name} " + v.map("{:.2f}".format), v)
+
+    for name, (od, os_) in {"眼轴": (AXIAL_COLUMNS["OD"], AXIAL_COLUMNS["OS"]), "SE": ("右眼_SE", "左眼_SE")}.items():
+        # 互换后与前后两次都更接近才提示，避免把填反那一行的下一次误判为填反
+        gain = {}
+        for side, ref in (("prev", prev), ("next", nxt)):
+            same = (num[od] - ref[od]).abs() + (num[os_] - ref[os_]).abs()
+            swap = (num[od] - ref[os_]).abs() + (num[os_] - ref[od]).abs()
+            gain[side] = same - swap
+        ok_next = gain["next"].isna() | (gain["next"] > SWAP_MARGIN[name])
+        flag("疑似左右眼填反", "OU", (gain["prev"] > SWAP_MARGIN[name]) & ok_next,
+             f"{name} 右/左 " + num[od].map("{:.2f}".format) + "/" + num[os_].map("{:.2f}".format)
+             + "，上次 " + prev[od].map("{:.2f}".format) + "/" + prev[os_].map("{:.2f}".format), gain["prev"])
+
+    if not parts:
+        return pd.DataFrame(columns=out_cols)
+    res = pd.concat(parts, ignore_index=True)
+    res["日期"] = df.loc[res["行"], "日期"].to_numpy()
+    res["儿童"] = child.loc[res["行"]].to_numpy()
+    return res[out_cols].sort_values(["日期", "规则"], ignore_index=True)
+
+
+@st.cache_data(max_entries=4, show_spinner="正在检查数据质量…")
+def cached_quality(fp: str) -> pd.DataFrame:
+    """按数据版本（文件指纹）缓存的整库质量扫描；只读规则用到的列。分片存储时按分片并行扫描。"""
+    if sharded():
+        return batch_quality()
+    return quality_flags(load_data(QUALITY_COLUMNS))
+
+
+# ================== 干预暴露时间轴（游程编码） ==================
+def _weekly_dose(df: pd.DataFrame, name: str) -> pd.Series:
+    """每条记录登记的每周剂量（已乘依从性）；频次没填时按 0 计剂量，但仍计入暴露时间。"""
+    def num(c, default=np.nan):
+        return to_numeric(df[c]).fillna(default)
+
+    if name == "阿托品":
+        dose = num("阿托品_每周次数", 0)
+    elif name == "防控眼镜":
+        dose = num("防控眼镜_每天佩戴时长(h)", 0) * num("防控眼镜_每周天数", 7)
+    elif name == "捕光仪":
+        dose = num("捕光仪_每天时长(min)", 0) * num("捕光仪_每周天数", 7)
+    elif name == "七叶洋地参":
+        dose = num("七叶洋地参_每日次数", 0) * 7
+    elif name == "翻转拍":
+        dose = num("翻转拍_每周次数", 0) * num("翻转拍_每次分钟", 0)
+    else:
+        dose = num("其它干预_每周次数", 0) * num("其它干预_每次分钟", 0)
+    adh = INTERVENTIONS_BY_NAME[name][3]
+    return dose * (num(adh[0], 100) / 100 if adh else 1)
+
+
+INTERVENTIONS_BY_NAME = {x[0]: x for x in INTERVENTIONS}
+# 剂量单位（每周剂量换算口径，见 _weekly_dose）
+EXPOSURE_UNITS = {"阿托品": "次", "防控眼镜": "小时", "捕光仪": "分钟", "七叶洋地参": "次", "翻转拍": "分钟", "其它": "分钟"}
+EXPOSURE_COLUMNS = [f"{name}_{kind}" for name in EXPOSURE_UNITS for kind in ("累计周数", "累计剂量")]
+# 计算暴露特征需要的源列（投影读取时缺任一列就不计算）
+EXPOSURE_SOURCES = ["日期", "儿童"] + TREAT_COLUMNS
 
-            f1 = to_numeric(used[freq_cols[0]]).mean() if len(freq_cols) >= 1 and freq_cols[0] in used.columns else None
-            f2 = to_numeric(used[freq_cols[1]]).mean() if len(freq_cols) >= 2 and freq_cols[1] in used.columns else None
 
-            rows.append({
-                "阶段": stage,
-                "干预": name,
-                "记录次数": int(len(used)),
-                "平均依从性(%)": None if adh is None or pd.isna(adh) else round(float(adh), 1),
-                "频次/时长均值1": None if f1 is None or pd.isna(f1) else round(float(f1), 2),
-                "频次/时长均值2": None if f2 is None or pd.isna(f2) else round(float(f2), 2),
-                "使用时平均视力(左右均值)": None if v_avg.dropna().empty else round(float(v_avg.mean()), 2),
-                "使用时平均SE(左右均值)": None if se_avg.dropna().empty else round(float(se_avg.mean()), 2),
-            })
-    return pd.DataFrame(rows)
+def _days(series: pd.Series) -> np.ndarray:
+    return pd.to_datetime(series).to_numpy("datetime64[D]").astype(np.int64)
+
+
+class ExposureTimeline:
+    """把每次检查登记的干预起止日期/频次展开成每个孩子、每种干预的连续暴露游程。
+
+    每条游程为 [开始日, 结束日) + 日剂量；区间重叠时以较早一次检查的登记为准（每次登记的用法沿用到下一次检查）。
+    结束日期没填的，视为持续到该孩子的下一次检查（最后一次检查则到今天）。
+    累计查询用前缀和 + 二分查找，批量日期一次完成。
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.runs = {}  # (儿童, 干预) -> (starts, stops, rate, cum_days, cum_dose)
+        if df.empty:
+            return
+        d = df.dropna(subset=["日期"]).copy()
+        d["_child"] = child_keys(d)
+        d = d.sort_values(["_child", "日期"], kind="stable")
+        today = _days(pd.Series([pd.Timestamp.today().normalize()]))[0] + 1
+        exam = _days(d["日期"])
+        nxt = d.groupby("_child")["日期"].shift(-1)
+        nxt_day = np.where(nxt.notna(), _days(nxt.fillna(d["日期"])), today)
+
+        for name, flag, _, _ in INTERVENTIONS:
+            used = yes_mask(d[flag]).to_numpy()
+            if not used.any():
+                continue
+            start_col, end_col = f"{flag.split('_')[0]}_开始日期", f"{flag.split('_')[0]}_结束日期"
+            start = np.where(d[start_col].notna(), _days(d[start_col].fillna(d["日期"])), exam)
+            stop = np.where(d[end_col].notna(), _days(d[end_col].fillna(d["日期"])) + 1, nxt_day)
+            rate = (_weekly_dose(d, name) / 7).to_numpy()
+            ok = used & (stop > start)
+            for child, idx in d[ok].groupby("_child").indices.items():
+                rows = np.flatnonzero(ok)[idx]
+                # 重叠部分以较早一次检查的登记为准：优先级 = 检查日期越早越高
+                s0, s1, win = compile_segments(start[rows], stop[rows], -exam[rows], open_end=np.iinfo(np.int64).max)
+                r = rate[rows][win]
+                # 首尾相接且日剂量相同的游程合并
+                keep = np.ones(len(s0), dtype=bool)
+                keep[1:] = ~((s0[1:] == s1[:-1]) & (r[1:] == r[:-1]))
+                s0, r = s0[keep], r[keep]
+                s1 = np.maximum.reduceat(s1, np.flatnonzero(keep)) if len(s1) else s1
+                length = s1 - s0
+                self.runs[(child, name)] = (
+                    s0, s1, r,
+                    np.concatenate([[0], np.cumsum(length)]),
+                    np.concatenate([[0.0], np.cumsum(length * r)]),
+                )
+
+    def cumulative(self, child: str, name: str, dates) -> tuple:
+        """截至各日期（不含当天）的累计暴露天数与累计剂量。"""
+        d = _days(pd.Series(dates))
+        run = self.runs.get((child, name))
+        if run is None:
+            return np.zeros(len(d)), np.zeros(len(d))
+        s0, s1, r, cum_days, cum_dose = run
+        i = np.searchsorted(s0, d, side="right") - 1
+        j = np.clip(i, 0, None)
+        part = np.where(i >= 0, np.clip(np.minimum(d, s1[j]) - s0[j], 0, None), 0)
+        days = np.where(i >= 0, cum_days[j] + part, 0)
+        dose = np.where(i >= 0, cum_dose[j] + part * r[j], 0.0)
+        return days.astype(float), dose
+
+    def between(self, child: str, name: str, start, end) -> tuple:
+        """[start, end) 区间内的暴露天数与剂量。"""
+        days, dose = self.cumulative(child, name, [start, end])
+        return days[1] - days[0], dose[1] - dose[0]
+
+    def to_matrix(self, child: str, freq: str = "W") -> pd.DataFrame:
+        """展开为按日/周的暴露矩阵（行=时间，列=干预，值=剂量），仅在需要明细时才物化。"""
+        cols = {}
+        for (c, name), (s0, s1, r, _, _) in self.runs.items():
+            if c != child:
+                continue
+            days = np.concatenate([np.arange(a, b) for a, b in zip(s0, s1)])
+            cols[name] = pd.Series(np.repeat(r, s1 - s0), index=pd.to_datetime(days, unit="D"))
+        if not cols:
+            return pd.DataFrame()
+        return pd.DataFrame(cols).fillna(0.0).resample(freq).sum()
+
+
+def exposure_features(df: pd.DataFrame) -> dict:
+    """每条检查记录“本次检查前”的各干预累计周数与累计剂量：{列名: 数组}。"""
+    timeline = ExposureTimeline(df)
+    out = {c: np.zeros(len(df)) for c in EXPOSURE_COLUMNS}
+    children = child_keys(df)
+    for child, idx in df.groupby(children).indices.items():
+        dates = df["日期"].iloc[idx]
+        for name in EXPOSURE_UNITS:
+            days, dose = timeline.cumulative(child, name, dates)
+            out[f"{name}_累计周数"][idx] = np.round(days / 7, 1)
+            out[f"{name}_累计剂量"][idx] = np.round(dose, 1)
+    return out
 
 
 def safe_last_n_selector(label: str, df_in: pd.DataFrame, default_n: int = 10, min_n: int = 3, max_cap: int = 60):
@@ -432,6 +3011,8 @@ def a4_report_html(latest: pd.Series) -> str:
          "OS K2(mm/D/轴)", f"{fmt(g('左眼_K2(mm)'))}/{fmt(g('左眼_K2(D)'))}/{fmt(g('左眼_K2轴位'))}"),
         ("角膜CYL OD(D/轴)", f"{fmt(g('右眼角膜CYL(D)'))}/{fmt(g('右眼角膜CYL轴位'))}",
          "角膜CYL OS(D/轴)", f"{fmt(g('左眼角膜CYL(D)'))}/{fmt(g('左眼角膜CYL轴位'))}"),
+        ("AL/CR OD/OS", f"{fmt(g('右眼_AL/CR'))}/{fmt(g('左眼_AL/CR'))}",
+         "J0/J45 OD·OS(D)", f"{fmt(g('右眼_J0'))}/{fmt(g('右眼_J45'))} · {fmt(g('左眼_J0'))}/{fmt(g('左眼_J45'))}"),
     ]
 
     # WTW/厚度/瞳孔
@@ -508,8 +3089,1516 @@ def a4_report_html(latest: pd.Series) -> str:
     return html
 
 
+# ================== 数据导出（英文字段 / FHIR Observation，流式写出） ==================
+EXPORT_DIR = "exports"
+EXPORT_STATE_FILE = os.path.join(EXPORT_DIR, "watermarks.json")
+EXPORT_FORMATS = {"jsonl": "jsonl", "fhir": "ndjson", "parquet": "parquet"}
+EXPORT_SALT_ENV = "EYE_EXPORT_SALT"
+EXPORT_DATE_SHIFT_DAYS = 180  # 去标识化时每个孩子固定平移 [-180, 180] 天，同一孩子内的间隔不变
+EXPORT_CODE_SYSTEM = "urn:children-eye-trend:observation"  # 本地观察项编码（未对应到 LOINC）
+EXPORT_SUBJECT_SYSTEM = "urn:children-eye-trend:child"
+EXPORT_BODY_SITES = {
+    "od": {"system": "http://snomed.info/sct", "code": "18944008", "display": "Right eye structure"},
+    "os": {"system": "http://snomed.info/sct", "code": "8966001", "display": "Left eye structure"},
+}
+
+# 中文列 -> (英文字段, UCUM 单位, 类别)。类别：id / date / timestamp / measure（数值检查项，导出为 Observation）/
+# number / flag / value（短文本）/ code（机构内标识，去标识化时换成加盐假名）/ text（自由文本，去标识化时丢弃）。
+# 站点、阶段名称与主方案是工作人员手填的，可能带人名；阶段ID 里有真实日期。字段名一经发布不再改动。
+EXPORT_FIELDS = {
+    "日期": ("exam_date", None, "date"),
+    "儿童": ("child_id", None, "id"),
+    "站点": ("site_id", None, "code"),
+    "阶段ID": ("stage_id", None, "code"),
+    "阶段名称": ("stage_name", None, "text"),
+    "阶段主方案": ("stage_plan", None, "text"),
+    "左眼视力": ("va_decimal_os", "1", "measure"),
+    "右眼视力": ("va_decimal_od", "1", "measure"),
+    "左眼_logMAR": ("va_logmar_os", "1", "measure"),
+    "右眼_logMAR": ("va_logmar_od", "1", "measure"),
+    "左眼远视储备": ("hyperopic_reserve_os", "[diop]", "measure"),
+    "右眼远视储备": ("hyperopic_reserve_od", "[diop]", "measure"),
+    "眼轴长度(L)": ("axial_length_os", "mm", "measure"),
+    "眼轴长度(R)": ("axial_length_od", "mm", "measure"),
+    "备注": ("note", None, "text"),
+    "录入时间": ("recorded_at", None, "timestamp"),
+    "PD(mm)": ("pupillary_distance", "mm", "measure"),
+    "立体视_Titmus(秒)": ("stereo_titmus", "''", "measure"),
+    "融合范围(°)": ("fusion_range", "deg", "measure"),
+    "他觉斜视角(°)": ("objective_deviation", "deg", "measure"),
+    "33cm_SC(°)": ("deviation_sc_33cm", "deg", "measure"),
+    "6m_SC(°)": ("deviation_sc_6m", "deg", "measure"),
+    "33cm_CC(°)": ("deviation_cc_33cm", "deg", "measure"),
+    "6m_CC(°)": ("deviation_cc_6m", "deg", "measure"),
+    "AC/A": ("ac_a_ratio", "1", "measure"),
+    "Amp_OD(D)": ("accommodation_amplitude_od", "[diop]", "measure"),
+    "Amp_OS(D)": ("accommodation_amplitude_os", "[diop]", "measure"),
+    "Amp_OU(D)": ("accommodation_amplitude_ou", "[diop]", "measure"),
+    "Flipper_OD(cpm)": ("flipper_rate_od", "/min", "measure"),
+    "Flipper_OS(cpm)": ("flipper_rate_os", "/min", "measure"),
+    "Flipper_OU(cpm)": ("flipper_rate_ou", "/min", "measure"),
+    "Flipper_备注": ("flipper_note", None, "text"),
+}
+# 分眼检查项：右眼/左眼 + 后缀
+_EYE_MEASURES = {
+    "_S": ("sphere", "[diop]"), "_C": ("cylinder", "[diop]"), "_A": ("cylinder_axis", "deg"),
+    "_SE": ("spherical_equivalent", "[diop]"),
+    "_K1(mm)": ("k1_radius", "mm"), "_K1(D)": ("k1_power", "[diop]"), "_K1轴位": ("k1_axis", "deg"),
+    "_K2(mm)": ("k2_radius", "mm"), "_K2(D)": ("k2_power", "[diop]"), "_K2轴位": ("k2_axis", "deg"),
+    "角膜CYL(D)": ("corneal_cylinder", "[diop]"), "角膜CYL轴位": ("corneal_cylinder_axis", "deg"),
+    "_WTW(mm)": ("white_to_white", "mm"),
+    "_角膜中央厚度(um)": ("central_corneal_thickness", "um"),
+    "_最薄角膜厚度(um)": ("thinnest_corneal_thickness", "um"),
+    "_最薄点位置(mm)": ("thinnest_point_position", "mm"),
+    "_瞳孔直径(mm)": ("pupil_diameter", "mm"),
+    "眼压(mmHg)": ("intraocular_pressure", "mm[Hg]"),
+    "_CR(mm)": ("mean_corneal_radius", "mm"), "_AL/CR": ("axial_length_corneal_radius_ratio", "1"),
+    "_M": ("power_vector_m", "[diop]"), "_J0": ("power_vector_j0", "[diop]"), "_J45": ("power_vector_j45", "[diop]"),
+    "_角膜J0": ("corneal_vector_j0", "[diop]"), "_角膜J45": ("corneal_vector_j45", "[diop]"),
+}
+for _suffix, (_name, _unit) in _EYE_MEASURES.items():
+    for _eye, _tag in (("右眼", "od"), ("左眼", "os")):
+        EXPORT_FIELDS[_eye + _suffix] = (f"{_name}_{_tag}", _unit, "measure")
+# 干预：前缀 + 后缀
+_TREAT_PREFIXES = {
+    "阿托品": "atropine", "防控眼镜": "myopia_control_lens", "捕光仪": "light_therapy",
+    "七叶洋地参": "qiye_yangdishen", "翻转拍": "flipper_training", "其它干预": "other_intervention",
+}
+_TREAT_SUFFIXES = {
+    "是否使用": ("used", None, "flag"), "是否训练": ("used", None, "flag"), "是否有": ("used", None, "flag"),
+    "浓度或规格": ("spec", None, "value"), "规格": ("spec", None, "value"),
+    "类型": ("type", None, "value"), "方案": ("protocol", None, "value"),
+    "频次文本": ("frequency_text", None, "text"), "内容": ("description", None, "text"),
+    "每周次数": ("times_per_week", "/wk", "number"), "每日次数": ("times_per_day", "/d", "number"),
+    "每天佩戴时长(h)": ("hours_per_day", "h/d", "number"), "每天时长(min)": ("minutes_per_day", "min/d", "number"),
+    "每周天数": ("days_per_week", "d/wk", "number"), "每次分钟": ("minutes_per_session", "min", "number"),
+    "开始日期": ("start_date", None, "date"), "结束日期": ("end_date", None, "date"),
+    "依从性(%)": ("adherence_pct", "%", "number"),
+    "副作用或不适": ("adverse_notes", None, "text"), "不适": ("adverse_notes", None, "text"),
+    "不适或反馈": ("adverse_notes", None, "text"), "反馈": ("adverse_notes", None, "text"),
+}
+for _col in TREAT_COLUMNS:
+    _prefix, _suffix = _col.split("_", 1)
+    _name, _unit, _kind = _TREAT_SUFFIXES[_suffix]
+    EXPORT_FIELDS[_col] = (f"{_TREAT_PREFIXES[_prefix]}_{_name}", _unit, _kind)
+
+assert set(EXPORT_FIELDS) == set(ALL_COLUMNS), "EXPORT_FIELDS 需覆盖全部列"
+
+
+def _pseudonym(salt: str, child: str, purpose: str = "id") -> bytes:
+    return hmac.new(salt.encode("utf-8"), f"{purpose}:{child}".encode("utf-8"), hashlib.sha256).digest()
+
+
+def export_frame(chunk: pd.DataFrame, salt: str = None) -> pd.DataFrame:
+    """把一块原始记录转成英文字段、类型统一的导出表；给了 salt 即去标识化。
+
+    去标识化：孩子、站点与阶段ID 换成加盐 HMAC 假名，所有日期按孩子固定平移（间隔不变），自由文本列丢弃。
+    """
+    out = {}
+    children = child_keys(chunk)
+    shift = None
+    if salt:
+        uniq = children.unique()
+        ids = {c: _pseudonym(salt, c).hex()[:16] for c in uniq}
+        span = 2 * EXPORT_DATE_SHIFT_DAYS + 1
+        days = {c: int.from_bytes(_pseudonym(salt, c, "shift")[:4], "big") % span - EXPORT_DATE_SHIFT_DAYS for c in uniq}
+        shift = pd.to_timedelta(children.map(days), unit="D")
+    for col, (name, _, kind) in EXPORT_FIELDS.items():
+        if salt and kind == "text":
+            continue
+        v = chunk[col] if col in chunk.columns else pd.Series(np.nan, index=chunk.index)
+        if kind == "id":
+            v = children.map(ids) if salt else children
+        elif kind == "code" and salt:
+            v = v.map(lambda x: x if pd.isna(x) else _pseudonym(salt, str(x), name).hex()[:16]).astype("string")
+        elif kind in ("date", "timestamp"):
+            v = pd.to_datetime(v, errors="coerce")
+            v = v + shift if shift is not None else v
+            v = v.dt.normalize() if kind == "date" else v
+        elif kind in ("measure", "number"):
+            v = to_numeric(v).astype(float)
+        elif kind == "flag":
+            v = yes_mask(v).astype("boolean").where(v.notna())
+        else:
+            v = v.astype("string")
+        out[name] = v
+    return pd.DataFrame(out, index=chunk.index)
+
+
+def fhir_observations(frame: pd.DataFrame) -> list:
+    """导出表 → FHIR R4 Observation 资源（每个有值的检查项一条）。"""
+    cols = {name: (col, unit) for col, (name, unit, kind) in EXPORT_FIELDS.items() if kind == "measure"}
+    long = frame[["child_id", "exam_date"] + list(cols)].melt(
+        id_vars=["child_id", "exam_date"], var_name="field", value_name="value"
+    ).dropna(subset=["exam_date", "value"])
+    resources = []
+    for child, date, field, value in long.itertuples(index=False):
+        col, unit = cols[field]
+        code, _, eye = field.rpartition("_")
+        if eye not in EXPORT_BODY_SITES:
+            code = field
+        day = date.strftime("%Y-%m-%d")
+        res = {
+            "resourceType": "Observation",
+            "id": hashlib.sha1(f"{child}|{day}|{field}".encode("utf-8")).hexdigest()[:32],
+            "status": "final",
+            "category": [{"coding": [{
+                "system": "http://terminology.hl7.org/CodeSystem/observation-category", "code": "exam"}]}],
+            "code": {"coding": [{"system": EXPORT_CODE_SYSTEM, "code": code, "display": col}]},
+            "subject": {"identifier": {"system": EXPORT_SUBJECT_SYSTEM, "value": child}},
+            "effectiveDateTime": day,
+            "valueQuantity": {"value": float(value), "unit": unit, "system": "http://unitsofmeasure.org", "code": unit},
+        }
+        if eye in EXPORT_BODY_SITES:
+            res["bodySite"] = {"coding": [EXPORT_BODY_SITES[eye]]}
+        resources.append(res)
+    return resources
+
+
+def _parquet_schema(columns):
+    """按字段类别固定 Parquet 列类型，保证各块（含整列为空的块）写出的类型一致。"""
+    types = {"date": pa.timestamp("ms"), "timestamp": pa.timestamp("ms"), "measure": pa.float64(),
+             "number": pa.float64(), "flag": pa.bool_()}
+    kinds = {name: kind for name, _, kind in EXPORT_FIELDS.values()}
+    return pa.schema([pa.field(n, types.get(kinds[n], pa.string())) for n in columns])
+
+
+def read_export_watermarks() -> dict:
+    """各 target 的水位线 {target: {"recorded": 录入时间, "hashes": [那一秒已导出记录的哈希]}}。"""
+    try:
+        with open(EXPORT_STATE_FILE, encoding="utf-8") as f:
+            marks = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # 旧格式只记时间
+    return {t: {"recorded": m, "hashes": []} if isinstance(m, str) else m for t, m in marks.items()}
+
+
+def export_records(fmt: str = "jsonl", salt: str = None, incremental: bool = False, target: str = "default") -> dict:
+    """分块流式导出（内存只占一块），写到 exports/ 下的新文件。
+
+    - fmt：jsonl（英文字段的平铺记录）/ fhir（FHIR Observation NDJSON）/ parquet（需要 pyarrow）
+    - incremental：只导出该 target 上次水位线之后录入的记录；成功写完后才推进水位线。
+      录入时间只精确到秒，水位线记下最晚的那一秒和这一秒已导出记录的哈希，下次按“≥ 这一秒”筛选再去掉这些记录，
+      同一秒里稍后保存的记录不会漏掉（录入时间在持写锁时才打上，导出读数据时也持写锁）。
+      没有录入时间的旧记录只在首次（无水位线）导出时带上。
+    """
+    if fmt == "parquet" and pa is None:
+        raise RuntimeError("导出 Parquet 需要安装 pyarrow")
+    marks = read_export_watermarks()
+    mark = marks.get(target) if incremental else None
+    since = pd.Timestamp(mark["recorded"]) if mark else None
+    seen = set(mark["hashes"]) if mark else set()
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"{target}-{datetime.now():%Y%m%d-%H%M%S}.{EXPORT_FORMATS[fmt]}")
+    tmp = f"{path}.tmp"
+
+    started = pd.Timestamp.now().floor("s")
+    rows, newest, newest_hashes, writer = 0, since, set(seen), None
+    with data_lock(), open(tmp, "wb") as f:  # 读的过程中持写锁：归档等写入不会让记录在热数据与归档之间挪动
+        # 归档按检查日期挑选，补录的旧检查可能录入后就被归档：增量导出也看归档，只跳过没有新录入的分区
+        for chunk in history_chunks(recorded_since=since):
+            recorded = pd.to_datetime(chunk["录入时间"], errors="coerce", format="mixed")
+            hashes = record_hashes(chunk).astype(str)
+            if since is not None:
+                keep = ((recorded >= since) & ~((recorded == since) & np.isin(hashes, list(seen)))).to_numpy()
+                chunk, recorded, hashes = chunk[keep], recorded[keep], hashes[keep]
+            if chunk.empty:
+                continue
+            if recorded.notna().any():
+                top = recorded.max()
+                at_top = set(hashes[(recorded == top).to_numpy()])
+                if newest is None or top > newest:
+                    newest, newest_hashes = top, at_top
+                elif top == newest:
+                    newest_hashes |= at_top
+            frame = export_frame(chunk, salt)
+            rows += len(frame)
+            if fmt == "jsonl":
+                body = frame.to_json(orient="records", lines=True, date_format="iso", force_ascii=False).encode("utf-8")
+                f.write(body if body.endswith(b"\n") else body + b"\n")
+            elif fmt == "fhir":
+                for res in fhir_observations(frame):
+                    f.write(json.dumps(res, ensure_ascii=False).encode("utf-8") + b"\n")
+            else:
+                table = pa.Table.from_pandas(frame, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(f, _parquet_schema(frame.columns), compression="zstd")
+                writer.write_table(table.cast(writer.schema))
+        if writer is not None:
+            writer.close()
+    os.replace(tmp, path)
+
+    # 没有任何带录入时间的记录时，以本次开始的那一秒为水位线（之后录入的记录下次导出）
+    newest = newest if newest is not None else started
+    if incremental:
+        marks[target] = {"recorded": newest.isoformat(), "hashes": sorted(newest_hashes)}
+        state_tmp = f"{EXPORT_STATE_FILE}.{os.getpid()}.tmp"
+        with open(state_tmp, "w", encoding="utf-8") as f:
+            json.dump(marks, f, ensure_ascii=False, indent=2)
+        os.replace(state_tmp, EXPORT_STATE_FILE)
+    return {"path": path, "rows": rows, "since": since, "watermark": newest}
+
+
+# ================== 复查提醒与依从性（批量调度） ==================
+# 每个孩子只看最近的检查：按日期排好序后一次取出每个孩子最后两条，向量化算出下次复查日期与依从性提醒，
+# 写成当天的摘要文件 digests/digest-YYYY-MM-DD.json，给本机的定时任务 / 提醒程序读取。
+# 定时运行示例（crontab）：0 7 * * * cd /数据目录 && python eye.py schedule --once
+DIGEST_DIR = "digests"
+SCHEDULE_DEFAULT_MONTHS = 3  # 阶段的医生建议里没写复查间隔时，默认 3 个月复查
+SCHEDULE_DUE_SOON_DAYS = 14
+ADHERENCE_ALERT_PCT = 70
+FREQUENCY_DROP = 0.3  # 处方频次比上次检查下降超过这个比例就提醒
+SCHEDULE_COLUMNS = ["日期", "儿童", "站点", "阶段ID", "阶段名称"] + [
+    c for _, flag, freq, adh in INTERVENTIONS for c in [flag] + freq + adh
+]
+DUE_COLUMNS = ["儿童", "站点", "最近检查", "阶段名称", "复查间隔", "间隔来源", "下次复查", "剩余天数", "状态"]
+ALERT_COLUMNS = ["儿童", "检查日期", "干预", "提醒", "详情"]
+
+_CN_DIGITS = {"零": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+_NUM = r"(\d+(?:\.\d+)?|[零一二两三四五六七八九十]+|半)"
+_UNIT = r"(个月|个星期|月|周|星期|天|日|年)"
+# “3个月复查”“半年后复诊”“3-6个月复查”（取较短的）/“复查间隔：2周”“随访每三个月”
+RECHECK_PATTERNS = [
+    re.compile(rf"(?:{_NUM}\s*[-~～到至]\s*)?{_NUM}\s*{_UNIT}\s*(?:后|左右|内)?\s*(?:再)?(?:复查|复诊|随访|回访|复测|检查)"),
+    re.compile(rf"(?:复查|复诊|随访|回访)\s*(?:间隔|周期|时间)?\s*(?:为|：|:)?\s*(?:每)?\s*(?:{_NUM}\s*[-~～到至]\s*)?{_NUM}\s*{_UNIT}"),
+]
+
+
+def _cn_number(text: str) -> float:
+    if text == "半":
+        return 0.5
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    if "十" in text:
+        tens, _, ones = text.partition("十")
+        return float(_CN_DIGITS.get(tens, 1) * 10 + _CN_DIGITS.get(ones, 0))
+    return float(_CN_DIGITS[text]) if text in _CN_DIGITS else np.nan
+
+
+def parse_recheck_interval(advice):
+    """从医生建议里找复查间隔，返回 (月数, 天数)；没写时返回 None。"""
+    if not isinstance(advice, str):
+        return None
+    for pat in RECHECK_PATTERNS:
+        m = pat.search(advice)
+        if not m:
+            continue
+        n, unit = _cn_number(m.group(1) or m.group(2)), m.group(3)
+        if not n > 0:
+            continue
+        if unit == "年":
+            return int(round(n * 12)), 0
+        if unit.endswith("月"):
+            return int(n), int(round(n % 1 * 30))
+        return 0, int(round(n * (1 if unit in ("天", "日") else 7)))
+    return None
+
+
+def _interval_text(months: int, days: int) -> str:
+    if months == 0 and days and days % 7 == 0:
+        return f"{days // 7}周"
+    return (f"{months}个月" if months else "") + (f"{days}天" if days else "")
+
+
+def latest_records(df: pd.DataFrame, n: int = 1) -> pd.DataFrame:
+    """每个孩子最近 n 次检查：按 (儿童, 日期) 排好序后一次取出，不逐个孩子循环。"""
+    d = df.dropna(subset=["日期"])
+    d = d.assign(儿童=child_keys(d)).sort_values(["儿童", "日期"], kind="stable")
+    return d.groupby("儿童", sort=False).tail(n)
+
+
+def schedule_due(latest: pd.DataFrame, stages_df: pd.DataFrame, today) -> pd.DataFrame:
+    """每个孩子的下次复查日期：间隔取最近一次检查所在阶段的医生建议，没写时用默认间隔。"""
+    if latest.empty:
+        return pd.DataFrame(columns=DUE_COLUMNS)
+    today = pd.Timestamp(today).normalize()
+    advice = stages_df.get("医生建议", pd.Series(index=stages_df.index, dtype=object))
+    by_stage = {str(sid): parse_recheck_interval(text) for sid, text in zip(stages_df["阶段ID"], advice)}
+    parsed = latest["阶段ID"].astype(str).map(by_stage)
+    from_advice = parsed.notna()
+    months = parsed.map(lambda x: x[0], na_action="ignore").fillna(SCHEDULE_DEFAULT_MONTHS).astype(int)
+    days = parsed.map(lambda x: x[1], na_action="ignore").fillna(0).astype(int)
+
+    due = pd.Series(pd.NaT, index=latest.index, dtype="datetime64[ns]")
+    for (m, d), idx in latest.groupby([months, days]).groups.items():  # 间隔只有少数几种，按间隔整组加
+        due[idx] = latest.loc[idx, "日期"] + pd.DateOffset(months=int(m), days=int(d))
+    left = (due - today).dt.days
+    out = pd.DataFrame({
+        "儿童": latest["儿童"],
+        "站点": site_keys(latest).replace("_", ""),
+        "最近检查": latest["日期"].dt.date,
+        "阶段名称": latest["阶段名称"].fillna("未匹配阶段"),
+        "复查间隔": [_interval_text(m, d) for m, d in zip(months, days)],
+        "间隔来源": np.where(from_advice, "医生建议", "默认"),
+        "下次复查": due.dt.date,
+        "剩余天数": left,
+        "状态": np.select([left < 0, left <= SCHEDULE_DUE_SOON_DAYS], ["已逾期", "即将到期"], "未到期"),
+    })
+    return out.sort_values(["剩余天数", "儿童"], ignore_index=True)
+
+
+def adherence_alerts(recent: pd.DataFrame) -> pd.DataFrame:
+    """最近一次检查里仍在使用、但依从性偏低或处方频次比上次检查明显下降的干预。"""
+    if recent.empty:
+        return pd.DataFrame(columns=ALERT_COLUMNS)
+    prev = recent.groupby("儿童", sort=False).shift(1)
+    last = recent.groupby("儿童", sort=False).tail(1)
+    prev = prev.loc[last.index]
+    parts = []
+    for name, flag, _, adh in INTERVENTIONS:
+        using = yes_mask(last[flag])
+        if not using.any():
+            continue
+        unit = EXPOSURE_UNITS[name]
+        pct = to_numeric(last[adh[0]])
+        low = using & (pct < ADHERENCE_ALERT_PCT)
+        # 比较的是处方频次（不乘依从性）
+        now = _weekly_dose(last.assign(**{adh[0]: np.nan}), name)
+        before = _weekly_dose(prev.assign(**{adh[0]: np.nan}), name).where(yes_mask(prev[flag]))
+        drop = using & (now > 0) & (before > 0) & (now < before * (1 - FREQUENCY_DROP))
+        for mask, kind, detail in (
+            (low, "依从性低", [f"依从性 {p:g}%（低于 {ADHERENCE_ALERT_PCT}%）" for p in pct[low]]),
+            (drop, "频次下降", [f"每周 {b:g} → {n:g} {unit}" for b, n in zip(before[drop], now[drop])]),
+        ):
+            if mask.any():
+                parts.append(pd.DataFrame({"儿童": last.loc[mask, "儿童"], "检查日期": last.loc[mask, "日期"].dt.date,
+                                           "干预": name, "提醒": kind, "详情": detail}))
+    if not parts:
+        return pd.DataFrame(columns=ALERT_COLUMNS)
+    return pd.concat(parts, ignore_index=True).sort_values(["儿童", "干预"], ignore_index=True)
+
+
+def build_schedule(today=None, processes: int = None) -> dict:
+    """全库调度：各分片并行取出每个孩子最近两次检查，合并后一次算出复查日期与提醒。
+
+    热数据里已经没有记录的孩子（最近一次检查早于归档期限，正是逾期最久的）从归档里补上他的最近检查。
+    """
+    today = pd.Timestamp(today if today is not None else pd.Timestamp.today()).normalize()
+    parts = [p for p in shard_map("schedule", processes) if not p.empty]
+    if archive_manifest():
+        hot = set().union(*(p["儿童"] for p in parts))
+        old = load_archive(SCHEDULE_COLUMNS, stages_df=load_stages())
+        old = old[~child_keys(old).isin(hot)]
+        if not old.empty:
+            parts.append(latest_records(old, 2))
+    recent = latest_records(pd.concat(parts, ignore_index=True) if parts else ensure_columns(pd.DataFrame(), SCHEDULE_COLUMNS), 2)
+    latest = recent.groupby("儿童", sort=False).tail(1)
+    return {"date": today, "due": schedule_due(latest, load_stages(), today), "alerts": adherence_alerts(recent)}
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def cached_schedule(fp: str, today: str) -> dict:
+    """按数据 + 阶段表版本与日期缓存的调度结果；fp 只作缓存键。"""
+    return build_schedule(today)
+
+
+def digest_path(today, out_dir: str = DIGEST_DIR) -> str:
+    return os.path.join(out_dir, f"digest-{pd.Timestamp(today):%Y-%m-%d}.json")
+
+
+def write_digest(schedule: dict, out_dir: str = DIGEST_DIR) -> str:
+    """写出当天摘要（已逾期 / 即将到期的复查 + 依从性提醒）；先写临时文件再替换，读取方不会读到半个文件。"""
+    due, alerts = schedule["due"], schedule["alerts"]
+    todo = due[due["状态"] != "未到期"]
+    digest = {
+        "date": f"{schedule['date']:%Y-%m-%d}",
+        "generated": datetime.now().isoformat(timespec="seconds"),
+        "counts": {"儿童": len(due), "已逾期": int((due["状态"] == "已逾期").sum()),
+                   "即将到期": int((due["状态"] == "即将到期").sum()), "依从性提醒": len(alerts)},
+        "due": todo.astype(object).where(todo.notna(), None).to_dict("records"),
+        "alerts": alerts.astype(object).where(alerts.notna(), None).to_dict("records"),
+    }
+    os.makedirs(out_dir, exist_ok=True)
+    path = digest_path(schedule["date"], out_dir)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(digest, f, ensure_ascii=False, indent=1, default=str)
+    os.replace(tmp, path)
+    return path
+
+
+# ================== 分片批处理（进程池按分片并行） ==================
+# 任务名 -> 需要读的列；每个分片一个任务，在工作进程里只读自己的分片，结果回到主进程合并
+SHARD_JOBS = {
+    "summary": SUMMARY_COLS,
+    "quality": QUALITY_COLUMNS,
+    "reports": ALL_COLUMNS,
+    "schedule": SCHEDULE_COLUMNS,
+}
+REPORT_DIR = "reports"
+
+
+def _shard_task(job: str, path: str, stages_df: pd.DataFrame):
+    """处理一个分片（在工作进程里运行）。"""
+    df = assign_stages(_load_files([path], project_columns(SHARD_JOBS[job])), as_timeline(stages_df))
+    if job == "summary":
+        acc = StageInterventionAccumulator()
+        acc.update(df)
+        return acc
+    if job == "quality":
+        flags = quality_flags(df)
+        flags.insert(0, "分片", os.path.relpath(path, SHARD_DIR) if path != CSV_FILE else path)
+        return flags
+    if job == "schedule":
+        return latest_records(df, 2)
+    latest = df.dropna(subset=["日期"]).sort_values("日期").groupby(child_keys(df), sort=False).tail(1)
+    return [(child_keys(latest)[i], latest.at[i, "日期"], a4_report_html(latest.loc[i])) for i in latest.index]
+
+
+def shard_map(job: str, processes: int = None) -> list:
+    """按分片把任务分发到进程池，返回各分片的结果（单文件存储时只有一个任务）。
+
+    页面里运行时脚本不是可导入的模块，子进程拿不到任务函数，改用线程池。
+    """
+    files = [p for p in data_files() if os.path.exists(data_physical_path(p))]
+    stages_df = load_stages()
+    if len(files) <= 1:
+        return [_shard_task(job, path, stages_df) for path in files]
+    workers = processes or min(len(files), os.cpu_count() or 1)
+    executor = ThreadPoolExecutor if running_in_streamlit() else ProcessPoolExecutor
+    with executor(max_workers=workers) as pool:
+        return list(pool.map(_shard_task, [job] * len(files), files, [stages_df] * len(files),
+                             chunksize=max(1, len(files) // (workers * 4))))
+
+
+def batch_summary(processes: int = None) -> pd.DataFrame:
+    """全库阶段×干预汇总：各分片的累加器合并后出结果。"""
+    acc = StageInterventionAccumulator()
+    for part in shard_map("summary", processes):
+        acc.merge(part)
+    return acc.result()
+
+
+def batch_quality(processes: int = None) -> pd.DataFrame:
+    """全库数据质量扫描（每个孩子的前后两次检查都在同一分片内，按分片扫描结果不变）。"""
+    parts = [p for p in shard_map("quality", processes) if not p.empty]
+    if not parts:
+        return pd.DataFrame(columns=["分片", "行", "日期", "儿童", "规则", "眼别", "详情", "偏差"])
+    return pd.concat(parts, ignore_index=True).sort_values(["日期", "规则"], ignore_index=True)
+
+
+def batch_reports(processes: int = None, out_dir: str = REPORT_DIR) -> list:
+    """每个孩子最近一次检查的 A4 报告各写一个 HTML 文件，返回文件路径。"""
+    latest = {}
+    for part in shard_map("reports", processes):
+        for child, when, html in part:
+            if child not in latest or when > latest[child][0]:
+                latest[child] = (when, html)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for child, (_, html) in sorted(latest.items()):
+        path = os.path.join(out_dir, f"{_slug(child)}.html")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f'<!doctype html><html><head><meta charset="utf-8"><title>{child}</title></head><body>{html}</body></html>')
+        paths.append(path)
+    return paths
+
+
+# ================== 压力测试（多会话模拟） ==================
+# 每个模拟会话用 AppTest 驱动本页面，数据放在临时目录（真实档案的副本或合成数据）里，不动原文件。
+# 默认所有会话作为线程跑在同一个进程里，和一个 Streamlit 服务器一样共享缓存、写锁、后台重算与版本号；
+# 指定进程数时每个会话一个进程，模拟多个服务器 / 命令行同时写同一份数据（只靠数据目录里的文件锁互斥）。
+LOADTEST_TABS = ["📈 趋势", "🧩 阶段×干预汇总", "🧾 最近一次明细清单", "📑 全部数据", "🩺 数据质量"]
+LOADTEST_MIX = {"browse": 0.6, "filter": 0.3, "entry": 0.1}
+LOADTEST_RUN_TIMEOUT = 300
+
+
+def synthetic_records(n: int, children=(DEFAULT_CHILD,), seed: int = 0) -> pd.DataFrame:
+    """合成检查记录（每个孩子约每 3 个月一次，视力/SE/眼轴随时间缓慢变化），用于压力测试。"""
+    rng = np.random.default_rng(seed)
+    child = np.resize(np.asarray(children, dtype=object), n)
+    k = np.arange(n) // len(children)
+    t = k * 0.25
+    df = pd.DataFrame({
+        "日期": pd.Timestamp("2018-01-01") + pd.to_timedelta(k * 91 + rng.integers(0, 10, n), unit="D"),
+        "儿童": np.where(child == DEFAULT_CHILD, None, child),
+        "左眼视力": np.clip(np.round(1.0 - 0.05 * t + rng.normal(0, 0.1, n), 1), 0.1, 2.0),
+        "右眼视力": np.clip(np.round(1.0 - 0.05 * t + rng.normal(0, 0.1, n), 1), 0.1, 2.0),
+        "左眼远视储备": np.round(1.0 - 0.2 * t + rng.normal(0, 0.1, n), 2),
+        "右眼远视储备": np.round(1.0 - 0.2 * t + rng.normal(0, 0.1, n), 2),
+        "眼轴长度(L)": np.round(23.0 + 0.25 * t + rng.normal(0, 0.03, n), 2),
+        "眼轴长度(R)": np.round(23.1 + 0.25 * t + rng.normal(0, 0.03, n), 2),
+        "左眼_SE": np.round(-0.5 - 0.4 * t + rng.normal(0, 0.1, n), 2),
+        "右眼_SE": np.round(-0.5 - 0.4 * t + rng.normal(0, 0.1, n), 2),
+        "阿托品_是否使用": t > 1,
+        "阿托品_每周次数": np.where(t > 1, 7, np.nan),
+        "阿托品_依从性(%)": np.where(t > 1, 90, np.nan),
+    })
+    return ensure_columns(df.sort_values("日期", kind="stable"))
+
+
+def synthetic_stages() -> pd.DataFrame:
+    return normalize_stages(pd.DataFrame([
+        {"阶段ID": "20180101-01", "阶段名称": "观察期", "开始日期": "2018-01-01", "结束日期": "2018-12-31",
+         "主方案": "观察", "是否启用": True},
+        {"阶段ID": "20190101-01", "阶段名称": "阿托品", "开始日期": "2019-01-01", "主方案": "0.01%阿托品", "是否启用": True},
+    ]))
+
+
+def _max_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:  # Windows 没有 resource 模块
+        return float("nan")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+def _loadtest_session(session_id: int, data_dir: str, steps: int, mix: dict, seed: int) -> dict:
+    """一个模拟会话：打开页面后按比例随机浏览 / 过滤 / 录入，记录每次重跑耗时。"""
+    from streamlit.testing.v1 import AppTest
+
+    os.chdir(data_dir)  # 线程模式下各会话目录相同，由 run_loadtest 事后切回
+    rng = np.random.default_rng(seed)
+    kinds, probs = list(mix), np.array(list(mix.values()), dtype=float)
+    base_rss = _max_rss_mb()
+    at = AppTest.from_file(os.path.abspath(__file__), default_timeout=LOADTEST_RUN_TIMEOUT)
+    timings, entries, errors, rejected = [], [], [], 0
+
+    def run(kind):
+        t0 = time.perf_counter()
+        at.run()
+        timings.append((kind, time.perf_counter() - t0))
+        errors.extend(e.message for e in at.exception)
+
+    run("open")
+    for step in range(steps):
+        kind = kinds[rng.choice(len(kinds), p=probs / probs.sum())]
+        if kind == "browse":
+            at.session_state["main_tabs"] = LOADTEST_TABS[rng.integers(len(LOADTEST_TABS))]
+        elif kind == "filter":
+            if at.session_state["main_tabs"] != LOADTEST_TABS[0]:
+                at.session_state["main_tabs"] = LOADTEST_TABS[0]
+                run("browse")
+            boxes = [w for w in at.selectbox if w.label == "阶段过滤"]
+            if boxes:
+                boxes[0].select(boxes[0].options[rng.integers(len(boxes[0].options))])
+        else:
+            tag = f"loadtest-{session_id}-{step}"
+            inputs = [w for w in at.text_input if w.label.startswith("儿童")]
+            buttons = [b for b in at.button if "保存记录" in b.label]
+            if not inputs or not buttons:
+                continue
+            inputs[0].input(tag)
+            buttons[0].click()
+        run(kind)
+        if kind == "entry":
+            if any("未重复保存" in e.value for e in at.error):
+                rejected += 1
+            else:
+                entries.append(f"loadtest-{session_id}-{step}")
+    return {
+        "session": session_id, "timings": timings, "entries": entries, "errors": errors,
+        "rejected": rejected, "rss_mb": _max_rss_mb(), "base_rss_mb": base_rss,
+    }
+
+
+def run_loadtest(sessions: int = 8, steps: int = 20, rows: int = 2000, children: int = 3,
+                 mix: dict = None, source_dir: str = None, processes: int = None) -> dict:
+    """并发跑 sessions 个模拟会话，汇总各类操作的重跑耗时 p50/p95、写冲突与每会话内存。
+
+    source_dir 给定时复制其中的数据文件作为替身，否则生成 rows 条合成记录。
+    processes 不给时，会话作为线程跑在本进程里（单服务器），每会话内存 = 本进程峰值内存增量 / 会话数；
+    给了就每个会话一个进程（多服务器 / 命令行争用），内存按进程各自计，含 AppTest 首次运行的开销。
+    写冲突 = 页面提示已保存、但压测结束后文件里找不到的记录。
+    """
+    mix = mix or LOADTEST_MIX
+    work = tempfile.mkdtemp(prefix="eye-loadtest-")
+    if source_dir:
+        for name in (CSV_FILE, f"{CSV_FILE}.enc", f"{CSV_FILE}.enc.idx", STAGE_FILE, ENCRYPTION_FILE):
+            if os.path.exists(os.path.join(source_dir, name)):
+                shutil.copy(os.path.join(source_dir, name), work)
+        if os.path.isdir(os.path.join(source_dir, SHARD_DIR)):
+            shutil.copytree(os.path.join(source_dir, SHARD_DIR), os.path.join(work, SHARD_DIR))
+    else:
+        synthetic_records(rows, [f"孩子{i + 1}" for i in range(children)]).to_csv(os.path.join(work, CSV_FILE), index=False)
+        synthetic_stages().to_csv(os.path.join(work, STAGE_FILE), index=False)
+
+    cwd = os.getcwd()
+    base_rss = _max_rss_mb()
+    t0 = time.perf_counter()
+    try:
+        with (ProcessPoolExecutor(max_workers=processes) if processes else
+              ThreadPoolExecutor(max_workers=sessions, thread_name_prefix="eye-loadtest")) as pool:
+            futures = [pool.submit(_loadtest_session, i, work, steps, mix, 1000 + i) for i in range(sessions)]
+            results = [f.result() for f in futures]
+    finally:
+        os.chdir(cwd)
+    wall = time.perf_counter() - t0
+
+    timings = pd.DataFrame([t for r in results for t in r["timings"]], columns=["操作", "秒"])
+    latency = timings.groupby("操作")["秒"].describe(percentiles=[0.5, 0.95])[["count", "50%", "95%", "max"]]
+    latency.loc["全部"] = timings["秒"].describe(percentiles=[0.5, 0.95])[["count", "50%", "95%", "max"]]
+    latency = latency.rename(columns={"count": "次数", "50%": "p50", "95%": "p95", "max": "最大"}).round(3)
+
+    saved = [tag for r in results for tag in r["entries"]]
+    os.chdir(work)  # 按替身目录自己的存储方式（单文件 / 分片 / 加密）读回
+    try:
+        present = set(child_keys(load_data(["儿童"])))
+    finally:
+        os.chdir(cwd)
+    lost = [tag for tag in saved if tag not in present]
+    report = {
+        "场景": f"多服务器 / 命令行争用（{processes} 个进程）" if processes else "单服务器（会话为同一进程内的线程）",
+        "会话数": sessions, "每会话操作数": steps, "总耗时(秒)": round(wall, 1), "数据目录": work,
+        "延迟": latency,
+        "录入成功": len(saved) - len(lost), "写冲突(丢失的录入)": len(lost), "判为重复而拒绝": sum(r["rejected"] for r in results),
+        "页面异常": [e for r in results for e in r["errors"]],
+    }
+    if processes:
+        memory = pd.Series([r["rss_mb"] - r["base_rss_mb"] for r in results])
+        report["每进程内存增量(MB，含首次运行开销)"] = {"平均": round(float(memory.mean()), 1), "最大": round(float(memory.max()), 1)}
+        report["单进程峰值内存(MB)"] = round(max(r["rss_mb"] for r in results), 1)
+    else:
+        peak = _max_rss_mb()
+        report["每会话内存增量(MB)"] = round((peak - base_rss) / sessions, 1)
+        report["进程峰值内存(MB)"] = round(peak, 1)
+    return report
+
+
 # ================== 主程序 ==================
+def rerun_fragment() -> None:
+    """只重跑当前片段；片段随整页一起运行时（不在片段重跑中）退回整页重跑。"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+
+DATA_WATCH_SECONDS = 2
+# 视图依赖的数据版本：阶段表本身的改动要等后台重算写回归属并发布后才影响视图
+VIEW_INPUT_VERSIONS = ("data", "published")
+
+
+@st.fragment(run_every=DATA_WATCH_SECONDS)
+def data_watch():
+    """轮询共享数据版本：表单、其他会话或后台重算写入后，视图输入变了才整页刷新。
+
+    刷新时没有变化的部分都命中按数据指纹缓存的结果，实际只重算受影响的视图。
+    """
+    worker = recompute_worker()
+    if worker.error:
+        st.error(f"后台重新计算失败，继续显示上一版数据：{worker.error}")
+    if worker.busy():
+        st.info("⏳ 正在后台重新计算阶段归属与汇总，当前先显示上一版数据…")
+    elif data_versions().get(*VIEW_INPUT_VERSIONS) != st.session_state.get("rendered_versions"):
+        st.rerun()
+
+
+@st.fragment
+def stage_panel():
+    """阶段管理（独立片段）：保存/启停只重跑本片段，阶段归属交给后台重算。"""
+    stages = load_stages()
+    timeline = StageTimeline(stages)
+
+    for note in st.session_state.pop("stage_notice", []):
+        st.warning(note)
+
+    with st.expander("新建阶段", expanded=False):
+        with st.form("stage_form", clear_on_submit=True):
+            stage_name = st.text_input("阶段名称（如：阿托品+眼镜阶段）", value="")
+            start_d = st.date_input("开始日期", value=datetime.now().date())
+            end_d = st.date_input("结束日期（可选，留空=至今）", value=None)
+            main_plan = st.text_input("主方案（如：0.01%阿托品+防控眼镜）", value="")
+            goal = st.text_area("阶段目标（可选）", value="", height=70)
+            advice = st.text_area("医生建议（可选）", value="", height=70)
+            memo = st.text_area("备注（可选）", value="", height=60)
+            enable = st.checkbox("启用", value=True)
+            stage_submit = st.form_submit_button("➕ 保存阶段")
+
+            if stage_submit:
+                if not stage_name.strip():
+                    st.error("阶段名称不能为空")
+                    st.stop()
+                ymd = pd.to_datetime(start_d).strftime("%Y%m%d")
+                existing = stages[stages["阶段ID"].astype(str).str.startswith(ymd)]
+                idx = len(existing) + 1
+                stage_id = f"{ymd}-{idx:02d}"
+
+                new_row = pd.DataFrame([{
+                    "阶段ID": stage_id,
+                    "阶段名称": stage_name.strip(),
+                    "开始日期": pd.to_datetime(start_d),
+                    "结束日期": pd.to_datetime(end_d) if end_d else pd.NaT,
+                    "主方案": main_plan.strip() or None,
+                    "阶段目标": goal.strip() or None,
+                    "医生建议": advice.strip() or None,
+                    "备注": memo.strip() or None,
+                    "是否启用": bool(enable),
+                }])
+                stages2 = pd.concat([stages, new_row], ignore_index=True) if not stages.empty else new_row
+                save_stages(stages2)
+                # 建阶段时校验时间轴：重叠/空档提示在刷新后显示
+                st.session_state["stage_notice"] = timeline_notes(StageTimeline(stages2), stage_id)
+                recompute_worker().submit()
+                st.toast(f"✅ 已新增阶段：{stage_id}")
+                rerun_fragment()
+
+    with st.expander("查看/管理阶段（启用/停用）", expanded=False):
+        if stages.empty:
+            st.info("暂无阶段。")
+        else:
+            show_cols = ["阶段ID", "阶段名称", "开始日期", "结束日期", "主方案", "是否启用"]
+            st.dataframe(stages[show_cols].sort_values("开始日期", ascending=False), use_container_width=True)
+            for note in timeline_notes(timeline):
+                st.caption(f"⚠️ {note}")
+
+            ids = stages["阶段ID"].astype(str).tolist()
+            sel_id = st.selectbox("选择阶段ID", ids, index=0)
+            cA, cB = st.columns(2)
+            if cA.button("✅ 启用"):
+                stages.loc[stages["阶段ID"] == sel_id, "是否启用"] = True
+                save_stages(stages)
+                recompute_worker().submit()
+                rerun_fragment()
+            if cB.button("⛔ 停用"):
+                stages.loc[stages["阶段ID"] == sel_id, "是否启用"] = False
+                save_stages(stages)
+                recompute_worker().submit()
+                rerun_fragment()
+
+
+@st.fragment
+def entry_panel():
+    """新增检查（独立片段）：提交只重跑本片段，写入后由 data_watch 刷新依赖数据的视图。"""
+    stages = load_stages()
+    timeline = StageTimeline(stages)
+
+    with st.form("entry_form", clear_on_submit=True):
+        date_input = st.date_input("检查日期", datetime.now().date())
+        child_input = st.text_input("儿童（姓名/编号，只记录一个孩子可留空）", value="")
+        site_input = st.text_input("站点（学校/筛查点，可留空）", value="")
+
+        auto_sid, auto_sname, auto_splan = timeline.lookup(pd.to_datetime(date_input))
+        stage_options = ["自动匹配"] + stages[stages["是否启用"] == True]["阶段ID"].astype(str).tolist()
+        sel_stage = st.selectbox("阶段归属", options=stage_options, index=0)
+
+        if sel_stage == "自动匹配":
+            stage_id, stage_name, stage_plan = auto_sid, auto_sname, auto_splan
+        else:
+            row = stages[stages["阶段ID"].astype(str) == sel_stage].iloc[0]
+            stage_id, stage_name, stage_plan = row["阶段ID"], row["阶段名称"], row["主方案"]
+
+        st.caption(f"归属阶段：**{stage_name or '未匹配阶段'}** | 主方案：**{stage_plan or '-'}**")
+
+        st.markdown("### ① 视功能（必填项为主）")
+        c1, c2 = st.columns(2)
+        l_vision = c1.number_input("左眼视力 (L)", min_value=0.1, max_value=2.0, value=1.0, step=0.1, format="%.1f")
+        r_vision = c2.number_input("右眼视力 (R)", min_value=0.1, max_value=2.0, value=1.0, step=0.1, format="%.1f")
+
+        c3, c4 = st.columns(2)
+        l_reserve = c3.number_input("左眼远视储备 (D)", min_value=-10.0, max_value=10.0, value=0.0, step=0.25, format="%.2f")
+        r_reserve = c4.number_input("右眼远视储备 (D)", min_value=-10.0, max_value=10.0, value=0.0, step=0.25, format="%.2f")
+
+        c5, c6 = st.columns(2)
+        l_axis_text = c5.text_input("左眼眼轴(mm，可留空 15~30)", value="")
+        r_axis_text = c6.text_input("右眼眼轴(mm，可留空 15~30)", value="")
+        l_axis, l_axis_err = parse_axis(l_axis_text)
+        r_axis, r_axis_err = parse_axis(r_axis_text)
+        if l_axis_err: c5.error(l_axis_err)
+        if r_axis_err: c6.error(r_axis_err)
+
+        st.markdown("### ② 屈光/验光（可留空）")
+        r1, r2, r3, r4 = st.columns(4)
+        OD_S = r1.text_input("OD S", value="")
+        OD_C = r2.text_input("OD C", value="")
+        OD_A = r3.text_input("OD A", value="")
+        OD_SE = r4.text_input("OD SE", value="")
+
+        l1, l2, l3, l4 = st.columns(4)
+        OS_S = l1.text_input("OS S", value="")
+        OS_C = l2.text_input("OS C", value="")
+        OS_A = l3.text_input("OS A", value="")
+        OS_SE = l4.text_input("OS SE", value="")
+
+        # PD：用可留空文本输入，避免 below-min 报错
+        pd_col = st.text_input("PD(mm)（可留空，范围 40~80）", value="")
+        PD, PD_err = parse_optional_float(pd_col, 40.0, 80.0)
+        if PD_err: st.error(f"PD：{PD_err}")
+
+        st.markdown("### ③ 角膜曲率/K值（可留空）")
+        k1, k2, k3 = st.columns(3)
+        OD_K1_mm = k1.text_input("OD K1(mm)", value="")
+        OD_K1_D = k2.text_input("OD K1(D)", value="")
+        OD_K1_axis = k3.text_input("OD K1轴位", value="")
+
+        k4, k5, k6 = st.columns(3)
+        OD_K2_mm = k4.text_input("OD K2(mm)", value="")
+        OD_K2_D = k5.text_input("OD K2(D)", value="")
+        OD_K2_axis = k6.text_input("OD K2轴位", value="")
+
+        k7, k8 = st.columns(2)
+        OD_cyl = k7.text_input("OD 角膜CYL(D)", value="")
+        OD_cyl_axis = k8.text_input("OD 角膜CYL轴位", value="")
+
+        k9, k10, k11 = st.columns(3)
+        OS_K1_mm = k9.text_input("OS K1(mm)", value="")
+        OS_K1_D = k10.text_input("OS K1(D)", value="")
+        OS_K1_axis = k11.text_input("OS K1轴位", value="")
+
+        k12, k13, k14 = st.columns(3)
+        OS_K2_mm = k12.text_input("OS K2(mm)", value="")
+        OS_K2_D = k13.text_input("OS K2(D)", value="")
+        OS_K2_axis = k14.text_input("OS K2轴位", value="")
+
+        k15, k16 = st.columns(2)
+        OS_cyl = k15.text_input("OS 角膜CYL(D)", value="")
+        OS_cyl_axis = k16.text_input("OS 角膜CYL轴位", value="")
+
+        st.markdown("### ④ WTW/角膜厚度/瞳孔/眼压（可留空）")
+        x1, x2 = st.columns(2)
+        OD_WTW = x1.text_input("OD WTW(mm)", value="")
+        OS_WTW = x2.text_input("OS WTW(mm)", value="")
+
+        t1, t2, t3 = st.columns(3)
+        OD_CCT = t1.text_input("OD 角膜中央厚度(um)", value="")
+        OS_CCT = t2.text_input("OS 角膜中央厚度(um)", value="")
+        OD_thinnest = t3.text_input("OD 最薄角膜厚度(um)", value="")
+
+        t4, t5, t6 = st.columns(3)
+        OS_thinnest = t4.text_input("OS 最薄角膜厚度(um)", value="")
+        OD_thinnest_pos = t5.text_input("OD 最薄点位置(mm)", value="")
+        OS_thinnest_pos = t6.text_input("OS 最薄点位置(mm)", value="")
+
+        p1, p2, p3, p4 = st.columns(4)
+        OD_pupil = p1.text_input("OD 瞳孔直径(mm)", value="")
+        OS_pupil = p2.text_input("OS 瞳孔直径(mm)", value="")
+        OD_iop = p3.text_input("OD 眼压(mmHg)", value="")
+        OS_iop = p4.text_input("OS 眼压(mmHg)", value="")
+
+        st.markdown("### ⑤ 双眼视觉/集合/调节/翻转拍（可留空）")
+        b1, b2, b3 = st.columns(3)
+        Titmus = b1.text_input("立体视 Titmus(秒)", value="")
+        Fusion = b2.text_input("融合范围(°)", value="")
+        Tropia = b3.text_input("他觉斜视角(°)", value="")
+
+        csc1, csc2, ccc1, ccc2 = st.columns(4)
+        SC_33 = csc1.text_input("33cm_SC(°)", value="")
+        SC_6m = csc2.text_input("6m_SC(°)", value="")
+        CC_33 = ccc1.text_input("33cm_CC(°)", value="")
+        CC_6m = ccc2.text_input("6m_CC(°)", value="")
+
+        a1, a2, a3, a4 = st.columns(4)
+        ACA = a1.text_input("AC/A", value="")
+        Amp_OD = a2.text_input("Amp_OD(D)", value="")
+        Amp_OS = a3.text_input("Amp_OS(D)", value="")
+        Amp_OU = a4.text_input("Amp_OU(D)", value="")
+
+        f1, f2, f3, f4 = st.columns(4)
+        Fl_OD = f1.text_input("Flipper_OD(cpm)", value="")
+        Fl_OS = f2.text_input("Flipper_OS(cpm)", value="")
+        Fl_OU = f3.text_input("Flipper_OU(cpm)", value="")
+        Fl_note = f4.text_input("Flipper_备注", value="")
+
+        st.divider()
+        st.markdown("### ⑥ 干预/治疗（含频次与依从性）")
+        st.markdown('<div class="small-hint">建议每次复查把“当前阶段正在执行的方案”勾选并写清楚频次，便于对比效果。</div>', unsafe_allow_html=True)
+
+        # 阿托品
+        use_atropine = st.checkbox("低浓度阿托品")
+        atropine_spec = atropine_freq = ""
+        atropine_week = None
+        atropine_start = atropine_end = None
+        atropine_ad = None
+        atropine_se = ""
+        if use_atropine:
+            atropine_spec = st.text_input("阿托品浓度/规格（如：0.01%）", value="")
+            atropine_freq = st.text_input("阿托品频次（文本）（如：每晚1次）", value="")
+            wtxt = st.text_input("阿托品每周次数（数字，可留空）", value="")
+            atropine_week, err = parse_optional_int(wtxt, 0, 14)
+            if err: st.error(f"阿托品每周次数：{err}")
+            a1c, a2c = st.columns(2)
+            atropine_start = a1c.date_input("阿托品开始日期", value=date_input)
+            atropine_end = a2c.date_input("阿托品结束日期（可选）", value=None)
+            atropine_ad = st.slider("阿托品依从性(%)", 0, 100, 80, 5)
+            atropine_se = st.text_area("阿托品副作用/不适（可选）", value="", height=60)
+
+        # 眼镜
+        use_glasses = st.checkbox("防控眼镜")
+        glasses_type = ""
+        glasses_hours = None
+        glasses_days = None
+        glasses_start = glasses_end = None
+        glasses_ad = None
+        glasses_dis = ""
+        if use_glasses:
+            glasses_type = st.text_input("眼镜类型（如：离焦/周边离焦等，自填）", value="")
+            glasses_hours = st.number_input("每天佩戴时长(h)", min_value=0.0, max_value=24.0, value=8.0, step=0.5)
+            dtxt = st.text_input("每周佩戴天数（0~7，可留空）", value="")
+            glasses_days, err = parse_optional_int(dtxt, 0, 7)
+            if err: st.error(f"每周佩戴天数：{err}")
+            g1c, g2c = st.columns(2)
+            glasses_start = g1c.date_input("眼镜开始日期", value=date_input)
+            glasses_end = g2c.date_input("眼镜结束日期（可选）", value=None)
+            glasses_ad = st.slider("眼镜依从性(%)", 0, 100, 85, 5)
+            glasses_dis = st.text_area("眼镜不适/反馈（可选）", value="", height=60)
+
+        # 捕光仪
+        use_light = st.checkbox("捕光仪/光照类")
+        light_plan = ""
+        light_minutes = None
+        light_days = None
+        light_start = light_end = None
+        light_ad = None
+        light_dis = ""
+        if use_light:
+            light_plan = st.text_input("方案/型号/规则（自填）", value="")
+            light_minutes = st.number_input("每天时长(min)", min_value=0, max_value=300, value=30, step=5)
+            ldtxt = st.text_input("每周使用天数（0~7，可留空）", value="")
+            light_days, err = parse_optional_int(ldtxt, 0, 7)
+            if err: st.error(f"每周使用天数：{err}")
+            l1c, l2c = st.columns(2)
+            light_start = l1c.date_input("捕光仪开始日期", value=date_input)
+            light_end = l2c.date_input("捕光仪结束日期（可选）", value=None)
+            light_ad = st.slider("捕光仪依从性(%)", 0, 100, 80, 5)
+            light_dis = st.text_area("捕光仪不适/反馈（可选）", value="", height=60)
+
+        # 七叶洋地参
+        use_qiye = st.checkbox("七叶洋地参滴眼液（仅记录）")
+        qiye_spec = qiye_freq = ""
+        qiye_day = None
+        qiye_start = qiye_end = None
+        qiye_ad = None
+        qiye_dis = ""
+        if use_qiye:
+            qiye_spec = st.text_input("规格/品牌（自填）", value="")
+            qiye_freq = st.text_input("频次（文本）（如：每日2次）", value="")
+            qtxt = st.text_input("每日次数（0~10，可留空）", value="")
+            qiye_day, err = parse_optional_int(qtxt, 0, 10)
+            if err: st.error(f"每日次数：{err}")
+            q1c, q2c = st.columns(2)
+            qiye_start = q1c.date_input("开始日期", value=date_input)
+            qiye_end = q2c.date_input("结束日期（可选）", value=None)
+            qiye_ad = st.slider("依从性(%)", 0, 100, 80, 5)
+            qiye_dis = st.text_area("不适/反馈（可选）", value="", height=60)
+
+        # 翻转拍
+        use_flip = st.checkbox("翻转拍/训练")
+        flip_plan = ""
+        flip_perweek = None
+        flip_minutes = None
+        flip_start = flip_end = None
+        flip_ad = None
+        flip_fb = ""
+        if use_flip:
+            flip_plan = st.text_input("训练方案（自填）", value="")
+            fptxt = st.text_input("每周次数（0~21，可留空）", value="")
+            flip_perweek, err = parse_optional_int(fptxt, 0, 21)
+            if err: st.error(f"每周次数：{err}")
+            fmtxt = st.text_input("每次分钟（0~180，可留空）", value="")
+            flip_minutes, err = parse_optional_int(fmtxt, 0, 180)
+            if err: st.error(f"每次分钟：{err}")
+            f1c, f2c = st.columns(2)
+            flip_start = f1c.date_input("训练开始日期", value=date_input)
+            flip_end = f2c.date_input("训练结束日期（可选）", value=None)
+            flip_ad = st.slider("训练依从性(%)", 0, 100, 70, 5)
+            flip_fb = st.text_area("训练反馈/不适（可选）", value="", height=60)
+
+        # 其它
+        use_other = st.checkbox("其它干预（自定义）")
+        other_content = ""
+        other_freqtxt = ""
+        other_perweek = None
+        other_minutes = None
+        other_start = other_end = None
+        other_ad = None
+        other_fb = ""
+        if use_other:
+            other_content = st.text_area("其它干预内容（写清：是什么、怎么做、频次等）", value="", height=80)
+            other_freqtxt = st.text_input("频次（文本）（如：每天一次/隔天一次等）", value="")
+            optxt = st.text_input("每周次数（0~21，可留空）", value="")
+            other_perweek, err = parse_optional_int(optxt, 0, 21)
+            if err: st.error(f"每周次数：{err}")
+            omtxt = st.text_input("每次分钟（0~180，可留空）", value="")
+            other_minutes, err = parse_optional_int(omtxt, 0, 180)
+            if err: st.error(f"每次分钟：{err}")
+            o1c, o2c = st.columns(2)
+            other_start = o1c.date_input("其它干预开始日期", value=date_input)
+            other_end = o2c.date_input("其它干预结束日期（可选）", value=None)
+            other_ad = st.slider("其它干预依从性(%)", 0, 100, 70, 5)
+            other_fb = st.text_area("其它干预反馈（可选）", value="", height=60)
+
+        st.divider()
+        note = st.text_area("备注（医院/验光方式/医生建议/用眼情况等）", value="", height=120)
+
+        submitted = st.form_submit_button("💾 保存记录（完整版）")
+
+        if submitted:
+            # 校验关键可选数值
+            if l_axis_err or r_axis_err:
+                st.error("❌ 眼轴输入有误，请修正后再保存")
+                st.stop()
+            if PD_err:
+                st.error("❌ PD 输入有误，请修正后再保存")
+                st.stop()
+
+            # 入库
+            new_entry = {
+                "日期": pd.to_datetime(date_input),
+                "儿童": child_input.strip() or None,
+                "站点": site_input.strip() or None,
+                "阶段ID": stage_id,
+                "阶段名称": stage_name if stage_name else "未匹配阶段",
+                "阶段主方案": stage_plan,
+
+                "左眼视力": float(l_vision),
+                "右眼视力": float(r_vision),
+                "左眼远视储备": float(l_reserve),
+                "右眼远视储备": float(r_reserve),
+                "眼轴长度(L)": None if l_axis is None else float(l_axis),
+                "眼轴长度(R)": None if r_axis is None else float(r_axis),
+                "备注": note,
+
+                # 屈光
+                "右眼_S": OD_S or None, "右眼_C": OD_C or None, "右眼_A": OD_A or None, "右眼_SE": OD_SE or None,
+                "左眼_S": OS_S or None, "左眼_C": OS_C or None, "左眼_A": OS_A or None, "左眼_SE": OS_SE or None,
+                "PD(mm)": None if PD is None else float(PD),
+
+                # K
+                "右眼_K1(mm)": OD_K1_mm or None, "右眼_K1(D)": OD_K1_D or None, "右眼_K1轴位": OD_K1_axis or None,
+                "右眼_K2(mm)": OD_K2_mm or None, "右眼_K2(D)": OD_K2_D or None, "右眼_K2轴位": OD_K2_axis or None,
+                "右眼角膜CYL(D)": OD_cyl or None, "右眼角膜CYL轴位": OD_cyl_axis or None,
+
+                "左眼_K1(mm)": OS_K1_mm or None, "左眼_K1(D)": OS_K1_D or None, "左眼_K1轴位": OS_K1_axis or None,
+                "左眼_K2(mm)": OS_K2_mm or None, "左眼_K2(D)": OS_K2_D or None, "左眼_K2轴位": OS_K2_axis or None,
+                "左眼角膜CYL(D)": OS_cyl or None, "左眼角膜CYL轴位": OS_cyl_axis or None,
+
+                # WTW/厚度/瞳孔/眼压
+                "右眼_WTW(mm)": OD_WTW or None, "左眼_WTW(mm)": OS_WTW or None,
+                "右眼_角膜中央厚度(um)": OD_CCT or None, "左眼_角膜中央厚度(um)": OS_CCT or None,
+                "右眼_最薄角膜厚度(um)": OD_thinnest or None, "左眼_最薄角膜厚度(um)": OS_thinnest or None,
+                "右眼_最薄点位置(mm)": OD_thinnest_pos or None, "左眼_最薄点位置(mm)": OS_thinnest_pos or None,
+                "右眼_瞳孔直径(mm)": OD_pupil or None, "左眼_瞳孔直径(mm)": OS_pupil or None,
+                "右眼眼压(mmHg)": OD_iop or None, "左眼眼压(mmHg)": OS_iop or None,
+
+                # 双眼视觉/集合/调节/翻转拍
+                "立体视_Titmus(秒)": Titmus or None,
+                "融合范围(°)": Fusion or None,
+                "他觉斜视角(°)": Tropia or None,
+                "33cm_SC(°)": SC_33 or None, "6m_SC(°)": SC_6m or None,
+                "33cm_CC(°)": CC_33 or None, "6m_CC(°)": CC_6m or None,
+                "AC/A": ACA or None,
+                "Amp_OD(D)": Amp_OD or None, "Amp_OS(D)": Amp_OS or None, "Amp_OU(D)": Amp_OU or None,
+                "Flipper_OD(cpm)": Fl_OD or None, "Flipper_OS(cpm)": Fl_OS or None, "Flipper_OU(cpm)": Fl_OU or None,
+                "Flipper_备注": Fl_note or None,
+
+                # 干预
+                "阿托品_是否使用": bool(use_atropine),
+                "阿托品_浓度或规格": atropine_spec if use_atropine else None,
+                "阿托品_频次文本": atropine_freq if use_atropine else None,
+                "阿托品_每周次数": atropine_week if use_atropine else None,
+                "阿托品_开始日期": pd.to_datetime(atropine_start) if use_atropine and atropine_start else None,
+                "阿托品_结束日期": pd.to_datetime(atropine_end) if use_atropine and atropine_end else None,
+                "阿托品_依从性(%)": int(atropine_ad) if use_atropine and atropine_ad is not None else None,
+                "阿托品_副作用或不适": atropine_se if use_atropine else None,
+
+                "防控眼镜_是否使用": bool(use_glasses),
+                "防控眼镜_类型": glasses_type if use_glasses else None,
+                "防控眼镜_每天佩戴时长(h)": float(glasses_hours) if use_glasses and glasses_hours is not None else None,
+                "防控眼镜_每周天数": glasses_days if use_glasses else None,
+                "防控眼镜_开始日期": pd.to_datetime(glasses_start) if use_glasses and glasses_start else None,
+                "防控眼镜_结束日期": pd.to_datetime(glasses_end) if use_glasses and glasses_end else None,
+                "防控眼镜_依从性(%)": int(glasses_ad) if use_glasses and glasses_ad is not None else None,
+                "防控眼镜_不适": glasses_dis if use_glasses else None,
+
+                "捕光仪_是否使用": bool(use_light),
+                "捕光仪_方案": light_plan if use_light else None,
+                "捕光仪_每天时长(min)": int(light_minutes) if use_light and light_minutes is not None else None,
+                "捕光仪_每周天数": light_days if use_light else None,
+                "捕光仪_开始日期": pd.to_datetime(light_start) if use_light and light_start else None,
+                "捕光仪_结束日期": pd.to_datetime(light_end) if use_light and light_end else None,
+                "捕光仪_依从性(%)": int(light_ad) if use_light and light_ad is not None else None,
+                "捕光仪_不适": light_dis if use_light else None,
+
+                "七叶洋地参_是否使用": bool(use_qiye),
+                "七叶洋地参_规格": qiye_spec if use_qiye else None,
+                "七叶洋地参_频次文本": qiye_freq if use_qiye else None,
+                "七叶洋地参_每日次数": qiye_day if use_qiye else None,
+                "七叶洋地参_开始日期": pd.to_datetime(qiye_start) if use_qiye and qiye_start else None,
+                "七叶洋地参_结束日期": pd.to_datetime(qiye_end) if use_qiye and qiye_end else None,
+                "七叶洋地参_依从性(%)": int(qiye_ad) if use_qiye and qiye_ad is not None else None,
+                "七叶洋地参_不适": qiye_dis if use_qiye else None,
+
+                "翻转拍_是否训练": bool(use_flip),
+                "翻转拍_方案": flip_plan if use_flip else None,
+                "翻转拍_每周次数": flip_perweek if use_flip else None,
+                "翻转拍_每次分钟": flip_minutes if use_flip else None,
+                "翻转拍_开始日期": pd.to_datetime(flip_start) if use_flip and flip_start else None,
+                "翻转拍_结束日期": pd.to_datetime(flip_end) if use_flip and flip_end else None,
+                "翻转拍_依从性(%)": int(flip_ad) if use_flip and flip_ad is not None else None,
+                "翻转拍_不适或反馈": flip_fb if use_flip else None,
+
+                "其它干预_是否有": bool(use_other),
+                "其它干预_内容": other_content if use_other else None,
+                "其它干预_频次文本": other_freqtxt if use_other else None,
+                "其它干预_每周次数": other_perweek if use_other else None,
+                "其它干预_每次分钟": other_minutes if use_other else None,
+                "其它干预_开始日期": pd.to_datetime(other_start) if use_other and other_start else None,
+                "其它干预_结束日期": pd.to_datetime(other_end) if use_other and other_end else None,
+                "其它干预_依从性(%)": int(other_ad) if use_other and other_ad is not None else None,
+                "其它干预_反馈": other_fb if use_other else None,
+            }
+
+            with data_lock():
+                new_entry["录入时间"] = pd.Timestamp.now().floor("s")  # 持写锁时才打录入时间（增量导出的水位线依赖这一点）
+                index = RecordIndex.load()
+                new_df = pd.DataFrame([new_entry])
+                new_hash = record_hashes(ensure_columns(new_df))
+                duplicate = index.contains(new_hash[0])
+                if not duplicate:
+                    append_records(new_df)
+                    index.add(new_hash)
+                    audit_append_or_warn("insert", {"rows": audit_records(ensure_columns(new_df))})
+
+            if duplicate:
+                st.error("❌ 这一天已有一条测量值完全相同的检查记录，未重复保存")
+                st.stop()
+            st.toast("✅ 已保存（完整版+阶段）")
+
+
+@st.fragment
+def import_panel():
+    """批量导入（独立片段）。"""
+    with st.expander("📥 批量导入（CSV）"):
+        st.caption("列名与导出的数据表一致；视力可以是小数、5 分记录或 logMAR，入库时统一换算。")
+        for note in st.session_state.pop("import_notice", []):
+            st.info(note)
+        up = st.file_uploader("选择 CSV 文件", type=["csv"], key="import_file")
+        scale = st.selectbox("视力记录法", ACUITY_SCALES, index=0, key="import_scale")
+        if up is not None and st.button("导入", key="import_btn"):
+            imported = pd.read_csv(up)
+            unknown = [c for c in imported.columns if c not in ALL_COLUMNS]
+            try:
+                imported = normalize_acuity(_coerce_dates(ensure_columns(imported)), scale)
+            except ValueError as exc:
+                st.error(f"❌ {exc}")
+                return
+            with data_lock():
+                imported["录入时间"] = pd.Timestamp.now().floor("s")
+                index = RecordIndex.load()
+                hashes = record_hashes(imported)
+                fresh = ~(index.mask(hashes) | pd.Series(hashes).duplicated().to_numpy())
+                imported, hashes = imported[fresh], hashes[fresh]
+                if not imported.empty:
+                    append_records(imported)
+                    index.add(hashes)
+                    audit_append_or_warn("insert", {"rows": audit_records(imported)})
+            skipped = int((~fresh).sum())
+            st.session_state["import_notice"] = [f"✅ 已导入 {len(imported)} 条记录"] + (
+                [f"已跳过重复记录 {skipped} 条"] if skipped else []) + (
+                [f"已忽略未知列：{'、'.join(unknown)}"] if unknown else [])
+            rerun_fragment()
+
+
+@st.fragment
+def trend_view(df_show, df_all, streamed, sel_child, view_fp):
+    """趋势页（独立片段）：阶段过滤 / 最近 N 次只重跑本页。"""
+    old_stages = historic_stages()
+    stage_list = ["全部"] + sorted(set(df_show["阶段名称"].fillna("未匹配阶段")) | set(old_stages))
+    sel_stage = st.selectbox("阶段过滤", stage_list, index=0)
+
+    dfp = df_show
+    if sel_stage in old_stages and not st.session_state.get("with_archive"):
+        # 历史阶段：只读该阶段所在年份的归档分区
+        dfp = with_archive(df_show, project_columns(df_show.columns), old_stages[sel_stage], sel_child)
+    dfp = dfp.copy()
+    dfp["阶段名称"] = dfp["阶段名称"].fillna("未匹配阶段")
+    if sel_stage != "全部":
+        dfp = dfp[dfp["阶段名称"] == sel_stage]
+    elif old_stages and not st.session_state.get("with_archive"):
+        st.caption("仅显示近期数据；更早的记录已归档，可打开上方“包含归档的全部历史”或选择历史阶段查看。")
+
+    if streamed is not None:
+        st.caption(f"历史档案较大，已按分块流式读取：明细仅保留最近 {STREAM_TAIL_ROWS} 条"
+                   "（干预累计周数 / 剂量也只按这些记录计算），下方附全程月度趋势。")
+        long_m = streamed["monthly"].melt(
+            id_vars=["日期"],
+            value_vars=["平均视力", "平均SE", "眼轴长度(L)", "眼轴长度(R)", "平均AL/CR"],
+            var_name="指标",
+            value_name="值",
+        ).dropna(subset=["日期", "值"])
+        if not long_m.empty:
+            fig_m = px.line(long_m, x="日期", y="值", color="指标", facet_row="指标", markers=False)
+            fig_m.update_yaxes(matches=None)
+            st.plotly_chart(fig_m, use_container_width=True)
+
+    # 预测只在看全部阶段时显示（按孩子最近所在阶段的趋势外推）
+    forecast = None
+    if sel_stage == "全部" and streamed is None:
+        fc_all = cached_forecasts(view_fp, df_all)
+        if not fc_all.empty:
+            forecast = fc_all[fc_all["儿童"] == (sel_child or child_keys(df_show).iloc[-1])]
+
+    if dfp.empty:
+        st.warning("该阶段暂无数据。")
+    else:
+        df_tail, n_used, _ = safe_last_n_selector("显示最近 N 次", dfp, default_n=12, min_n=3, max_cap=80)
+        df_tail = df_tail.copy()
+
+        # 平均视力 / 平均SE
+        df_tail["平均logMAR"] = (to_numeric(df_tail["左眼_logMAR"]) + to_numeric(df_tail["右眼_logMAR"])) / 2
+        df_tail["平均视力"] = logmar_to_decimal(df_tail["平均logMAR"])
+        df_tail["平均SE"] = (to_numeric(df_tail["左眼_SE"]) + to_numeric(df_tail["右眼_SE"])) / 2
+
+        cA, cB = st.columns(2)
+
+        with cA:
+            long_v = df_tail.melt(
+                id_vars=["日期", "阶段名称", "阶段主方案"],
+                value_vars=["左眼视力", "右眼视力", "平均视力"],
+                var_name="指标",
+                value_name="值",
+            ).dropna(subset=["日期", "值"])
+            fig1 = px.line(long_v, x="日期", y="值", color="指标", markers=True, hover_data=["阶段名称", "阶段主方案"])
+            st.plotly_chart(fig1, use_container_width=True)
+
+        with cB:
+            long_se = df_tail.melt(
+                id_vars=["日期", "阶段名称", "阶段主方案"],
+                value_vars=["左眼_SE", "右眼_SE", "平均SE"],
+                var_name="指标",
+                value_name="值",
+            ).dropna(subset=["日期", "值"])
+            if long_se.empty:
+                st.info("SE 数据为空（请在录入时填写 S/C/A/SE 或 SE）。")
+            else:
+                fig2 = px.line(long_se, x="日期", y="值", color="指标", markers=True, hover_data=["阶段名称", "阶段主方案"])
+                st.plotly_chart(fig2, use_container_width=True)
+
+        cC, cD = st.columns(2)
+        with cC:
+            long_r = df_tail.melt(
+                id_vars=["日期", "阶段名称"],
+                value_vars=["左眼远视储备", "右眼远视储备"],
+                var_name="指标",
+                value_name="值",
+            ).dropna(subset=["日期", "值"])
+            fig3 = px.line(long_r, x="日期", y="值", color="指标", markers=True, hover_data=["阶段名称"])
+            st.plotly_chart(fig3, use_container_width=True)
+
+        with cD:
+            long_ax = df_tail.melt(
+                id_vars=["日期", "阶段名称"],
+                value_vars=["眼轴长度(L)", "眼轴长度(R)"],
+                var_name="指标",
+                value_name="值",
+            ).dropna(subset=["日期", "值"])
+            if long_ax.empty:
+                st.info("眼轴数据为空（可留空，也可后续补录）。")
+            else:
+                fig4 = px.line(long_ax, x="日期", y="值", color="指标", markers=True, hover_data=["阶段名称"])
+                if forecast is not None and not forecast.empty:
+                    last_ax = dfp.dropna(subset=["日期"]).iloc[-1]
+                    add_forecast_traces(
+                        fig4,
+                        forecast[forecast["指标"].isin(["眼轴长度(L)", "眼轴长度(R)"])],
+                        {k: to_numeric(pd.Series([last_ax[k]])).iloc[0] for k in ["眼轴长度(L)", "眼轴长度(R)"]
+                         if pd.notna(to_numeric(pd.Series([last_ax[k]])).iloc[0])},
+                    )
+                st.plotly_chart(fig4, use_container_width=True)
+
+        cE, cF = st.columns(2)
+        with cE:
+            long_alcr = df_tail.melt(
+                id_vars=["日期", "阶段名称"],
+                value_vars=["左眼_AL/CR", "右眼_AL/CR"],
+                var_name="指标",
+                value_name="值",
+            ).dropna(subset=["日期", "值"])
+            if long_alcr.empty:
+                st.info("AL/CR 需要眼轴和角膜曲率（K1/K2）。")
+            else:
+                fig5 = px.line(long_alcr, x="日期", y="值", color="指标", markers=True, hover_data=["阶段名称"])
+                st.plotly_chart(fig5, use_container_width=True)
+        with cF:
+            long_j = df_tail.melt(
+                id_vars=["日期", "阶段名称"],
+                value_vars=[f"{eye}_{c}" for eye in ("右眼", "左眼") for c in ("J0", "J45", "角膜J0", "角膜J45")],
+                var_name="指标",
+                value_name="值",
+            ).dropna(subset=["日期", "值"])
+            if long_j.empty:
+                st.info("散光矢量需要柱镜 C/轴位 A 或角膜 K 值轴位。")
+            else:
+                long_j[["眼别", "指标"]] = long_j["指标"].str.split("_", n=1, expand=True)
+                fig6 = px.line(long_j, x="日期", y="值", color="指标", facet_col="眼别", markers=True,
+                               hover_data=["阶段名称"])
+                st.plotly_chart(fig6, use_container_width=True)
+            st.caption("J0 > 0 为顺规、< 0 为逆规散光，J45 为斜轴分量；角膜J0/J45 按矫正等效计，可与验光对比。")
+
+        if forecast is not None and not forecast.empty:
+            st.markdown("#### 🔮 6 / 12 个月预测（线性趋势，95% 预测区间）")
+            st.dataframe(
+                forecast.drop(columns=["儿童", "6个月日期", "12个月日期"]),
+                use_container_width=True, hide_index=True,
+            )
+            st.caption("说明：默认按当前阶段（方案）内的检查拟合；当前阶段不足 3 次检查时改用全部历史。预测仅供参考。")
+
+
+@st.fragment
+def summary_view(df_show, streamed, sel_child, view_fp):
+    """阶段×干预汇总页（独立片段）。已发布的汇总只含热数据，包含归档时现场计算。"""
+    if streamed is not None:
+        summary = streamed["summary"]
+    else:
+        archived = bool(st.session_state.get("with_archive"))
+        summary = load_prepared_summary() if sel_child is None and not archived else None
+        if summary is None:
+            summary = build_stage_intervention_summary(df_show)
+    if summary.empty:
+        st.info("暂无可汇总数据（请先录入干预勾选/频次/依从性）。")
+    else:
+        st.dataframe(summary.sort_values(["阶段", "干预"]), use_container_width=True)
+        st.caption("说明：频次/时长均值1、2 对应各干预的核心频次字段（如眼镜=每天佩戴时长/每周天数）。")
+
+    if streamed is None:
+        stage_fx, inter_fx = cached_effects(view_fp, sel_child, df_show)
+        st.markdown("#### 📉 各阶段进展速度（年化，95% 自助法区间）")
+        if stage_fx.empty:
+            st.info("检查次数不足，暂无法估计进展速度。")
+        else:
+            st.dataframe(stage_fx, use_container_width=True, hide_index=True)
+        if not inter_fx.empty:
+            st.markdown("#### 💊 干预使用前 vs 使用中")
+            st.dataframe(inter_fx, use_container_width=True, hide_index=True)
+        st.caption("说明：速度为同一孩子同一只眼内部的变化斜率（多孩子时合并计算）；"
+                   "区间不含 0 的变化/差值才有统计意义。眼轴增长或 SE 下降越慢越好。")
+
+
+@st.fragment
+def table_view(df_show, streamed):
+    """全部数据页（独立片段）：去重 / 审计 / 导出操作只重跑本页。"""
+    front_cols = [
+        "日期", "阶段名称", "阶段主方案", "干预标签",
+        "左眼视力", "右眼视力", "左眼远视储备", "右眼远视储备",
+        "眼轴长度(L)", "眼轴长度(R)",
+        "右眼_S","右眼_C","右眼_A","右眼_SE","左眼_S","左眼_C","左眼_A","左眼_SE",
+        "PD(mm)", "右眼眼压(mmHg)", "左眼眼压(mmHg)",
+        "备注"
+    ]
+    rest_cols = [c for c in df_show.columns if c not in front_cols]
+    if streamed is not None:
+        st.caption(f"历史档案较大，仅显示最近 {STREAM_TAIL_ROWS} 条记录。")
+    st.dataframe(df_show[front_cols + rest_cols].sort_values("日期"), use_container_width=True)
+
+    with st.expander("🔍 疑似重复记录", expanded=False):
+        st.caption(f"同一孩子 {NEAR_DUP_DAYS} 天内、主要测量值几乎相同的记录（整库扫描）。")
+        if st.button("开始扫描", key="dedup_scan") or st.session_state.get("dedup_scanned"):
+            st.session_state["dedup_scanned"] = True
+            pairs = cached_near_duplicates(data_file_fingerprint())
+            if pairs.empty:
+                st.success("没有发现疑似重复记录。")
+            else:
+                st.dataframe(pairs, use_container_width=True, hide_index=True)
+                if pairs["完全重复"].any() and st.button("删除完全重复的记录（保留先录入的）", key="dedup_drop"):
+                    with data_lock():
+                        drop_exact_duplicates()
+                    rerun_fragment()
+
+    with st.expander("🧾 修改记录（审计日志）", expanded=False):
+        c1, c2 = st.columns(2)
+        check = None
+        if c1.button("校验新增日志", key="audit_verify"):
+            check = verify_audit()
+        if c2.button("从头完整校验", key="audit_verify_full"):
+            check = verify_audit(full=True)
+        if check is not None:
+            if check["ok"]:
+                st.success(f"✅ 哈希链完整：本次校验 {check['checked']} 条，共 {check['seq']} 条")
+            else:
+                st.error(f"❌ {check['error']}")
+        when = st.date_input("查看某天结束时的数据", value=None, key="audit_when")
+        if when is not None:
+            past, past_stages = audit_state_at(pd.Timestamp(when) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1))
+            st.caption(f"{when}：{len(past)} 条检查记录，{len(past_stages)} 个阶段")
+            st.dataframe(past, use_container_width=True)
+
+    with st.expander("🗄️ 归档旧记录", expanded=False):
+        manifest = archive_manifest()
+        if manifest:
+            st.dataframe(pd.DataFrame.from_dict(manifest, orient="index").rename_axis("年份"), use_container_width=True)
+        days = st.number_input("归档早于多少天的记录", min_value=30, value=ARCHIVE_HORIZON_DAYS, step=30, key="archive_days")
+        if pq is None:
+            st.caption("归档需要安装 pyarrow。")
+        elif encrypted():
+            st.caption("加密存储暂不支持归档（归档分区是明文 Parquet）。")
+        elif st.button("立即归档", key="archive_btn"):
+            res = archive_old_records(int(days))
+            st.toast(f"已归档 {res['rows']} 条 {res['cutoff']} 之前的记录" if res["rows"] else "没有需要归档的记录")
+            rerun_fragment()
+
+    with st.expander("⏰ 复查提醒与依从性", expanded=False):
+        today = pd.Timestamp.today().normalize()
+        sched = cached_schedule(data_fingerprint(), str(today.date()))
+        due, alerts = sched["due"], sched["alerts"]
+        c1, c2, c3 = st.columns(3)
+        c1.metric("已逾期", int((due["状态"] == "已逾期").sum()))
+        c2.metric(f"{SCHEDULE_DUE_SOON_DAYS} 天内到期", int((due["状态"] == "即将到期").sum()))
+        c3.metric("依从性提醒", len(alerts))
+        st.dataframe(due, use_container_width=True, hide_index=True)
+        if not alerts.empty:
+            st.dataframe(alerts, use_container_width=True, hide_index=True)
+        st.caption(f"复查间隔取最近一次检查所在阶段的医生建议（如“3个月复查”），没写时按 {SCHEDULE_DEFAULT_MONTHS} 个月；"
+                   f"依从性低于 {ADHERENCE_ALERT_PCT}% 或处方频次比上次下降超过 {FREQUENCY_DROP:.0%} 时提醒。")
+        if st.button("写出今日摘要", key="digest_btn"):
+            st.toast(f"已写出 {write_digest(sched)}")
+
+    with st.expander("📤 导出（英文字段 / FHIR）", expanded=False):
+        fmt = st.selectbox("格式", list(EXPORT_FORMATS), key="export_fmt",
+                           format_func={"jsonl": "JSONL（平铺记录）", "fhir": "FHIR Observation（NDJSON）",
+                                        "parquet": "Parquet"}.get)
+        deid = st.checkbox("去标识化（假名 + 日期平移 + 去掉自由文本）", key="export_deid")
+        salt = st.text_input("去标识化密钥（盐）", value=os.environ.get(EXPORT_SALT_ENV, ""),
+                             type="password", key="export_salt") if deid else None
+        incremental = st.checkbox("只导出上次导出之后新录入的记录", key="export_incremental")
+        if st.button("生成导出文件", key="export_btn"):
+            if deid and not salt:
+                st.error("❌ 去标识化需要填写密钥")
+            elif fmt == "parquet" and pa is None:
+                st.error("❌ 导出 Parquet 需要安装 pyarrow")
+            else:
+                st.session_state["export_result"] = export_records(
+                    fmt, salt=salt if deid else None, incremental=incremental, target="page")
+        res = st.session_state.get("export_result")
+        if res and os.path.exists(res["path"]):
+            st.caption(f"{res['path']}：{res['rows']} 条记录")
+            with open(res["path"], "rb") as f:
+                st.download_button("下载", f, file_name=os.path.basename(res["path"]), key="export_download")
+
+
+@st.fragment
+def quality_view():
+    """数据质量页（独立片段）：整库一次扫描，结果按数据版本缓存，筛选只重跑本页。"""
+    flags = cached_quality(data_file_fingerprint())
+    if flags.empty:
+        st.success("✅ 全部记录均通过一致性检查。")
+        return
+    counts = flags.groupby("规则").agg(条数=("行", "size"), 涉及记录=("行", "nunique"))
+    counts["说明"] = [QUALITY_RULES.get(r, "") for r in counts.index]
+    st.dataframe(counts, use_container_width=True)
+
+    c1, c2, c3 = st.columns(3)
+    rules = c1.multiselect("规则", list(counts.index), key="quality_rules")
+    kids = c2.multiselect("儿童", sorted(flags["儿童"].unique().tolist()), key="quality_children")
+    eyes = c3.multiselect("眼别", sorted(flags["眼别"].unique().tolist()), key="quality_eyes")
+    view = flags
+    if rules:
+        view = view[view["规则"].isin(rules)]
+    if kids:
+        view = view[view["儿童"].isin(kids)]
+    if eyes:
+        view = view[view["眼别"].isin(eyes)]
+    where = "所在分片文件" if "分片" in view.columns else "数据文件"
+    st.caption(f"共 {len(view)} 条提示；“行”为{where}中的行号（不含表头，从 0 开始）。")
+    st.dataframe(view, use_container_width=True, hide_index=True)
+
+
 def app_main():
+    page_setup()
+    ensure_audit_baseline()
     st.markdown(
         """
 <div class="hero">
@@ -522,606 +4611,249 @@ def app_main():
     st.write("")
 
     stages = load_stages()
-    df = load_data()
-    if not df.empty:
-        df = df.sort_values("日期")
-
-    # 每次运行：把阶段匹配写回历史数据（阶段调整后会自动刷新归属）
-    if not df.empty:
-        sid_list, sname_list, splan_list = [], [], []
-        for _, row in df.iterrows():
-            sid, sn, sp = match_stage_for_date(stages, row["日期"])
-            sid_list.append(sid)
-            sname_list.append(sn if sn else "未匹配阶段")
-            splan_list.append(sp)
-        df["阶段ID"] = sid_list
-        df["阶段名称"] = sname_list
-        df["阶段主方案"] = splan_list
-        df = ensure_columns(df)
-        save_data(df)
-
-    df_show = df.copy()
-    if not df_show.empty:
-        df_show = df_show.sort_values("日期")
-        df_show["干预标签"] = df_show.apply(short_tag, axis=1)
-        df_show["阶段名称"] = df_show["阶段名称"].fillna("未匹配阶段")
+    timeline = StageTimeline(stages)
 
     # ================== Sidebar：阶段管理 + 完整录入 ==================
     with st.sidebar:
         st.header("🧩 阶段管理")
-
-        with st.expander("新建阶段", expanded=False):
-            with st.form("stage_form", clear_on_submit=True):
-                stage_name = st.text_input("阶段名称（如：阿托品+眼镜阶段）", value="")
-                start_d = st.date_input("开始日期", value=datetime.now().date())
-                end_d = st.date_input("结束日期（可选，留空=至今）", value=None)
-                main_plan = st.text_input("主方案（如：0.01%阿托品+防控眼镜）", value="")
-                goal = st.text_area("阶段目标（可选）", value="", height=70)
-                advice = st.text_area("医生建议（可选）", value="", height=70)
-                memo = st.text_area("备注（可选）", value="", height=60)
-                enable = st.checkbox("启用", value=True)
-                stage_submit = st.form_submit_button("➕ 保存阶段")
-
-                if stage_submit:
-                    if not stage_name.strip():
-                        st.error("阶段名称不能为空")
-                        st.stop()
-                    ymd = pd.to_datetime(start_d).strftime("%Y%m%d")
-                    existing = stages[stages["阶段ID"].astype(str).str.startswith(ymd)]
-                    idx = len(existing) + 1
-                    stage_id = f"{ymd}-{idx:02d}"
-
-                    new_row = pd.DataFrame([{
-                        "阶段ID": stage_id,
-                        "阶段名称": stage_name.strip(),
-                        "开始日期": pd.to_datetime(start_d),
-                        "结束日期": pd.to_datetime(end_d) if end_d else pd.NaT,
-                        "主方案": main_plan.strip() or None,
-                        "阶段目标": goal.strip() or None,
-                        "医生建议": advice.strip() or None,
-                        "备注": memo.strip() or None,
-                        "是否启用": bool(enable),
-                    }])
-                    stages2 = pd.concat([stages, new_row], ignore_index=True) if not stages.empty else new_row
-                    save_stages(stages2)
-                    st.success(f"✅ 已新增阶段：{stage_id}")
-                    st.rerun()
-
-        with st.expander("查看/管理阶段（启用/停用）", expanded=False):
-            if stages.empty:
-                st.info("暂无阶段。")
-            else:
-                show_cols = ["阶段ID", "阶段名称", "开始日期", "结束日期", "主方案", "是否启用"]
-                st.dataframe(stages[show_cols].sort_values("开始日期", ascending=False), use_container_width=True)
-
-                ids = stages["阶段ID"].astype(str).tolist()
-                sel_id = st.selectbox("选择阶段ID", ids, index=0)
-                cA, cB = st.columns(2)
-                if cA.button("✅ 启用"):
-                    stages.loc[stages["阶段ID"] == sel_id, "是否启用"] = True
-                    save_stages(stages)
-                    st.rerun()
-                if cB.button("⛔ 停用"):
-                    stages.loc[stages["阶段ID"] == sel_id, "是否启用"] = False
-                    save_stages(stages)
-                    st.rerun()
-
+        stage_panel()
         st.divider()
         st.header("📝 新增检查 + 干预（完整版）")
+        entry_panel()
+        import_panel()
 
-        with st.form("entry_form", clear_on_submit=True):
-            date_input = st.date_input("检查日期", datetime.now().date())
+    # ================== 主页面展示 ==================
+    # 先搭好版面：只有展开的报告 / 当前打开的标签页才参与列投影，未打开的视图不解析其列
+    status_box = st.container()
+    page = st.empty()
+    with page.container():
+        header = st.container()
 
-            auto_sid, auto_sname, auto_splan = match_stage_for_date(stages, pd.to_datetime(date_input))
-            stage_options = ["自动匹配"] + stages[stages["是否启用"] == True]["阶段ID"].astype(str).tolist()
-            sel_stage = st.selectbox("阶段归属", options=stage_options, index=0)
+        # A4 打印版报告（隐藏打印按钮区域）
+        st.markdown('<div class="no-print">', unsafe_allow_html=True)
+        report_box = st.expander("🖨️ 最近一次检查报告（A4一页打印版）", expanded=False, key="report_expander", on_change="rerun")
+        st.markdown("</div>", unsafe_allow_html=True)
 
-            if sel_stage == "自动匹配":
-                stage_id, stage_name, stage_plan = auto_sid, auto_sname, auto_splan
-            else:
-                row = stages[stages["阶段ID"].astype(str) == sel_stage].iloc[0]
-                stage_id, stage_name, stage_plan = row["阶段ID"], row["阶段名称"], row["主方案"]
-
-            st.caption(f"归属阶段：**{stage_name or '未匹配阶段'}** | 主方案：**{stage_plan or '-'}**")
-
-            st.markdown("### ① 视功能（必填项为主）")
-            c1, c2 = st.columns(2)
-            l_vision = c1.number_input("左眼视力 (L)", min_value=0.1, max_value=2.0, value=1.0, step=0.1, format="%.1f")
-            r_vision = c2.number_input("右眼视力 (R)", min_value=0.1, max_value=2.0, value=1.0, step=0.1, format="%.1f")
-
-            c3, c4 = st.columns(2)
-            l_reserve = c3.number_input("左眼远视储备 (D)", min_value=-10.0, max_value=10.0, value=0.0, step=0.25, format="%.2f")
-            r_reserve = c4.number_input("右眼远视储备 (D)", min_value=-10.0, max_value=10.0, value=0.0, step=0.25, format="%.2f")
-
-            c5, c6 = st.columns(2)
-            l_axis_text = c5.text_input("左眼眼轴(mm，可留空 15~30)", value="")
-            r_axis_text = c6.text_input("右眼眼轴(mm，可留空 15~30)", value="")
-            l_axis, l_axis_err = parse_axis(l_axis_text)
-            r_axis, r_axis_err = parse_axis(r_axis_text)
-            if l_axis_err: c5.error(l_axis_err)
-            if r_axis_err: c6.error(r_axis_err)
-
-            st.markdown("### ② 屈光/验光（可留空）")
-            r1, r2, r3, r4 = st.columns(4)
-            OD_S = r1.text_input("OD S", value="")
-            OD_C = r2.text_input("OD C", value="")
-            OD_A = r3.text_input("OD A", value="")
-            OD_SE = r4.text_input("OD SE", value="")
-
-            l1, l2, l3, l4 = st.columns(4)
-            OS_S = l1.text_input("OS S", value="")
-            OS_C = l2.text_input("OS C", value="")
-            OS_A = l3.text_input("OS A", value="")
-            OS_SE = l4.text_input("OS SE", value="")
-
-            # PD：用可留空文本输入，避免 below-min 报错
-            pd_col = st.text_input("PD(mm)（可留空，范围 40~80）", value="")
-            PD, PD_err = parse_optional_float(pd_col, 40.0, 80.0)
-            if PD_err: st.error(f"PD：{PD_err}")
-
-            st.markdown("### ③ 角膜曲率/K值（可留空）")
-            k1, k2, k3 = st.columns(3)
-            OD_K1_mm = k1.text_input("OD K1(mm)", value="")
-            OD_K1_D = k2.text_input("OD K1(D)", value="")
-            OD_K1_axis = k3.text_input("OD K1轴位", value="")
-
-            k4, k5, k6 = st.columns(3)
-            OD_K2_mm = k4.text_input("OD K2(mm)", value="")
-            OD_K2_D = k5.text_input("OD K2(D)", value="")
-            OD_K2_axis = k6.text_input("OD K2轴位", value="")
-
-            k7, k8 = st.columns(2)
-            OD_cyl = k7.text_input("OD 角膜CYL(D)", value="")
-            OD_cyl_axis = k8.text_input("OD 角膜CYL轴位", value="")
-
-            k9, k10, k11 = st.columns(3)
-            OS_K1_mm = k9.text_input("OS K1(mm)", value="")
-            OS_K1_D = k10.text_input("OS K1(D)", value="")
-            OS_K1_axis = k11.text_input("OS K1轴位", value="")
-
-            k12, k13, k14 = st.columns(3)
-            OS_K2_mm = k12.text_input("OS K2(mm)", value="")
-            OS_K2_D = k13.text_input("OS K2(D)", value="")
-            OS_K2_axis = k14.text_input("OS K2轴位", value="")
-
-            k15, k16 = st.columns(2)
-            OS_cyl = k15.text_input("OS 角膜CYL(D)", value="")
-            OS_cyl_axis = k16.text_input("OS 角膜CYL轴位", value="")
-
-            st.markdown("### ④ WTW/角膜厚度/瞳孔/眼压（可留空）")
-            x1, x2 = st.columns(2)
-            OD_WTW = x1.text_input("OD WTW(mm)", value="")
-            OS_WTW = x2.text_input("OS WTW(mm)", value="")
-
-            t1, t2, t3 = st.columns(3)
-            OD_CCT = t1.text_input("OD 角膜中央厚度(um)", value="")
-            OS_CCT = t2.text_input("OS 角膜中央厚度(um)", value="")
-            OD_thinnest = t3.text_input("OD 最薄角膜厚度(um)", value="")
-
-            t4, t5, t6 = st.columns(3)
-            OS_thinnest = t4.text_input("OS 最薄角膜厚度(um)", value="")
-            OD_thinnest_pos = t5.text_input("OD 最薄点位置(mm)", value="")
-            OS_thinnest_pos = t6.text_input("OS 最薄点位置(mm)", value="")
-
-            p1, p2, p3, p4 = st.columns(4)
-            OD_pupil = p1.text_input("OD 瞳孔直径(mm)", value="")
-            OS_pupil = p2.text_input("OS 瞳孔直径(mm)", value="")
-            OD_iop = p3.text_input("OD 眼压(mmHg)", value="")
-            OS_iop = p4.text_input("OS 眼压(mmHg)", value="")
-
-            st.markdown("### ⑤ 双眼视觉/集合/调节/翻转拍（可留空）")
-            b1, b2, b3 = st.columns(3)
-            Titmus = b1.text_input("立体视 Titmus(秒)", value="")
-            Fusion = b2.text_input("融合范围(°)", value="")
-            Tropia = b3.text_input("他觉斜视角(°)", value="")
-
-            csc1, csc2, ccc1, ccc2 = st.columns(4)
-            SC_33 = csc1.text_input("33cm_SC(°)", value="")
-            SC_6m = csc2.text_input("6m_SC(°)", value="")
-            CC_33 = ccc1.text_input("33cm_CC(°)", value="")
-            CC_6m = ccc2.text_input("6m_CC(°)", value="")
-
-            a1, a2, a3, a4 = st.columns(4)
-            ACA = a1.text_input("AC/A", value="")
-            Amp_OD = a2.text_input("Amp_OD(D)", value="")
-            Amp_OS = a3.text_input("Amp_OS(D)", value="")
-            Amp_OU = a4.text_input("Amp_OU(D)", value="")
-
-            f1, f2, f3, f4 = st.columns(4)
-            Fl_OD = f1.text_input("Flipper_OD(cpm)", value="")
-            Fl_OS = f2.text_input("Flipper_OS(cpm)", value="")
-            Fl_OU = f3.text_input("Flipper_OU(cpm)", value="")
-            Fl_note = f4.text_input("Flipper_备注", value="")
-
-            st.divider()
-            st.markdown("### ⑥ 干预/治疗（含频次与依从性）")
-            st.markdown('<div class="small-hint">建议每次复查把“当前阶段正在执行的方案”勾选并写清楚频次，便于对比效果。</div>', unsafe_allow_html=True)
-
-            # 阿托品
-            use_atropine = st.checkbox("低浓度阿托品")
-            atropine_spec = atropine_freq = ""
-            atropine_week = None
-            atropine_start = atropine_end = None
-            atropine_ad = None
-            atropine_se = ""
-            if use_atropine:
-                atropine_spec = st.text_input("阿托品浓度/规格（如：0.01%）", value="")
-                atropine_freq = st.text_input("阿托品频次（文本）（如：每晚1次）", value="")
-                wtxt = st.text_input("阿托品每周次数（数字，可留空）", value="")
-                atropine_week, err = parse_optional_int(wtxt, 0, 14)
-                if err: st.error(f"阿托品每周次数：{err}")
-                a1c, a2c = st.columns(2)
-                atropine_start = a1c.date_input("阿托品开始日期", value=date_input)
-                atropine_end = a2c.date_input("阿托品结束日期（可选）", value=None)
-                atropine_ad = st.slider("阿托品依从性(%)", 0, 100, 80, 5)
-                atropine_se = st.text_area("阿托品副作用/不适（可选）", value="", height=60)
-
-            # 眼镜
-            use_glasses = st.checkbox("防控眼镜")
-            glasses_type = ""
-            glasses_hours = None
-            glasses_days = None
-            glasses_start = glasses_end = None
-            glasses_ad = None
-            glasses_dis = ""
-            if use_glasses:
-                glasses_type = st.text_input("眼镜类型（如：离焦/周边离焦等，自填）", value="")
-                glasses_hours = st.number_input("每天佩戴时长(h)", min_value=0.0, max_value=24.0, value=8.0, step=0.5)
-                dtxt = st.text_input("每周佩戴天数（0~7，可留空）", value="")
-                glasses_days, err = parse_optional_int(dtxt, 0, 7)
-                if err: st.error(f"每周佩戴天数：{err}")
-                g1c, g2c = st.columns(2)
-                glasses_start = g1c.date_input("眼镜开始日期", value=date_input)
-                glasses_end = g2c.date_input("眼镜结束日期（可选）", value=None)
-                glasses_ad = st.slider("眼镜依从性(%)", 0, 100, 85, 5)
-                glasses_dis = st.text_area("眼镜不适/反馈（可选）", value="", height=60)
-
-            # 捕光仪
-            use_light = st.checkbox("捕光仪/光照类")
-            light_plan = ""
-            light_minutes = None
-            light_days = None
-            light_start = light_end = None
-            light_ad = None
-            light_dis = ""
-            if use_light:
-                light_plan = st.text_input("方案/型号/规则（自填）", value="")
-                light_minutes = st.number_input("每天时长(min)", min_value=0, max_value=300, value=30, step=5)
-                ldtxt = st.text_input("每周使用天数（0~7，可留空）", value="")
-                light_days, err = parse_optional_int(ldtxt, 0, 7)
-                if err: st.error(f"每周使用天数：{err}")
-                l1c, l2c = st.columns(2)
-                light_start = l1c.date_input("捕光仪开始日期", value=date_input)
-                light_end = l2c.date_input("捕光仪结束日期（可选）", value=None)
-                light_ad = st.slider("捕光仪依从性(%)", 0, 100, 80, 5)
-                light_dis = st.text_area("捕光仪不适/反馈（可选）", value="", height=60)
-
-            # 七叶洋地参
-            use_qiye = st.checkbox("七叶洋地参滴眼液（仅记录）")
-            qiye_spec = qiye_freq = ""
-            qiye_day = None
-            qiye_start = qiye_end = None
-            qiye_ad = None
-            qiye_dis = ""
-            if use_qiye:
-                qiye_spec = st.text_input("规格/品牌（自填）", value="")
-                qiye_freq = st.text_input("频次（文本）（如：每日2次）", value="")
-                qtxt = st.text_input("每日次数（0~10，可留空）", value="")
-                qiye_day, err = parse_optional_int(qtxt, 0, 10)
-                if err: st.error(f"每日次数：{err}")
-                q1c, q2c = st.columns(2)
-                qiye_start = q1c.date_input("开始日期", value=date_input)
-                qiye_end = q2c.date_input("结束日期（可选）", value=None)
-                qiye_ad = st.slider("依从性(%)", 0, 100, 80, 5)
-                qiye_dis = st.text_area("不适/反馈（可选）", value="", height=60)
-
-            # 翻转拍
-            use_flip = st.checkbox("翻转拍/训练")
-            flip_plan = ""
-            flip_perweek = None
-            flip_minutes = None
-            flip_start = flip_end = None
-            flip_ad = None
-            flip_fb = ""
-            if use_flip:
-                flip_plan = st.text_input("训练方案（自填）", value="")
-                fptxt = st.text_input("每周次数（0~21，可留空）", value="")
-                flip_perweek, err = parse_optional_int(fptxt, 0, 21)
-                if err: st.error(f"每周次数：{err}")
-                fmtxt = st.text_input("每次分钟（0~180，可留空）", value="")
-                flip_minutes, err = parse_optional_int(fmtxt, 0, 180)
-                if err: st.error(f"每次分钟：{err}")
-                f1c, f2c = st.columns(2)
-                flip_start = f1c.date_input("训练开始日期", value=date_input)
-                flip_end = f2c.date_input("训练结束日期（可选）", value=None)
-                flip_ad = st.slider("训练依从性(%)", 0, 100, 70, 5)
-                flip_fb = st.text_area("训练反馈/不适（可选）", value="", height=60)
-
-            # 其它
-            use_other = st.checkbox("其它干预（自定义）")
-            other_content = ""
-            other_freqtxt = ""
-            other_perweek = None
-            other_minutes = None
-            other_start = other_end = None
-            other_ad = None
-            other_fb = ""
-            if use_other:
-                other_content = st.text_area("其它干预内容（写清：是什么、怎么做、频次等）", value="", height=80)
-                other_freqtxt = st.text_input("频次（文本）（如：每天一次/隔天一次等）", value="")
-                optxt = st.text_input("每周次数（0~21，可留空）", value="")
-                other_perweek, err = parse_optional_int(optxt, 0, 21)
-                if err: st.error(f"每周次数：{err}")
-                omtxt = st.text_input("每次分钟（0~180，可留空）", value="")
-                other_minutes, err = parse_optional_int(omtxt, 0, 180)
-                if err: st.error(f"每次分钟：{err}")
-                o1c, o2c = st.columns(2)
-                other_start = o1c.date_input("其它干预开始日期", value=date_input)
-                other_end = o2c.date_input("其它干预结束日期（可选）", value=None)
-                other_ad = st.slider("其它干预依从性(%)", 0, 100, 70, 5)
-                other_fb = st.text_area("其它干预反馈（可选）", value="", height=60)
-
-            st.divider()
-            note = st.text_area("备注（医院/验光方式/医生建议/用眼情况等）", value="", height=120)
-
-            submitted = st.form_submit_button("💾 保存记录（完整版）")
-
-            if submitted:
-                # 校验关键可选数值
-                if l_axis_err or r_axis_err:
-                    st.error("❌ 眼轴输入有误，请修正后再保存")
-                    st.stop()
-                if PD_err:
-                    st.error("❌ PD 输入有误，请修正后再保存")
-                    st.stop()
+        st.divider()
 
-                # 入库
-                new_entry = {
-                    "日期": pd.to_datetime(date_input),
-                    "阶段ID": stage_id,
-                    "阶段名称": stage_name if stage_name else "未匹配阶段",
-                    "阶段主方案": stage_plan,
-
-                    "左眼视力": float(l_vision),
-                    "右眼视力": float(r_vision),
-                    "左眼远视储备": float(l_reserve),
-                    "右眼远视储备": float(r_reserve),
-                    "眼轴长度(L)": None if l_axis is None else float(l_axis),
-                    "眼轴长度(R)": None if r_axis is None else float(r_axis),
-                    "备注": note,
-
-                    # 屈光
-                    "右眼_S": OD_S or None, "右眼_C": OD_C or None, "右眼_A": OD_A or None, "右眼_SE": OD_SE or None,
-                    "左眼_S": OS_S or None, "左眼_C": OS_C or None, "左眼_A": OS_A or None, "左眼_SE": OS_SE or None,
-                    "PD(mm)": None if PD is None else float(PD),
-
-                    # K
-                    "右眼_K1(mm)": OD_K1_mm or None, "右眼_K1(D)": OD_K1_D or None, "右眼_K1轴位": OD_K1_axis or None,
-                    "右眼_K2(mm)": OD_K2_mm or None, "右眼_K2(D)": OD_K2_D or None, "右眼_K2轴位": OD_K2_axis or None,
-                    "右眼角膜CYL(D)": OD_cyl or None, "右眼角膜CYL轴位": OD_cyl_axis or None,
-
-                    "左眼_K1(mm)": OS_K1_mm or None, "左眼_K1(D)": OS_K1_D or None, "左眼_K1轴位": OS_K1_axis or None,
-                    "左眼_K2(mm)": OS_K2_mm or None, "左眼_K2(D)": OS_K2_D or None, "左眼_K2轴位": OS_K2_axis or None,
-                    "左眼角膜CYL(D)": OS_cyl or None, "左眼角膜CYL轴位": OS_cyl_axis or None,
-
-                    # WTW/厚度/瞳孔/眼压
-                    "右眼_WTW(mm)": OD_WTW or None, "左眼_WTW(mm)": OS_WTW or None,
-                    "右眼_角膜中央厚度(um)": OD_CCT or None, "左眼_角膜中央厚度(um)": OS_CCT or None,
-                    "右眼_最薄角膜厚度(um)": OD_thinnest or None, "左眼_最薄角膜厚度(um)": OS_thinnest or None,
-                    "右眼_最薄点位置(mm)": OD_thinnest_pos or None, "左眼_最薄点位置(mm)": OS_thinnest_pos or None,
-                    "右眼_瞳孔直径(mm)": OD_pupil or None, "左眼_瞳孔直径(mm)": OS_pupil or None,
-                    "右眼眼压(mmHg)": OD_iop or None, "左眼眼压(mmHg)": OS_iop or None,
-
-                    # 双眼视觉/集合/调节/翻转拍
-                    "立体视_Titmus(秒)": Titmus or None,
-                    "融合范围(°)": Fusion or None,
-                    "他觉斜视角(°)": Tropia or None,
-                    "33cm_SC(°)": SC_33 or None, "6m_SC(°)": SC_6m or None,
-                    "33cm_CC(°)": CC_33 or None, "6m_CC(°)": CC_6m or None,
-                    "AC/A": ACA or None,
-                    "Amp_OD(D)": Amp_OD or None, "Amp_OS(D)": Amp_OS or None, "Amp_OU(D)": Amp_OU or None,
-                    "Flipper_OD(cpm)": Fl_OD or None, "Flipper_OS(cpm)": Fl_OS or None, "Flipper_OU(cpm)": Fl_OU or None,
-                    "Flipper_备注": Fl_note or None,
-
-                    # 干预
-                    "阿托品_是否使用": bool(use_atropine),
-                    "阿托品_浓度或规格": atropine_spec if use_atropine else None,
-                    "阿托品_频次文本": atropine_freq if use_atropine else None,
-                    "阿托品_每周次数": atropine_week if use_atropine else None,
-                    "阿托品_开始日期": pd.to_datetime(atropine_start) if use_atropine and atropine_start else None,
-                    "阿托品_结束日期": pd.to_datetime(atropine_end) if use_atropine and atropine_end else None,
-                    "阿托品_依从性(%)": int(atropine_ad) if use_atropine and atropine_ad is not None else None,
-                    "阿托品_副作用或不适": atropine_se if use_atropine else None,
-
-                    "防控眼镜_是否使用": bool(use_glasses),
-                    "防控眼镜_类型": glasses_type if use_glasses else None,
-                    "防控眼镜_每天佩戴时长(h)": float(glasses_hours) if use_glasses and glasses_hours is not None else None,
-                    "防控眼镜_每周天数": glasses_days if use_glasses else None,
-                    "防控眼镜_开始日期": pd.to_datetime(glasses_start) if use_glasses and glasses_start else None,
-                    "防控眼镜_结束日期": pd.to_datetime(glasses_end) if use_glasses and glasses_end else None,
-                    "防控眼镜_依从性(%)": int(glasses_ad) if use_glasses and glasses_ad is not None else None,
-                    "防控眼镜_不适": glasses_dis if use_glasses else None,
-
-                    "捕光仪_是否使用": bool(use_light),
-                    "捕光仪_方案": light_plan if use_light else None,
-                    "捕光仪_每天时长(min)": int(light_minutes) if use_light and light_minutes is not None else None,
-                    "捕光仪_每周天数": light_days if use_light else None,
-                    "捕光仪_开始日期": pd.to_datetime(light_start) if use_light and light_start else None,
-                    "捕光仪_结束日期": pd.to_datetime(light_end) if use_light and light_end else None,
-                    "捕光仪_依从性(%)": int(light_ad) if use_light and light_ad is not None else None,
-                    "捕光仪_不适": light_dis if use_light else None,
-
-                    "七叶洋地参_是否使用": bool(use_qiye),
-                    "七叶洋地参_规格": qiye_spec if use_qiye else None,
-                    "七叶洋地参_频次文本": qiye_freq if use_qiye else None,
-                    "七叶洋地参_每日次数": qiye_day if use_qiye else None,
-                    "七叶洋地参_开始日期": pd.to_datetime(qiye_start) if use_qiye and qiye_start else None,
-                    "七叶洋地参_结束日期": pd.to_datetime(qiye_end) if use_qiye and qiye_end else None,
-                    "七叶洋地参_依从性(%)": int(qiye_ad) if use_qiye and qiye_ad is not None else None,
-                    "七叶洋地参_不适": qiye_dis if use_qiye else None,
-
-                    "翻转拍_是否训练": bool(use_flip),
-                    "翻转拍_方案": flip_plan if use_flip else None,
-                    "翻转拍_每周次数": flip_perweek if use_flip else None,
-                    "翻转拍_每次分钟": flip_minutes if use_flip else None,
-                    "翻转拍_开始日期": pd.to_datetime(flip_start) if use_flip and flip_start else None,
-                    "翻转拍_结束日期": pd.to_datetime(flip_end) if use_flip and flip_end else None,
-                    "翻转拍_依从性(%)": int(flip_ad) if use_flip and flip_ad is not None else None,
-                    "翻转拍_不适或反馈": flip_fb if use_flip else None,
-
-                    "其它干预_是否有": bool(use_other),
-                    "其它干预_内容": other_content if use_other else None,
-                    "其它干预_频次文本": other_freqtxt if use_other else None,
-                    "其它干预_每周次数": other_perweek if use_other else None,
-                    "其它干预_每次分钟": other_minutes if use_other else None,
-                    "其它干预_开始日期": pd.to_datetime(other_start) if use_other and other_start else None,
-                    "其它干预_结束日期": pd.to_datetime(other_end) if use_other and other_end else None,
-                    "其它干预_依从性(%)": int(other_ad) if use_other and other_ad is not None else None,
-                    "其它干预_反馈": other_fb if use_other else None,
-                }
+        tab1, tab2, tab3, tab4, tab5 = st.tabs(
+            ["📈 趋势", "🧩 阶段×干预汇总", "🧾 最近一次明细清单", "📑 全部数据", "🩺 数据质量"],
+            key="main_tabs", on_change="rerun",
+        )
+
+    views = ["header"] + [v for v, t in zip(["trend", "summary", "report", "table"], [tab1, tab2, tab3, tab4]) if t.open]
+    if report_box.open:
+        views.append("report")
+    # 阶段匹配写回历史数据在缓存未命中时进行（阶段调整后会自动刷新归属）
+    # 超大历史档案走分块流式读取：汇总/月度趋势全量累加，明细只保留最近若干条
+    streamed = None
+    sel_child = None
+    if sharded():
+        # 分片存储：先按分片索引选孩子，只读这个孩子的分片；阶段归属的写回交给后台线程
+        children = shard_children()
+        if len(children) > 1:
+            sel_child = header.selectbox("👧 选择儿童", children, key="sel_child")
+        else:
+            sel_child = children[0] if children else DEFAULT_CHILD
+        if recompute_worker().synced_stages != file_fingerprint(STAGE_FILE):
+            recompute_worker().submit()
+        view_fp = data_fingerprint(sel_child)
+        df_show = cached_child_view(view_fp, tuple(view_columns(*views)), sel_child)
+    elif is_large_archive():
+        # 阶段表变了：交给后台把归属写回，期间按数据指纹继续用上一次的扫描结果；写回后指纹变了再重新扫描
+        if recompute_worker().synced_stages != file_fingerprint(STAGE_FILE) and not recompute_worker().busy():
+            recompute_worker().submit()
+        view_fp = data_fingerprint()
+        streamed = stream_view_data(view_fp, tuple(view_columns(*views)))
+        df_show = streamed["tail"]
+    else:
+        df_show, view_fp = load_prepared(timeline, view_columns(*views))
 
-                new_df = pd.DataFrame([new_entry])
-                df2 = pd.concat([df, new_df], ignore_index=True) if not df.empty else new_df
-                df2["日期"] = pd.to_datetime(df2["日期"], errors="coerce")
-                df2 = df2.sort_values("日期")
-                df2 = ensure_columns(df2)
-                save_data(df2)
+    st.session_state["rendered_versions"] = data_versions().get(*VIEW_INPUT_VERSIONS)
+    with status_box:
+        data_watch()
 
-                st.success("✅ 已保存（完整版+阶段）")
-                st.rerun()
+    # 默认只看热数据；打开后按需读取归档分区接在前面（超大档案的流式模式不提供）
+    years = sorted(archive_manifest())
+    if years and streamed is None:
+        if header.toggle(f"📚 包含归档的全部历史（{years[0]}–{years[-1]}）", key="with_archive"):
+            df_show = with_archive(df_show, view_columns(*views), child=sel_child if sharded() else None)
+            view_fp = f"{view_fp}|归档{','.join(map(str, years))}"  # 预测、效果估计按含归档的数据另行缓存
 
-    # ================== 主页面展示 ==================
     if df_show.empty:
-        st.info("👋 欢迎！请在左侧录入第一次检查数据。")
+        page.info("👋 欢迎！请在左侧录入第一次检查数据。")
         return
 
-    df_show = df_show.sort_values("日期").copy()
+    # 多个孩子时先选人；预测等批量计算仍在全部孩子上一次完成（分片存储时上面已选好、只读了这个孩子）
+    df_all = df_show
+    children = sorted(child_keys(df_all).unique().tolist())
+    if len(children) > 1 and not sharded():
+        sel_child = header.selectbox("👧 选择儿童", children, key="sel_child")
+        df_show = df_all[child_keys(df_all) == sel_child]
+
     latest = df_show.iloc[-1]
     latest_date_str = latest["日期"].strftime("%Y-%m-%d") if pd.notnull(latest["日期"]) else "未知日期"
 
-    st.markdown(
-        f"""
+    with header:
+        st.markdown(
+            f"""
 <div class="card">
   <div class="card-title">🔍 最近一次记录
     <span class="badge">{latest_date_str}</span>
     <span class="badge">阶段：{latest.get("阶段名称","未匹配阶段")}</span>
-    <span class="badge">干预：{short_tag(latest)}</span>
+    <span class="badge">干预：{latest.get("干预标签", "无")}</span>
   </div>
 </div>
 """,
-        unsafe_allow_html=True,
-    )
-
-    k1, k2, k3, k4 = st.columns(4)
-    k1.metric("左眼视力", latest.get("左眼视力", ""))
-    k2.metric("右眼视力", latest.get("右眼视力", ""))
-    k3.metric("左眼远视储备", f"{latest.get('左眼远视储备', 0):+}D")
-    k4.metric("右眼远视储备", f"{latest.get('右眼远视储备', 0):+}D")
-
-    # A4 打印版报告（隐藏打印按钮区域）
-    st.markdown('<div class="no-print">', unsafe_allow_html=True)
-    with st.expander("🖨️ 最近一次检查报告（A4一页打印版）", expanded=False):
-        st.info("打开后按 Ctrl+P（打印），选择 A4 纵向；系统会自动只打印报告内容。")
-        st.markdown(a4_report_html(latest), unsafe_allow_html=True)
-        st.caption("提示：如果你想把报告导出 PDF，打印时选择“另存为PDF”。")
-    st.markdown("</div>", unsafe_allow_html=True)
+            unsafe_allow_html=True,
+        )
 
-    st.divider()
+        k1, k2, k3, k4 = st.columns(4)
+        k1.metric("左眼视力", latest.get("左眼视力", ""))
+        k2.metric("右眼视力", latest.get("右眼视力", ""))
+        k3.metric("左眼远视储备", f"{latest.get('左眼远视储备', 0):+}D")
+        k4.metric("右眼远视储备", f"{latest.get('右眼远视储备', 0):+}D")
 
-    tab1, tab2, tab3, tab4 = st.tabs(["📈 趋势", "🧩 阶段×干预汇总", "🧾 最近一次明细清单", "📑 全部数据"])
+    with report_box:
+        if report_box.open:
+            st.info("打开后按 Ctrl+P（打印），选择 A4 纵向；系统会自动只打印报告内容。")
+            st.markdown(a4_report_html(latest), unsafe_allow_html=True)
+            st.caption("提示：如果你想把报告导出 PDF，打印时选择“另存为PDF”。")
 
     with tab1:
-        stage_list = ["全部"] + sorted(df_show["阶段名称"].fillna("未匹配阶段").unique().tolist())
-        sel_stage = st.selectbox("阶段过滤", stage_list, index=0)
-
-        dfp = df_show.copy()
-        dfp["阶段名称"] = dfp["阶段名称"].fillna("未匹配阶段")
-        if sel_stage != "全部":
-            dfp = dfp[dfp["阶段名称"] == sel_stage]
-
-        if dfp.empty:
-            st.warning("该阶段暂无数据。")
-        else:
-            df_tail, n_used, _ = safe_last_n_selector("显示最近 N 次", dfp, default_n=12, min_n=3, max_cap=80)
-            df_tail = df_tail.copy()
-
-            # 平均视力 / 平均SE
-            df_tail["平均视力"] = (to_numeric(df_tail["左眼视力"]) + to_numeric(df_tail["右眼视力"])) / 2
-            df_tail["平均SE"] = (to_numeric(df_tail["左眼_SE"]) + to_numeric(df_tail["右眼_SE"])) / 2
-
-            cA, cB = st.columns(2)
-
-            with cA:
-                long_v = df_tail.melt(
-                    id_vars=["日期", "阶段名称", "阶段主方案"],
-                    value_vars=["左眼视力", "右眼视力", "平均视力"],
-                    var_name="指标",
-                    value_name="值",
-                ).dropna(subset=["日期", "值"])
-                fig1 = px.line(long_v, x="日期", y="值", color="指标", markers=True, hover_data=["阶段名称", "阶段主方案"])
-                st.plotly_chart(fig1, use_container_width=True)
-
-            with cB:
-                long_se = df_tail.melt(
-                    id_vars=["日期", "阶段名称", "阶段主方案"],
-                    value_vars=["左眼_SE", "右眼_SE", "平均SE"],
-                    var_name="指标",
-                    value_name="值",
-                ).dropna(subset=["日期", "值"])
-                if long_se.empty:
-                    st.info("SE 数据为空（请在录入时填写 S/C/A/SE 或 SE）。")
-                else:
-                    fig2 = px.line(long_se, x="日期", y="值", color="指标", markers=True, hover_data=["阶段名称", "阶段主方案"])
-                    st.plotly_chart(fig2, use_container_width=True)
-
-            cC, cD = st.columns(2)
-            with cC:
-                long_r = df_tail.melt(
-                    id_vars=["日期", "阶段名称"],
-                    value_vars=["左眼远视储备", "右眼远视储备"],
-                    var_name="指标",
-                    value_name="值",
-                ).dropna(subset=["日期", "值"])
-                fig3 = px.line(long_r, x="日期", y="值", color="指标", markers=True, hover_data=["阶段名称"])
-                st.plotly_chart(fig3, use_container_width=True)
-
-            with cD:
-                long_ax = df_tail.melt(
-                    id_vars=["日期", "阶段名称"],
-                    value_vars=["眼轴长度(L)", "眼轴长度(R)"],
-                    var_name="指标",
-                    value_name="值",
-                ).dropna(subset=["日期", "值"])
-                if long_ax.empty:
-                    st.info("眼轴数据为空（可留空，也可后续补录）。")
-                else:
-                    fig4 = px.line(long_ax, x="日期", y="值", color="指标", markers=True, hover_data=["阶段名称"])
-                    st.plotly_chart(fig4, use_container_width=True)
+        if tab1.open:
+            trend_view(df_show, df_all, streamed, sel_child, view_fp)
 
     with tab2:
-        summary = build_stage_intervention_summary(df_show)
-        if summary.empty:
-            st.info("暂无可汇总数据（请先录入干预勾选/频次/依从性）。")
-        else:
-            st.dataframe(summary.sort_values(["阶段", "干预"]), use_container_width=True)
-            st.caption("说明：频次/时长均值1、2 对应各干预的核心频次字段（如眼镜=每天佩戴时长/每周天数）。")
+        if tab2.open:
+            summary_view(df_show, streamed, sel_child, view_fp)
 
     with tab3:
-        st.markdown("### 🧾 最近一次检查项目清单（可打印/可复制）")
-        st.markdown(a4_report_html(latest), unsafe_allow_html=True)
-        st.caption("提示：该页面在打印时会自动只打印报告内容（隐藏侧栏与控件）。")
+        if tab3.open:
+            st.markdown("### 🧾 最近一次检查项目清单（可打印/可复制）")
+            st.markdown(a4_report_html(latest), unsafe_allow_html=True)
+            st.caption("提示：该页面在打印时会自动只打印报告内容（隐藏侧栏与控件）。")
 
     with tab4:
-        front_cols = [
-            "日期", "阶段名称", "阶段主方案", "干预标签",
-            "左眼视力", "右眼视力", "左眼远视储备", "右眼远视储备",
-            "眼轴长度(L)", "眼轴长度(R)",
-            "右眼_S","右眼_C","右眼_A","右眼_SE","左眼_S","左眼_C","左眼_A","左眼_SE",
-            "PD(mm)", "右眼眼压(mmHg)", "左眼眼压(mmHg)",
-            "备注"
-        ]
-        rest_cols = [c for c in df_show.columns if c not in front_cols]
-        st.dataframe(df_show[front_cols + rest_cols].sort_values("日期"), use_container_width=True)
-
-
-app_main()
+        if tab4.open:
+            table_view(df_show, streamed)
+
+    with tab5:
+        if tab5.open:
+            quality_view()
+
+
+def cli_main(argv) -> None:
+    parser = argparse.ArgumentParser(prog="eye.py", description="宝贝视力成长档案命令行工具（不带参数运行则打开页面）")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_exp = sub.add_parser("export", help="导出数据（可配合定时任务每晚增量导出）")
+    p_exp.add_argument("--format", choices=list(EXPORT_FORMATS), default="jsonl")
+    p_exp.add_argument("--deid", action="store_true", help=f"去标识化，盐取自环境变量 {EXPORT_SALT_ENV}")
+    p_exp.add_argument("--incremental", action="store_true", help="只导出上次导出之后录入的记录")
+    p_exp.add_argument("--target", default="default", help="导出目标名（各自维护水位线）")
+    p_arc = sub.add_parser("archive", help="把旧记录移入按年分区的归档（可配合定时任务）")
+    p_arc.add_argument("--days", type=int, default=ARCHIVE_HORIZON_DAYS, help="归档早于多少天的记录")
+    p_sh = sub.add_parser("shard", help="按孩子分片存储（或 --merge 合并回单个文件）")
+    p_sh.add_argument("--by-site", action="store_true", help="先按站点分目录，再按孩子分片")
+    p_sh.add_argument("--merge", action="store_true", help="把分片合并回 vision_data.csv")
+    p_bat = sub.add_parser("batch", help="按分片并行的批处理：汇总 / 数据质量 / 每个孩子的报告")
+    p_bat.add_argument("job", choices=list(SHARD_JOBS))
+    p_bat.add_argument("--processes", type=int, default=None, help="进程数（默认=CPU 数）")
+    p_bat.add_argument("--out", default=None, help="汇总/质量结果写到该 CSV（默认打印）；报告为输出目录")
+    p_sch = sub.add_parser("schedule", help="算出复查到期与依从性提醒，写出当天摘要（可配合定时任务每天运行）")
+    p_sch.add_argument("--date", default=None, help="按哪一天计算（默认今天，YYYY-MM-DD）")
+    p_sch.add_argument("--out", default=DIGEST_DIR, help="摘要输出目录")
+    p_sch.add_argument("--processes", type=int, default=None, help="进程数（默认=CPU 数）")
+    p_sch.add_argument("--once", action="store_true", help="当天的摘要已存在就跳过（定时任务可以频繁触发，错过的也能补上）")
+    p_enc = sub.add_parser("encrypt", help=f"转为分块加密存储（密钥取自环境变量 {ENCRYPTION_KEY_ENV} 或 --key-file）")
+    p_enc.add_argument("--key-file", help="数据目录之外的密钥文件，不存在时生成（权限 600）")
+    p_enc.add_argument("--decrypt", action="store_true", help="转回明文存储")
+    p_bs = sub.add_parser("bench-storage", help="明文与加密存储的读写吞吐对比（在临时目录里跑）")
+    p_bs.add_argument("--rows", type=int, default=20000, help="合成数据条数")
+    p_bs.add_argument("--children", type=int, default=50, help="合成数据的孩子数")
+    p_bs.add_argument("--appends", type=int, default=20, help="逐条追加的次数")
+    p_lt = sub.add_parser("loadtest", help="多会话压力测试（在临时目录的数据替身上运行）")
+    p_lt.add_argument("--sessions", type=int, default=8, help="并发会话数")
+    p_lt.add_argument("--steps", type=int, default=20, help="每个会话的操作次数")
+    p_lt.add_argument("--rows", type=int, default=2000, help="合成数据条数（未指定 --source 时）")
+    p_lt.add_argument("--children", type=int, default=3, help="合成数据的孩子数")
+    p_lt.add_argument("--mix", default="browse=6,filter=3,entry=1", help="操作比例，如 browse=6,filter=3,entry=1")
+    p_lt.add_argument("--source", default=None, help="复制该目录下的数据文件作为替身（默认用合成数据）")
+    p_lt.add_argument("--processes", type=int, default=None,
+                      help="改为多进程（模拟多个服务器 / 命令行同时写）；默认所有会话是同一进程里的线程，即一个服务器")
+    args = parser.parse_args(argv)
+
+    if args.cmd == "loadtest":
+        mix = {}
+        for part in args.mix.split(","):
+            name, _, weight = part.partition("=")
+            if name.strip() not in LOADTEST_MIX:
+                parser.error(f"未知操作：{name}（可选 {'/'.join(LOADTEST_MIX)}）")
+            mix[name.strip()] = float(weight or 1)
+        report = run_loadtest(args.sessions, args.steps, args.rows, args.children, mix, args.source, args.processes)
+        latency = report.pop("延迟")
+        errors = report.pop("页面异常")
+        for k, v in report.items():
+            print(f"{k}: {v}")
+        print("重跑耗时（秒）：")
+        print(latency.to_string())
+        if errors:
+            print(f"页面异常 {len(errors)} 次，例如：{errors[0]}")
+    elif args.cmd == "export":
+        salt = os.environ.get(EXPORT_SALT_ENV) if args.deid else None
+        if args.deid and not salt:
+            parser.error(f"--deid 需要先设置环境变量 {EXPORT_SALT_ENV}")
+        r = export_records(args.format, salt=salt, incremental=args.incremental, target=args.target)
+        print(f"已导出 {r['rows']} 条记录 -> {r['path']}")
+    elif args.cmd == "shard":
+        if args.merge:
+            print(f"已合并 {unshard_storage()} 条记录 -> {CSV_FILE}")
+        else:
+            print(f"已拆分为 {shard_storage(args.by_site)} 个分片 -> {SHARD_DIR}/")
+    elif args.cmd == "batch":
+        t0 = time.perf_counter()
+        if args.job == "reports":
+            paths = batch_reports(args.processes, args.out or REPORT_DIR)
+            print(f"已生成 {len(paths)} 份报告 -> {args.out or REPORT_DIR}/")
+        else:
+            result = batch_summary(args.processes) if args.job == "summary" else batch_quality(args.processes)
+            if args.out:
+                result.to_csv(args.out, index=False)
+                print(f"{len(result)} 行 -> {args.out}")
+            else:
+                print(result.to_string())
+        print(f"{len(data_files())} 个数据文件，耗时 {time.perf_counter() - t0:.2f} 秒")
+    elif args.cmd == "schedule":
+        try:
+            today = pd.Timestamp(args.date if args.date else pd.Timestamp.today()).normalize()
+        except ValueError:
+            parser.error(f"无法识别的日期：{args.date}")
+        if args.once and os.path.exists(digest_path(today, args.out)):
+            print(f"{digest_path(today, args.out)} 已存在，跳过")
+            return
+        schedule = build_schedule(today, args.processes)
+        path = write_digest(schedule, args.out)
+        status = schedule["due"]["状态"]
+        print(f"{len(status)} 个孩子：已逾期 {(status == '已逾期').sum()}，即将到期 {(status == '即将到期').sum()}，"
+              f"依从性提醒 {len(schedule['alerts'])} 条 -> {path}")
+    elif args.cmd == "encrypt":
+        ensure_audit_baseline()
+        if args.decrypt:
+            print(f"已转回明文存储：{disable_encryption()} 条记录")
+        else:
+            n = enable_encryption(args.key_file)
+            print(f"已转为加密存储：{n} 条记录（密钥："
+                  f"{key_file_path() if args.key_file or ENCRYPTION_KEY_ENV not in os.environ else '环境变量 ' + ENCRYPTION_KEY_ENV}）")
+            print("注意：已有的审计快照、.bak 备份、归档分区与导出文件仍是明文，请按需另行处理。")
+    elif args.cmd == "bench-storage":
+        print(run_storage_benchmark(args.rows, args.children, args.appends).to_string(index=False))
+    elif args.cmd == "archive":
+        ensure_audit_baseline()
+        r = archive_old_records(args.days)
+        print(f"已归档 {r['rows']} 条 {r['cutoff']} 之前的记录：{r['years'] or '无'}")
+
+
+if __name__ == "__main__" and not running_in_streamlit():
+    cli_main(sys.argv[1:])
+elif running_in_streamlit():
+    app_main()
@@ -0,0 +1,29 @@
+import importlib.util
+import os
+
+import pytest
+
+EYE_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "eye.py")
+
+
+@pytest.fixture(scope="session")
+def eye(tmp_path_factory):
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("import"))  # 导入时页面代码会在当前目录读数据
+    try:
+        spec = importlib.util.spec_from_file_location("eye", EYE_PY)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    return module
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    work = tmp_path / "data"
+    work.mkdir()
+    monkeypatch.chdir(work)
+    monkeypatch.delenv("EYE_DATA_KEY", raising=False)
+    monkeypatch.delenv("EYE_KEY_FILE", raising=False)
+    return work
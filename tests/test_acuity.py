@@ -0,0 +1,46 @@
+"""视力记录法换算：自动识别按整个文件判断一次，判断不了时要求明确选择。"""
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def _frame(left, right=None):
+    return pd.DataFrame({"左眼视力": left, "右眼视力": right if right is not None else left})
+
+
+def test_auto_detects_logmar_file(eye):
+    df = eye.normalize_acuity(_frame([0.0, 0.3, 1.0]), "自动识别")
+    assert df["左眼_logMAR"].tolist() == [0.0, 0.3, 1.0]
+    assert df["左眼视力"].tolist() == [1.0, 0.5, 0.1]
+
+
+def test_auto_detects_five_point_file(eye):
+    df = eye.normalize_acuity(_frame([5.0, 4.7, 4.0]), "自动识别")
+    assert df["左眼_logMAR"].tolist() == [0.0, 0.3, 1.0]
+    assert df["左眼视力"].tolist() == [1.0, 0.5, 0.1]
+
+
+def test_auto_detects_decimal_file_and_keeps_values(eye):
+    df = eye.normalize_acuity(_frame([0.7, 1.2, np.nan]), "自动识别")
+    assert df["左眼视力"].tolist()[:2] == [0.7, 1.2]
+    assert df["左眼_logMAR"].tolist()[:2] == [0.15, -0.1]
+
+
+def test_ambiguous_file_refused(eye):
+    with pytest.raises(ValueError, match="请明确选择"):
+        eye.normalize_acuity(_frame([0.3, 0.5, 1.0]), "自动识别")
+    with pytest.raises(ValueError):  # 5 分和其他记法混用
+        eye.normalize_acuity(_frame([5.0, 0.5]), "自动识别")
+
+
+def test_scale_detected_once_per_file(eye):
+    """左眼列看不出记法，右眼列有 0：整个文件按 logMAR 换算，两列不会各按各的。"""
+    df = eye.normalize_acuity(_frame([0.3, 0.5], [0.0, 0.2]), "自动识别")
+    assert df["左眼视力"].tolist() == [0.5, 0.3]
+    assert df["右眼视力"].tolist() == [1.0, 0.6]
+
+
+def test_zero_never_written_as_decimal(eye):
+    df = eye.normalize_acuity(_frame([0.0, 0.5]), "小数")
+    assert np.isnan(df["左眼视力"][0]) and np.isnan(df["左眼_logMAR"][0])
+    assert df["左眼视力"][1] == 0.5
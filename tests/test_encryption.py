@@ -0,0 +1,130 @@
+"""加密存储（分块 AES-GCM 容器）的测试：篡改、调换、截断、尾部合并、密钥位置。"""
+import base64
+import os
+import stat
+
+import pytest
+
+pytest.importorskip("cryptography")
+
+
+@pytest.fixture
+def store(eye, data_dir, monkeypatch):
+    """已加密的单文件存储，密钥走环境变量。"""
+    monkeypatch.setenv("EYE_DATA_KEY", base64.urlsafe_b64encode(os.urandom(32)).decode("ascii"))
+    eye.save_data(eye.synthetic_records(30, ["小明", "小红"]))
+    eye.enable_encryption()
+    return eye.EncryptedFile(eye.CSV_FILE)
+
+
+def _append(eye, n, child="小刚"):
+    for i in range(n):
+        eye.append_records(eye.synthetic_records(1, [child], seed=i + 1))
+
+
+def test_roundtrip_and_no_plaintext(eye, store):
+    assert len(eye.load_data()) == 30
+    assert not os.path.exists(eye.CSV_FILE)
+    assert "小明".encode("utf-8") not in open(store.path, "rb").read()
+    assert len(eye.load_data(child="小明")) == len(eye.load_data()[eye.child_keys(eye.load_data()) == "小明"])
+
+
+def test_tampered_chunk_rejected(eye, store):
+    data = bytearray(open(store.path, "rb").read())
+    data[store.index["chunks"][0]["offset"] + 40] ^= 1
+    open(store.path, "wb").write(bytes(data))
+    with pytest.raises(RuntimeError, match="校验失败"):
+        eye.load_data()
+
+
+def test_reordered_chunks_rejected(eye, store):
+    _append(eye, 2)
+    chunks = eye.EncryptedFile(eye.CSV_FILE).index["chunks"]
+    data = open(store.path, "rb").read()
+    a, b = chunks[-2], chunks[-1]
+    swapped = (data[:a["offset"]] + data[b["offset"]:b["offset"] + b["length"]]
+               + data[a["offset"]:a["offset"] + a["length"]])
+    open(store.path, "wb").write(swapped)
+    os.remove(store.idx_path)  # 逼它按文件内容重建索引
+    with pytest.raises(RuntimeError, match="校验失败"):
+        eye.load_data()
+
+
+def test_chunk_moved_from_other_file_rejected(eye, store):
+    other = eye.EncryptedFile("other.csv")
+    other.rewrite([eye.synthetic_records(5, ["小红"])])
+    theirs = open(other.path, "rb").read()
+    m = other.index["chunks"][0]
+    ours = open(store.path, "rb").read()
+    open(store.path, "wb").write(ours + theirs[m["offset"]:m["offset"] + m["length"]])
+    with pytest.raises(RuntimeError, match="校验失败"):
+        eye.load_data()
+
+
+def test_truncated_file_detected(eye, store):
+    _append(eye, 1)
+    chunks = eye.EncryptedFile(eye.CSV_FILE).index["chunks"]
+    data = open(store.path, "rb").read()
+    open(store.path, "wb").write(data[:chunks[-1]["offset"]])
+    with pytest.raises(RuntimeError, match="截断"):
+        eye.load_data()
+
+
+def test_torn_append_ignored(eye, store):
+    """追加写了半块就中断：半块被忽略，已有记录都还在，下次追加覆盖它。"""
+    with open(store.path, "ab") as f:
+        f.write(b"\x00\x00\x01\x00" + os.urandom(20))
+    assert len(eye.load_data()) == 30
+    _append(eye, 1)
+    assert len(eye.load_data()) == 31
+
+
+def test_lost_index_rebuilt(eye, store):
+    _append(eye, 3)
+    os.remove(store.idx_path)
+    assert len(eye.load_data()) == 33
+    assert len(eye.load_data(child="小刚")) == 3
+
+
+def test_tail_merge(eye, store):
+    n = eye.ENC_TAIL_MERGE + 2
+    _append(eye, n)
+    chunks = eye.EncryptedFile(eye.CSV_FILE).index["chunks"]
+    assert len(chunks) < 1 + n
+    assert sum(m["rows"] for m in chunks) == 30 + n
+    assert len(eye.load_data()) == 30 + n
+    assert len(eye.load_data(child="小刚")) == n
+
+
+def test_wrong_key_rejected(eye, store, monkeypatch):
+    monkeypatch.setenv("EYE_DATA_KEY", base64.urlsafe_b64encode(os.urandom(32)).decode("ascii"))
+    with pytest.raises(RuntimeError, match="不匹配"):
+        eye.load_data()
+
+
+def test_key_required(eye, data_dir):
+    eye.save_data(eye.synthetic_records(5, ["小明"]))
+    with pytest.raises(RuntimeError, match="需要密钥"):
+        eye.enable_encryption()
+    with pytest.raises(RuntimeError, match="数据目录"):
+        eye.enable_encryption("k.key")
+    assert not os.path.exists(eye.ENCRYPTION_FILE)
+    assert not os.path.exists("k.key")
+
+
+def test_key_file_outside_data_dir(eye, data_dir, tmp_path):
+    df = eye.synthetic_records(12, ["小明", "小红"])
+    df["站点"] = "东城站"
+    eye.save_data(df)
+    eye.shard_storage(by_site=True)
+    assert os.path.isdir(os.path.join(eye.SHARD_DIR, eye._slug("东城站")))
+    key_file = tmp_path / "eye.key"
+    assert eye.enable_encryption(str(key_file)) == 12
+    assert stat.S_IMODE(os.stat(key_file).st_mode) == 0o600
+    assert eye.key_file_path() == str(key_file.resolve())
+    assert len(eye.load_data()) == 12
+    # 明文分片按站点名建的目录已删掉，分片目录里只剩哈希命名的文件
+    names = [n for _, dirs, files in os.walk(eye.SHARD_DIR) for n in dirs + files]
+    assert names and not any("小" in n or "站" in n for n in names)
+    assert eye.disable_encryption() == 12
+    assert len(eye.load_data()) == 12
@@ -0,0 +1,52 @@
+"""增量导出的水位线与去标识化。"""
+import json
+
+import pandas as pd
+
+
+def _records(eye, n, child, recorded, seed=1):
+    df = eye.synthetic_records(n, [child], seed=seed)
+    df["录入时间"] = recorded
+    return df
+
+
+def _exported(eye, r):
+    with open(r["path"], encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_incremental_keeps_same_second_records(eye, data_dir):
+    """上次导出之后、同一秒里保存的记录，下次增量导出仍会带上，且已导出的不重复。"""
+    t = pd.Timestamp("2026-03-01 10:00:00")
+    eye.save_data(_records(eye, 2, "小明", t))
+    assert eye.export_records(incremental=True)["rows"] == 2
+    eye.append_records(_records(eye, 1, "小红", t, seed=7))
+    r = eye.export_records(incremental=True)
+    assert r["rows"] == 1 and _exported(eye, r)[0]["child_id"] == "小红"
+    assert eye.export_records(incremental=True)["rows"] == 0
+    eye.append_records(_records(eye, 1, "小红", t + pd.Timedelta(seconds=1), seed=8))
+    assert eye.export_records(incremental=True)["rows"] == 1
+
+
+def test_old_watermark_format_still_read(eye, data_dir):
+    eye.save_data(_records(eye, 2, "小明", pd.Timestamp("2026-03-01 10:00:00")))
+    eye.os.makedirs(eye.EXPORT_DIR, exist_ok=True)
+    with open(eye.EXPORT_STATE_FILE, "w", encoding="utf-8") as f:
+        json.dump({"default": "2026-02-01T00:00:00"}, f)
+    assert eye.export_records(incremental=True)["rows"] == 2
+
+
+def test_deid_drops_or_pseudonymizes_staff_text(eye, data_dir):
+    df = _records(eye, 3, "张小明", pd.Timestamp("2026-03-01 10:00:00"))
+    df["站点"] = "李医生诊室"
+    df["阶段名称"] = "张小明阿托品阶段"
+    df["阶段主方案"] = "王主任方案"
+    df["阶段ID"] = "20250101-01"
+    eye.save_data(df)
+    r = eye.export_records(salt="s3cret")
+    text = open(r["path"], encoding="utf-8").read()
+    for raw in ("张小明", "李医生", "王主任", "20250101"):
+        assert raw not in text
+    row = _exported(eye, r)[0]
+    assert "stage_name" not in row and "stage_plan" not in row
+    assert row["site_id"] and row["stage_id"]